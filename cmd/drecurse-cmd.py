@@ -23,6 +23,7 @@ exclude= a path to exclude from the backup (can be used more than once)
 exclude-from= a file that contains exclude paths (can be used more than once)
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
+j,jobs=  read up to this many directories in parallel [1]
 q,quiet  don't actually print filenames
 profile  run under the python profiler
 """
@@ -31,6 +32,9 @@ o = options.Options(optspec)
 
 if len(extra) != 1:
     o.fatal("exactly one filename expected")
+opt.jobs = int(opt.jobs or 1)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 drecurse_top = argv_bytes(extra[0])
 excluded_paths = parse_excludes(flags, o.fatal)
@@ -39,7 +43,8 @@ if not drecurse_top.startswith(b'/'):
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 it = drecurse.recursive_dirlist([drecurse_top], opt.xdev,
                                 excluded_paths=excluded_paths,
-                                exclude_rxs=exclude_rxs)
+                                exclude_rxs=exclude_rxs,
+                                jobs=opt.jobs)
 if opt.profile:
     import cProfile
     def do_it():
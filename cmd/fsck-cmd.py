@@ -6,15 +6,16 @@ exec "$bup_python" "$0" ${1+"$@"}
 # end of bup preamble
 
 from __future__ import absolute_import, print_function
-import sys, os, glob, subprocess
+from multiprocessing import Pool
+import sys, os, glob, json, subprocess, time
 from shutil import rmtree
 from subprocess import PIPE, Popen
 from tempfile import mkdtemp
 
-from bup import options, git
+from bup import options, fsck, git
 from bup.compat import argv_bytes
-from bup.helpers import Sha1, chunkyreader, istty2, log, progress
-from bup.io import byte_stream
+from bup.helpers import istty2, log, progress, qprogress
+from bup.io import byte_stream, path_msg
 
 
 par2_ok = 0
@@ -99,33 +100,21 @@ def par2_verify(base):
 def par2_repair(base):
     return par2(b'repair', [b'--', base], verb_floor=2)
 
-def quick_verify(base):
-    f = open(base + b'.pack', 'rb')
-    f.seek(-20, 2)
-    wantsum = f.read(20)
-    assert(len(wantsum) == 20)
-    f.seek(0)
-    sum = Sha1()
-    for b in chunkyreader(f, os.fstat(f.fileno()).st_size - 20):
-        sum.update(b)
-    if sum.digest() != wantsum:
-        raise ValueError('expected %r, got %r' % (wantsum.encode('hex'),
-                                                  sum.hexdigest()))
-        
+def native_verify(base, last, report):
+    report.update(fsck.verify_pack(base, full=not opt.quick))
+    for msg in report['errors']:
+        log('%s: %s\n' % (path_msg(last), msg))
+    omitted = report['error_count'] - len(report['errors'])
+    if omitted:
+        log('%s: (and %d more errors)\n' % (path_msg(last), omitted))
+    return 1 if report['error_count'] else 0
 
-def git_verify(base):
-    if opt.quick:
-        try:
-            quick_verify(base)
-        except Exception as e:
-            log('error: %s\n' % e)
-            return 1
-        return 0
-    else:
-        return run([b'git', b'verify-pack', b'--', base])
-    
-    
-def do_pack(base, last, par2_exists, out):
+
+def do_pack(base, last, par2_exists):
+    """Check (etc.) the pack and return (code, action_result, report),
+    where report is a dict describing the outcome (cf. --report)."""
+    start = time.time()
+    report = {}
     code = 0
     if par2_ok and par2_exists and (opt.repair or not opt.generate):
         vresult = par2_verify(base)
@@ -147,10 +136,10 @@ def do_pack(base, last, par2_exists, out):
         else:
             action_result = b'ok'
     elif not opt.generate or (par2_ok and not par2_exists):
-        gresult = git_verify(base)
+        gresult = native_verify(base, last, report)
         if gresult != 0:
             action_result = b'failed'
-            log('%s git verify: failed (%d)\n' % (last, gresult))
+            log('%s verify: failed (%d)\n' % (path_msg(last), gresult))
             code = gresult
         else:
             if par2_ok and opt.generate:
@@ -166,9 +155,18 @@ def do_pack(base, last, par2_exists, out):
     else:
         assert(opt.generate and (not par2_ok or par2_exists))
         action_result = b'exists' if par2_exists else b'skipped'
-    if opt.verbose:
-        out.write(last + b' ' +  action_result + b'\n')
-    return code
+    report['seconds'] = round(time.time() - start, 3)
+    return code, action_result, report
+
+
+def check_pack(task):
+    base, last, par2_exists = task
+    try:
+        code, action_result, report = do_pack(base, last, par2_exists)
+    except Exception as e:
+        log('exception: %r\n' % e)
+        code, action_result, report = 99, b'failed', {'errors': [repr(e)]}
+    return last, code, action_result, report
 
 
 optspec = """
@@ -177,14 +175,18 @@ bup fsck [options...] [filenames...]
 r,repair    attempt to repair errors using par2 (dangerous!)
 g,generate  generate auto-repair information using par2
 v,verbose   increase verbosity (can be used more than once)
-quick       just check pack sha1sum, don't use git verify-pack
-j,jobs=     run 'n' jobs in parallel
+quick       don't inflate and hash each object, just check checksums and CRCs
+j,jobs=     check 'n' packs in parallel
+report=     write a JSON description of each pack's outcome to the given file ('-' for stdout)
 par2-ok     immediately return 0 if par2 is ok, 1 if not
 disable-par2  ignore par2 even if it is available
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
 opt.verbose = opt.verbose or 0
+opt.jobs = int(opt.jobs or 1)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 par2_setup()
 if opt.par2_ok:
@@ -198,16 +200,21 @@ if opt.disable_par2:
 git.check_repo_or_die()
 
 if extra:
-    extra = [argv_byes(x) for x in extra]
+    extra = [argv_bytes(x) for x in extra]
 else:
     debug('fsck: No filenames given: checking all packs.\n')
     extra = glob.glob(git.repo(b'objects/pack/*.pack'))
 
 sys.stdout.flush()
 out = byte_stream(sys.stdout)
-code = 0
-count = 0
-outstanding = {}
+report_file = None
+if opt.report == '-':
+    report_file = out
+elif opt.report:
+    report_file = open(argv_bytes(opt.report), 'wb')
+
+tasks = []
+pack_sizes = {}
 for name in extra:
     if name.endswith(b'.pack'):
         base = name[:-5]
@@ -223,43 +230,62 @@ for name in extra:
     par2_exists = os.path.exists(base + b'.par2')
     if par2_exists and os.stat(base + b'.par2').st_size == 0:
         par2_exists = 0
-    sys.stdout.flush()  # Not sure we still need this, but it'll flush out too
-    debug('fsck: checking %r (%s)\n'
-          % (last, par2_ok and par2_exists and 'par2' or 'git'))
+    try:
+        pack_sizes[last] = os.stat(base + b'.pack').st_size
+    except OSError:
+        pack_sizes[last] = 0
+    tasks.append((base, last, par2_exists))
+total_bytes = sum(pack_sizes.values())
+
+def pack_progress(count, done_bytes):
     if not opt.verbose:
-        progress('fsck (%d/%d)\r' % (count, len(extra)))
-    
-    if not opt.jobs:
-        nc = do_pack(base, last, par2_exists, out)
-        code = code or nc
-        count += 1
-    else:
-        while len(outstanding) >= opt.jobs:
-            (pid,nc) = os.wait()
-            nc >>= 8
-            if pid in outstanding:
-                del outstanding[pid]
-                code = code or nc
-                count += 1
-        pid = os.fork()
-        if pid:  # parent
-            outstanding[pid] = 1
-        else: # child
-            try:
-                sys.exit(do_pack(base, last, par2_exists, out))
-            except Exception as e:
-                log('exception: %r\n' % e)
-                sys.exit(99)
-                
-while len(outstanding):
-    (pid,nc) = os.wait()
-    nc >>= 8
-    if pid in outstanding:
-        del outstanding[pid]
+        qprogress('fsck (%d/%d packs, %d/%d MiB)\r'
+                  % (count, len(tasks),
+                     done_bytes // 1024**2, total_bytes // 1024**2))
+
+# With more than one job, the packs are checked by a pool of worker
+# processes, and the results are reported here as they finish.
+if opt.jobs > 1 and len(tasks) > 1:
+    pool = Pool(min(opt.jobs, len(tasks)))
+    results = pool.imap_unordered(check_pack, tasks)
+else:
+    pool = None
+    results = (check_pack(task) for task in tasks)
+
+code = 0
+count = 0
+done_bytes = 0
+try:
+    pack_progress(count, done_bytes)
+    for last, nc, action_result, report in results:
         code = code or nc
         count += 1
-    if not opt.verbose:
-        progress('fsck (%d/%d)\r' % (count, len(extra)))
+        done_bytes += pack_sizes[last]
+        if opt.verbose:
+            out.write(last + b' ' +  action_result + b'\n')
+        if report_file:
+            report['pack'] = path_msg(last)
+            report['result'] = action_result.decode('ascii')
+            report_file.write(json.dumps(report, sort_keys=True)
+                              .encode('ascii') + b'\n')
+            report_file.flush()
+        pack_progress(count, done_bytes)
+except BaseException:
+    if pool:
+        pool.terminate()
+        pool.join()
+        pool = None
+    raise
+finally:
+    if pool:
+        pool.close()
+        pool.join()
+if not opt.verbose:
+    progress('fsck (%d/%d packs, %d/%d MiB), done.\n'
+             % (count, len(tasks),
+                done_bytes // 1024**2, total_bytes // 1024**2))
+if report_file and report_file is not out:
+    report_file.close()
 
 if istty2:
     debug('fsck done.           \n')
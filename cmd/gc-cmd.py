@@ -10,7 +10,7 @@ import sys
 
 from bup import git, options
 from bup.gc import bup_gc
-from bup.helpers import die_if_errors, handle_ctrl_c, log
+from bup.helpers import die_if_errors, handle_ctrl_c, log, parse_num
 
 
 optspec = """
@@ -19,6 +19,8 @@ bup gc [options...]
 v,verbose   increase log output (can be used more than once)
 threshold=  only rewrite a packfile if it's over this percent garbage [10]
 #,compress= set compression level to # (0-9, 9 is highest) [1]
+j,jobs=     number of parallel jobs for finding and sweeping data [1]
+bitmap-max= max memory for an exact (bitmap) record of the live objects [64M]
 unsafe      use the command even though it may be DANGEROUS
 """
 
@@ -44,10 +46,21 @@ if opt.threshold:
     if opt.threshold < 0 or opt.threshold > 100:
         o.fatal('threshold must be an integer percentage value')
 
+opt.jobs = int(opt.jobs or 1)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+
+try:
+    opt.bitmap_max = parse_num(opt.bitmap_max)
+except ValueError:
+    o.fatal('invalid --bitmap-max size %r' % opt.bitmap_max)
+
 git.check_repo_or_die()
 
 bup_gc(threshold=opt.threshold,
        compression=opt.compress,
-       verbosity=opt.verbose)
+       verbosity=opt.verbose,
+       jobs=opt.jobs,
+       max_bitmap_size=opt.bitmap_max)
 
 die_if_errors()
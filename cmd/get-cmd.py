@@ -183,11 +183,19 @@ def parse_args(args):
 def get_random_item(name, hash, repo, writer, opt):
     def already_seen(oid):
         return writer.exists(unhexlify(oid))
-    for item in walk_object(repo.cat, hash, stop_at=already_seen,
-                            include_data=True):
+    for item in walk_object(repo.cat, hash, stop_at=already_seen):
         # already_seen ensures that writer.exists(id) is false.
         # Otherwise, just_write() would fail.
-        writer.just_write(item.oid, item.type, item.data)
+        oidx = hexlify(item.oid)
+        # Copy the compressed pack record as-is when the source has
+        # the whole object at the requested compression level, and
+        # only fall back to inflating and recompressing it otherwise.
+        raw = repo.cat_raw(oidx, compression_level=opt.compress)
+        if raw:
+            writer.just_write_raw(item.oid, raw[1])
+        else:
+            writer.just_write(item.oid, item.type,
+                              get_cat_data(repo.cat(oidx), item.type))
 
 
 def append_commit(name, hash, parent, src_repo, writer, opt):
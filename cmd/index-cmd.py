@@ -9,27 +9,158 @@ from __future__ import absolute_import, print_function
 from binascii import hexlify
 import sys, stat, time, os, errno, re
 
-from bup import metadata, options, git, index, drecurse, hlinkdb
+from bup import metadata, options, git, index, drecurse, hlinkdb, watch, xstat
 from bup.compat import argv_bytes
 from bup.drecurse import recursive_dirlist
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE
-from bup.helpers import (add_error, handle_ctrl_c, log, parse_excludes, parse_rx_excludes,
-                         progress, qprogress, saved_errors)
+from bup.helpers import (add_error, debug1, handle_ctrl_c, log, parse_excludes,
+                         parse_rx_excludes, progress, qprogress, saved_errors)
 from bup.io import byte_stream, path_msg
 
 
-class IterHelper:
+class IterHelper(object):
+    # The iterator isn't advanced until cur is actually needed, so that
+    # (cf. StableDirs) it's never ahead of the filesystem traversal.
     def __init__(self, l):
         self.i = iter(l)
-        self.cur = None
-        self.next()
+        self._cur = None
+        self._stale = True
+
+    @property
+    def cur(self):
+        if self._stale:
+            self._cur = next(self.i, None)
+            self._stale = False
+        return self._cur
 
     def __next__(self):
-        self.cur = next(self.i, None)
-        return self.cur
+        self._stale = True
 
     next = __next__
 
+
+class StableDirs:
+    """With --assume-stable, decide (as the recursive_dirlist() stable
+    function) which directories can be trusted not to have changed,
+    because the directory's own stat matches its existing index entry.
+    The existing entries for the contents of those directories (just
+    their non-directories for 'dirs', everything for 'trees') are then
+    kept as they are, without looking at the filesystem."""
+    def __init__(self, reader, trees, tstart, check_device=True):
+        self.reader = reader
+        self.trees = trees
+        self.tstart = tstart
+        self.check_device = check_device
+        # {dir name: the names still to be visited} for the trusted
+        # directories, until they're done().
+        self.kept = {}
+        # {dir name: {child name: entry}} for the directories that are
+        # still being traversed.
+        self._children = {}
+
+    def _children_of(self, name):
+        kids = self._children.get(name)
+        if kids is None:
+            if name == b'/':
+                ent = self.reader.root()
+            else:
+                ent = self._entry(name)
+            if not ent:
+                return None
+            kids = dict((c.name, c) for c in ent.children())
+            self._children[name] = kids
+        return kids
+
+    def _entry(self, name):
+        kids = self._children_of(_parent_name(name))
+        ent = kids.get(name) if kids else None
+        if not ent or ent.is_deleted():
+            return None
+        return ent
+
+    def _unchanged(self, ent, st):
+        if ent.mtime != st.st_mtime or ent.ctime != st.st_ctime:
+            return False
+        # The link count also covers the number of subdirectories.
+        if ent.size != st.st_size or ent.nlink != st.st_nlink:
+            return False
+        if ent.ino != st.st_ino or ent.mode != st.st_mode:
+            return False
+        if self.check_device and ent.dev != st.st_dev:
+            return False
+        ctime_sec_in_ns = xstat.fstime_floor_secs(st.st_ctime) * 10**9
+        return ctime_sec_in_ns < self.tstart
+
+    def _trusted(self, path, st):
+        """Return the names in the directory path that still have to
+        be visited if the rest of it can be trusted, else None."""
+        ent = self._entry(path)
+        if not ent or not self._unchanged(ent, st):
+            return None
+        if self.trees:
+            return []
+        return [name[len(path):]
+                for name, child in self._children_of(path).items()
+                if name.endswith(b'/') and child.exists()]
+
+    def __call__(self, path, st):
+        names = self._trusted(path, st)
+        if names is not None:
+            self.kept[path] = names
+        return names
+
+    def keeps(self, name):
+        """Return true if the existing entry for name should be kept."""
+        return _parent_name(name) in self.kept
+
+    def wantrecurse(self, ent):
+        # Nothing below a directory that's trusted entirely is needed.
+        return self.kept.get(ent.name) != []
+
+    def done(self, name):
+        self.kept.pop(name, None)
+        self._children.pop(name, None)
+
+
+class JournalDirs(StableDirs):
+    """With --from-journal, trust every directory under the watched
+    roots that existed during the last update, except for those that
+    changes (a watch.Changes) says may have changed, and visit only the
+    paths leading to the changes."""
+    def __init__(self, reader, tstart, changes, roots, check_device=True):
+        StableDirs.__init__(self, reader, False, tstart,
+                            check_device=check_device)
+        self.changes = changes
+        self.roots = roots
+        # {dir name: set of names leading to changes}
+        self._visit = {}
+        for kind, path in changes.records():
+            while path != b'/':
+                parent = _parent_name(path)
+                self._visit.setdefault(parent, set()).add(path[len(parent):])
+                path = parent
+
+    def _in_tree(self, path):
+        while True:
+            if path in self.changes.trees:
+                return True
+            if path == b'/':
+                return False
+            path = _parent_name(path)
+
+    def _trusted(self, path, st):
+        if not watch.under_roots(path, self.roots):
+            return None
+        if path in self.changes.listed or self._in_tree(path):
+            return None
+        if not self._entry(path):
+            return None
+        return sorted(self._visit.get(path, ()))
+
+
+def _parent_name(name):
+    return name[:name.rindex(b'/', 0, len(name) - 1) + 1]
+
 def check_index(reader):
     try:
         log('check: checking forward iteration...\n')
@@ -61,7 +192,11 @@ def check_index(reader):
 
 
 def clear_index(indexfile):
-    indexfiles = [indexfile, indexfile + b'.meta', indexfile + b'.hlink']
+    indexfiles = [indexfile, index.delta_name(indexfile),
+                  indexfile + b'.meta', indexfile + b'.meta.ofs',
+                  indexfile + b'.hlink', indexfile + b'.hlink.journal',
+                  watch.journal_name(indexfile),
+                  watch.journal_name(indexfile) + b'.taken']
     for indexfile in indexfiles:
         path = git.repo(indexfile)
         try:
@@ -73,14 +208,25 @@ def clear_index(indexfile):
                 raise
 
 
-def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
+def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None,
+                 changes=None, roots=None):
     # tmax and start must be epoch nanoseconds.
     tmax = (time.time() - 1) * 10**9
     ri = index.Reader(indexfile)
     msw = index.MetaStoreWriter(indexfile + b'.meta')
     wi = index.Writer(indexfile, msw, tmax)
-    rig = IterHelper(ri.iter(name=top))
     tstart = int(time.time()) * 10**9
+    stable = None
+    wantrecurse = None
+    if changes is not None:
+        stable = JournalDirs(ri, tstart, changes, roots,
+                             check_device=opt.check_device)
+    elif opt.assume_stable:
+        stable = StableDirs(ri, opt.assume_stable == 'trees', tstart,
+                            check_device=opt.check_device)
+    if stable:
+        wantrecurse = stable.wantrecurse
+    rig = IterHelper(ri.iter(name=top, wantrecurse=wantrecurse))
 
     hlinks = hlinkdb.HLinkDB(indexfile + b'.hlink')
 
@@ -97,7 +243,9 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
                                        bup_dir=bup_dir,
                                        excluded_paths=excluded_paths,
                                        exclude_rxs=exclude_rxs,
-                                       xdev_exceptions=xdev_exceptions):
+                                       xdev_exceptions=xdev_exceptions,
+                                       jobs=opt.jobs,
+                                       stable=stable):
         if opt.verbose>=2 or (opt.verbose==1 and stat.S_ISDIR(pst.st_mode)):
             out.write(b'%s\n' % path)
             out.flush()
@@ -110,7 +258,10 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
             qprogress('Indexing: %d (%d paths/s)\r' % (total, paths_per_sec))
         total += 1
 
-        while rig.cur and rig.cur.name > path:  # deleted paths
+        while rig.cur and rig.cur.name > path:  # deleted (or kept) paths
+            if stable and stable.keeps(rig.cur.name):
+                rig.next()
+                continue
             if rig.cur.exists():
                 rig.cur.set_deleted()
                 rig.cur.repack()
@@ -118,6 +269,9 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
                     hlinks.del_path(rig.cur.name)
             rig.next()
 
+        if stable and stat.S_ISDIR(pst.st_mode):
+            stable.done(path)
+
         if rig.cur and rig.cur.name == path:    # paths that already existed
             need_repack = False
             if(rig.cur.stale(pst, tstart, check_device=opt.check_device)):
@@ -189,14 +343,18 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
                 check_index(ri)
                 log('check: before merging: newfile\n')
                 check_index(wr)
-            mi = index.Writer(indexfile, msw, tmax)
+            if index.update_delta(ri, wr):
+                debug1('index: added %d entries via the delta\n' % wr.count)
+                ri.close()
+            else:
+                mi = index.Writer(indexfile, msw, tmax)
 
-            for e in index.merge(ri, wr):
-                # FIXME: shouldn't we remove deleted entries eventually?  When?
-                mi.add_ixentry(e)
+                for e in index.merge(ri, wr):
+                    # FIXME: shouldn't we remove deleted entries eventually?  When?
+                    mi.add_ixentry(e)
 
-            ri.close()
-            mi.close()
+                ri.close()
+                mi.close()
             wr.close()
         wi.abort()
     else:
@@ -207,7 +365,7 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions, out=None):
 
 
 optspec = """
-bup index <-p|-m|-s|-u|--clear|--check> [options...] <filenames...>
+bup index <-p|-m|-s|-u|--clear|--check|--compact|--watch> [options...] <filenames...>
 --
  Modes:
 p,print    print the index entries for the given names (also works with -u)
@@ -216,6 +374,9 @@ s,status   print each filename with a status char (A/M/D) (implies -p)
 u,update   recursively update the index entries for the given file/dir names (default if no mode is specified)
 check      carefully check index file integrity
 clear      clear the default index
+compact    fold in any pending delta, and drop unreferenced metadata
+watch      record changes to the given paths for --from-journal until interrupted
+from-journal  like -u, but only look at what --watch recorded as changed
  Options:
 H,hash     print the hash for each object next to its name
 l,long     print more information about each file
@@ -229,6 +390,8 @@ exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 v,verbose  increase log output (can be used more than once)
 x,xdev,one-file-system  don't cross filesystem boundaries
+j,jobs=    read up to this many directories in parallel [1]
+assume-stable= trust unchanged directories' index entries ('dirs' or 'trees')
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -238,14 +401,32 @@ if not (opt.modified or \
         opt.status or \
         opt.update or \
         opt.check or \
-        opt.clear):
+        opt.clear or \
+        opt.compact or \
+        opt.watch):
     opt.update = 1
+if opt.from_journal:
+    if opt.assume_stable:
+        o.fatal('--from-journal is incompatible with --assume-stable')
+    opt.update = 1
+if opt.watch:
+    if opt.update or opt['print'] or opt.status or opt.modified:
+        o.fatal('--watch is incompatible with -p, -m, -s, and -u')
+    if not watch.inotify_init:
+        o.fatal('--watch is not supported on this system')
 if (opt.fake_valid or opt.fake_invalid) and not opt.update:
     o.fatal('--fake-{in,}valid are meaningless without -u')
 if opt.fake_valid and opt.fake_invalid:
     o.fatal('--fake-valid is incompatible with --fake-invalid')
+if opt.assume_stable and not opt.update:
+    o.fatal('--assume-stable is meaningless without -u')
+if opt.assume_stable not in (None, 'dirs', 'trees'):
+    o.fatal("--assume-stable must be 'dirs' or 'trees'")
 if opt.clear and opt.indexfile:
     o.fatal('cannot clear an external index (via -f)')
+opt.jobs = int(opt.jobs or 1)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 # FIXME: remove this once we account for timestamp races, i.e. index;
 # touch new-file; index.  It's possible for this to happen quickly
@@ -277,6 +458,12 @@ if opt.clear:
 sys.stdout.flush()
 out = byte_stream(sys.stdout)
 
+if opt.compact:
+    log('compact: compacting index metadata.\n')
+    reclaimed = index.compact_metastore(indexfile)
+    if opt.verbose:
+        log('compact: reclaimed %d bytes\n' % reclaimed)
+
 if opt.update:
     if not extra:
         o.fatal('update mode (-u) requested but no paths given')
@@ -284,9 +471,51 @@ if opt.update:
     excluded_paths = parse_excludes(flags, o.fatal)
     exclude_rxs = parse_rx_excludes(flags, o.fatal)
     xexcept = index.unique_resolved_paths(extra)
-    for rp, path in index.reduce_paths(extra):
+    changes = roots = None
+    if opt.from_journal:
+        roots = watch.watched_roots(indexfile)
+        if roots is not None:
+            changes = watch.take_changes(indexfile)
+        if changes is None:
+            log('index: no --watch is running; updating everything.\n')
+    tops = index.reduce_paths(extra)
+    for rp, path in tops:
+        top_changes = None
+        if changes is not None:
+            if watch.under_roots(rp, roots):
+                top_changes = changes.under(rp)
+                if not top_changes:
+                    continue
+            elif any(root.startswith(rp) for root in roots):
+                # Only part of it is watched.
+                top_changes = changes.under(rp)
+            else:
+                log('index: %s is not being watched; updating all of it.\n'
+                    % path_msg(rp))
         update_index(rp, excluded_paths, exclude_rxs, xdev_exceptions=xexcept,
-                     out=out)
+                     out=out, changes=top_changes, roots=roots)
+    if changes is not None:
+        watch.finish_changes(indexfile,
+                             changes.outside([rp for rp, path in tops]))
+
+if opt.watch:
+    if not extra:
+        o.fatal('--watch requested but no paths given')
+    roots = [rp for rp, path in index.reduce_paths(argv_bytes(x)
+                                                    for x in extra)
+             if rp.endswith(b'/')]
+    if not roots:
+        o.fatal('--watch requires at least one directory')
+    watcher = watch.Watcher(indexfile, roots, xdev=opt.xdev,
+                            bup_dir=os.path.abspath(git.repo()),
+                            excluded_paths=parse_excludes(flags, o.fatal),
+                            exclude_rxs=parse_rx_excludes(flags, o.fatal))
+    watcher.start()
+    log('watch: watching %d directories.\n' % len(watcher))
+    try:
+        watcher.run()
+    finally:
+        watcher.close()
 
 if opt['print'] or opt.status or opt.modified:
     extra = [argv_bytes(x) for x in extra]
@@ -40,6 +40,7 @@ strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    number of threads to use for hashing and compression [1]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -63,6 +64,9 @@ extra = [argv_bytes(x) for x in extra]
 
 opt.progress = (istty2 and not opt.quiet)
 opt.smaller = parse_num(opt.smaller or 0)
+opt.jobs = int(opt.jobs or 1)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
 
@@ -109,11 +113,11 @@ if opt.remote or is_reverse:
         log('error: %s' % e)
         sys.exit(1)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
+    w = cli.new_packwriter(compression_level=opt.compress, jobs=opt.jobs)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+    w = git.PackWriter(compression_level=opt.compress, jobs=opt.jobs)
 
 handle_ctrl_c()
 
@@ -416,7 +420,8 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
                 try:
                     (mode, id) = hashsplit.split_to_blob_or_tree(
                                             w.new_blob, w.new_tree, [f],
-                                            keep_boundaries=False)
+                                            keep_boundaries=False,
+                                            makeblobs=w.new_blobs)
                 except (IOError, OSError) as e:
                     add_error('%s: %s' % (ent.name, e))
                     lastskip_name = ent.name
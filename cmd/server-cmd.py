@@ -10,7 +10,7 @@ from binascii import hexlify, unhexlify
 import os, sys, struct, subprocess
 
 from bup import options, git, vfs, vint
-from bup.compat import environ, hexstr
+from bup.compat import environ, hexstr, range
 from bup.git import MissingObject
 from bup.helpers import (Conn, debug1, debug2, linereader, lines_until_sentinel,
                          log)
@@ -21,6 +21,7 @@ from bup.repo import LocalRepo
 suspended_w = None
 dumb_server_mode = False
 repo = None
+objcache = None
 
 def do_help(conn, junk):
     conn.write(b'Commands:\n    %s\n' % b'\n    '.join(sorted(commands)))
@@ -32,6 +33,12 @@ def _set_mode():
     dumb_server_mode = os.path.exists(git.repo(b'bup-dumb-server'))
     debug1('bup server: serving in %s mode\n' 
            % (dumb_server_mode and 'dumb' or 'smart'))
+    if not dumb_server_mode and git.git_config_get(b'bup.locmap',
+                                                   opttype='bool'):
+        # Every server (and anything else) writing to the repository
+        # adds its packs to the map as they're finished, so it only
+        # has to be built once.
+        git.update_locmap(git.repo(b'objects/pack'), create=True)
 
 
 def _init_session(reinit_with_new_repopath=None):
@@ -44,6 +51,7 @@ def _init_session(reinit_with_new_repopath=None):
     if repo:
         repo.close()
     repo = LocalRepo()
+    _drop_objcache()
     # OK. we now know the path is a proper repository. Record this path in the
     # environment so that subprocesses inherit it and know where to operate.
     environ[b'BUP_DIR'] = git.repodir
@@ -84,6 +92,49 @@ def send_index(conn, name):
     conn.ok()
 
 
+def _drop_objcache():
+    global objcache
+    objcache = None
+
+
+def _current_objcache():
+    # Keep one PackIdxList for all of the sessions on this connection,
+    # and just refresh it to pick up any packs that have been written
+    # since (here or elsewhere), rather than starting from scratch.
+    global objcache
+    if objcache is None:
+        objcache = git.PackIdxList(git.repo(b'objects/pack'))
+    else:
+        objcache.refresh()
+    return objcache
+
+
+def _shared_objcache():
+    oc = _current_objcache()
+    oc.also = set()
+    return oc
+
+
+def have_objects(conn, count):
+    _init_session()
+    n = int(count)
+    ids = conn.read(n * 20)
+    if len(ids) != n * 20:
+        raise Exception('have-objects: expected %d bytes, got %d\n'
+                        % (n * 20, len(ids)))
+    found = _current_objcache().exists_many([ids[i : i + 20]
+                                             for i in range(0, n * 20, 20)])
+    # Bit i (counting from the low bit of the first byte) is set if
+    # object i exists.
+    bits = bytearray((n + 7) // 8)
+    for i, have in enumerate(found):
+        if have:
+            bits[i >> 3] |= 1 << (i & 7)
+    conn.write(bytes(bits))
+    debug1('bup server: have %d of %d objects\n' % (sum(found), n))
+    conn.ok()
+
+
 def receive_objects_v2(conn, junk):
     global suspended_w
     _init_session()
@@ -95,7 +146,7 @@ def receive_objects_v2(conn, junk):
         if dumb_server_mode:
             w = git.PackWriter(objcache_maker=None)
         else:
-            w = git.PackWriter()
+            w = git.PackWriter(objcache_maker=_shared_objcache)
     while 1:
         ns = conn.read(4)
         if not ns:
@@ -177,20 +228,33 @@ def join(conn, id):
         conn.write(b'\0\0\0\0')
         conn.ok()
 
+def _write_cat_result(conn, cat_pipe, ref):
+    it = cat_pipe.get(ref)
+    info = next(it)
+    if not info[0]:
+        conn.write(b'missing\n')
+        return
+    conn.write(b'%s %s %d\n' % info)
+    for buf in it:
+        conn.write(buf)
+
 def cat_batch(conn, dummy):
     _init_session()
     cat_pipe = git.cp()
     # For now, avoid potential deadlock by just reading them all
     for ref in tuple(lines_until_sentinel(conn, b'\n', Exception)):
-        ref = ref[:-1]
-        it = cat_pipe.get(ref)
-        info = next(it)
-        if not info[0]:
-            conn.write(b'missing\n')
-            continue
-        conn.write(b'%s %s %d\n' % info)
-        for buf in it:
-            conn.write(buf)
+        _write_cat_result(conn, cat_pipe, ref[:-1])
+    conn.ok()
+
+def cat_stream(conn, dummy):
+    # Like cat-batch, but answer each ref as soon as it arrives.  The
+    # client limits the number of refs in flight (so it'll never block
+    # while sending one), and conn.readline() flushes our output before
+    # waiting for the next one.
+    _init_session()
+    cat_pipe = git.cp()
+    for ref in lines_until_sentinel(conn, b'\n', Exception):
+        _write_cat_result(conn, cat_pipe, ref[:-1])
     conn.ok()
 
 def refs(conn, args):
@@ -280,11 +344,13 @@ commands = {
     b'list-indexes': list_indexes,
     b'send-index': send_index,
     b'receive-objects-v2': receive_objects_v2,
+    b'have-objects': have_objects,
     b'read-ref': read_ref,
     b'update-ref': update_ref,
     b'join': join,
     b'cat': join,  # apocryphal alias
     b'cat-batch' : cat_batch,
+    b'cat-stream' : cat_stream,
     b'refs': refs,
     b'rev-list': rev_list,
     b'resolve': resolve
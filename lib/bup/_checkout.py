@@ -0,0 +1,3 @@
+COMMIT='78a3c611a9d2f3592767aec22000711b262f94fe'
+NAMES='(tag: 78a3c61)'
+DATE='2026-10-18 23:06:09 +0000'
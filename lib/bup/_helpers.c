@@ -44,12 +44,30 @@
 #include <time.h>
 #endif
 
+#ifdef HAVE_DIRENT_H
+#include <dirent.h>
+#endif
+
+#ifdef HAVE_SYS_INOTIFY_H
+#include <sys/inotify.h>
+#endif
+
 #include "bupsplit.h"
 
 #if defined(FS_IOC_GETFLAGS) && defined(FS_IOC_SETFLAGS)
 #define BUP_HAVE_FILE_ATTRS 1
 #endif
 
+#if defined(HAVE_DIRENT_H) && defined(HAVE_OPENAT) && defined(HAVE_FSTATAT) \
+    && defined(HAVE_FDOPENDIR) && defined(AT_SYMLINK_NOFOLLOW) \
+    && defined(O_DIRECTORY) && defined(O_NOFOLLOW)
+#define BUP_HAVE_DIRFD_OPS 1
+#endif
+
+#if defined(HAVE_SYS_INOTIFY_H) && defined(HAVE_INOTIFY_INIT1)
+#define BUP_HAVE_INOTIFY 1
+#endif
+
 /*
  * Check for incomplete UTIMENSAT support (NetBSD 6), and if so,
  * pretend we don't have it.
@@ -839,6 +857,111 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 }
 
 
+/* Version 3 (blocked) filters: the table is divided into 64 byte
+ * (512 bit) blocks, the first nbits - 6 bits of the sha (at most 32)
+ * choose a block, and each of the k positions within the block is
+ * taken from the next 9 bits of the sha, starting with the second 64
+ * bits.  So all of an object's bits are in one cache line (and page).
+ */
+#define BLOOM3_BLOCK_SHIFT 6
+#define BLOOM3_MAX_BITS (32 + BLOOM3_BLOCK_SHIFT)
+#define BLOOM3_MAX_K 8
+
+static unsigned char *bloom3_block(unsigned char *bloom,
+                                   const unsigned char *sha, const int nbits)
+{
+    uint32_t high;
+    int block_bits = nbits - BLOOM3_BLOCK_SHIFT;
+    memcpy(&high, sha, 4);
+    high = ntohl(high);
+    return bloom + BLOOM2_HEADERLEN
+        + ((block_bits ? (uint64_t)high >> (32 - block_bits) : 0)
+           << BLOOM3_BLOCK_SHIFT);
+}
+
+static unsigned int bloom3_pos(const unsigned char *sha, const int i)
+{
+    // 9 bits at bit offset 64 + 9 * i (so never past byte 17)
+    const int ofs = 64 + 9 * i;
+    const unsigned char *p = sha + (ofs >> 3);
+    const unsigned int v = (p[0] << 16) | (p[1] << 8) | p[2];
+    return (v >> (15 - (ofs & 7))) & 0x1ff;
+}
+
+static int bloom3_args_ok(Py_ssize_t len, int nbits, int k)
+{
+    return nbits >= BLOOM3_BLOCK_SHIFT && nbits <= BLOOM3_MAX_BITS
+        && k >= 1 && k <= BLOOM3_MAX_K
+        && len >= BLOOM2_HEADERLEN + ((Py_ssize_t)1 << nbits);
+}
+
+static PyObject *bloom3_add(PyObject *self, PyObject *args)
+{
+    Py_buffer bloom, sha;
+    int nbits = 0, k = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf wbuf_argf "ii",
+                          &bloom, &sha, &nbits, &k))
+        return NULL;
+
+    PyObject *result = NULL;
+
+    if (!bloom3_args_ok(bloom.len, nbits, k) || sha.len % 20 != 0)
+        goto clean_and_return;
+
+    const unsigned char *cur = sha.buf;
+    const unsigned char *end = cur + sha.len;
+    for (; cur < end; cur += 20)
+    {
+        unsigned char *block = bloom3_block(bloom.buf, cur, nbits);
+        int i;
+        for (i = 0; i < k; i++)
+        {
+            const unsigned int pos = bloom3_pos(cur, i);
+            block[pos >> 3] |= 1 << (pos & 7);
+        }
+    }
+    result = Py_BuildValue("n", sha.len / 20);
+
+ clean_and_return:
+    PyBuffer_Release(&bloom);
+    PyBuffer_Release(&sha);
+    return result;
+}
+
+static PyObject *bloom3_contains(PyObject *self, PyObject *args)
+{
+    Py_buffer bloom;
+    unsigned char *sha = NULL;
+    Py_ssize_t len = 0;
+    int nbits = 0, k = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf rbuf_argf "ii",
+                          &bloom, &sha, &len, &nbits, &k))
+        return NULL;
+
+    PyObject *result = NULL;
+
+    if (len != 20 || !bloom3_args_ok(bloom.len, nbits, k))
+        goto clean_and_return;
+
+    const unsigned char *block = bloom3_block(bloom.buf, sha, nbits);
+    int i;
+    for (i = 0; i < k; i++)
+    {
+        const unsigned int pos = bloom3_pos(sha, i);
+        if (!(block[pos >> 3] & (1 << (pos & 7))))
+        {
+            result = Py_BuildValue("Oi", Py_None, i + 1);
+            goto clean_and_return;
+        }
+    }
+    result = Py_BuildValue("ii", 1, k);
+
+ clean_and_return:
+    PyBuffer_Release(&bloom);
+    return result;
+}
+
+
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
     uint32_t v, mask;
@@ -931,6 +1054,334 @@ static uint32_t _get_idx_i(struct idx *idx)
     return ntohl(*idx->cur_name) + idx->name_base;
 }
 
+static PyObject *find_shas(PyObject *self, PyObject *args)
+{
+    Py_buffer table, queries, found;
+    Py_ssize_t ofs = 0, count = 0, stride = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf "nnn" wbuf_argf "w*",
+                          &table, &ofs, &count, &stride, &queries, &found))
+	return NULL;
+
+    PyObject *result = NULL;
+    Py_ssize_t nq = queries.len / 20;
+
+    if (stride < 20 || ofs < 0 || count < 0
+        || queries.len % 20 != 0 || found.len < nq
+        || (count && (ofs > table.len - 20
+                      || (table.len - ofs - 20) / stride < count - 1)))
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid sha table or batch");
+        goto clean_and_return;
+    }
+
+    const unsigned char *tab = (unsigned char *) table.buf + ofs;
+    const unsigned char *q = queries.buf;
+    unsigned char *f = found.buf;
+    Py_ssize_t i, lo = 0, hits = 0;
+    // The batch is sorted, so each search can start where the last
+    // one stopped, making this a single merged pass over the table.
+    for (i = 0; i < nq && lo < count; i++, q += 20)
+    {
+        Py_ssize_t hi = count;
+        if (f[i])
+            continue;
+        while (lo < hi)
+        {
+            Py_ssize_t mid = lo + (hi - lo) / 2;
+            if (memcmp(tab + mid * stride, q, 20) < 0)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+        if (lo < count && memcmp(tab + lo * stride, q, 20) == 0)
+        {
+            f[i] = 1;
+            hits++;
+        }
+    }
+    result = PyLong_FromSsize_t(hits);
+
+ clean_and_return:
+    PyBuffer_Release(&table);
+    PyBuffer_Release(&queries);
+    PyBuffer_Release(&found);
+    return result;
+}
+
+
+// Return a list of (basename, record_ofs) for up to n consecutive
+// bupindex entries (each a NUL terminated basename followed by a
+// record_len byte record) starting at ofs, stopping before any entry
+// whose record would extend past end.
+static PyObject *bup_index_names(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    Py_ssize_t ofs = 0, n = 0, record_len = 0, end = 0;
+    if (!PyArg_ParseTuple(args, wbuf_argf "nnnn",
+                          &buf, &ofs, &n, &record_len, &end))
+	return NULL;
+
+    PyObject *result = NULL;
+    if (ofs < 0 || n < 0 || record_len < 0 || end < 0 || end > buf.len)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid index entry range");
+        goto clean_and_return;
+    }
+    result = PyList_New(0);
+    if (!result)
+        goto clean_and_return;
+
+    const char *m = buf.buf;
+    Py_ssize_t i;
+    for (i = 0; i < n && ofs <= end - record_len; i++)
+    {
+        const char *eon = memchr(m + ofs, 0, buf.len - ofs);
+        if (!eon || eon == m + ofs)
+        {
+            PyErr_Format(PyExc_ValueError,
+                         "invalid index entry name at offset %zd", ofs);
+            Py_CLEAR(result);
+            goto clean_and_return;
+        }
+        Py_ssize_t record_ofs = eon - m + 1;
+        PyObject *item = Py_BuildValue("Nn",
+                                       PyBytes_FromStringAndSize(m + ofs,
+                                                                 eon - m - ofs),
+                                       record_ofs);
+        if (!item || PyList_Append(result, item) != 0)
+        {
+            Py_XDECREF(item);
+            Py_CLEAR(result);
+            goto clean_and_return;
+        }
+        Py_DECREF(item);
+        ofs = record_ofs + record_len;
+    }
+
+ clean_and_return:
+    PyBuffer_Release(&buf);
+    return result;
+}
+
+
+static uint64_t be64_at(const unsigned char *p)
+{
+    uint64_t x = 0;
+    int i;
+    for (i = 0; i < 8; i++)
+        x = (x << 8) | p[i];
+    return x;
+}
+
+static uint32_t be32_at(const unsigned char *p)
+{
+    return ((uint32_t) p[0] << 24) | ((uint32_t) p[1] << 16)
+        | ((uint32_t) p[2] << 8) | p[3];
+}
+
+struct ofs_entry {
+    uint64_t ofs;
+    uint32_t idx;
+};
+
+static int ofs_entry_cmp(const void *a, const void *b)
+{
+    const uint64_t x = ((const struct ofs_entry *) a)->ofs;
+    const uint64_t y = ((const struct ofs_entry *) b)->ofs;
+    return (x > y) - (x < y);
+}
+
+// Return (offsets, idxs) for the n entries of the big-endian pack
+// offset table at table_ofs (one every stride bytes), sorted by
+// offset, as native uint64_t and uint32_t vectors.  When large_ofs is
+// not negative, entries with the high bit set refer to the 64-bit
+// offsets there, as in a v2 idx.
+static PyObject *pack_order(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    Py_ssize_t n = 0, table_ofs = 0, stride = 0, large_ofs = -1;
+    if (!PyArg_ParseTuple(args, wbuf_argf "nnnn",
+                          &buf, &n, &table_ofs, &stride, &large_ofs))
+	return NULL;
+
+    PyObject *result = NULL;
+    struct ofs_entry *entries = NULL;
+    PyObject *py_offsets = NULL, *py_idxs = NULL;
+    if (n < 0 || n > UINT32_MAX || stride < 4 || table_ofs < 0
+        || large_ofs > buf.len
+        || (n && (table_ofs > buf.len - 4
+                  || (buf.len - table_ofs - 4) / stride < n - 1)))
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid pack offset table");
+        goto clean_and_return;
+    }
+    if (!(entries = checked_malloc(n ? n : 1, sizeof(struct ofs_entry))))
+        goto clean_and_return;
+
+    const unsigned char *m = buf.buf;
+    Py_ssize_t i;
+    for (i = 0; i < n; i++)
+    {
+        uint64_t ofs = be32_at(m + table_ofs + i * stride);
+        if (large_ofs >= 0 && (ofs & 0x80000000))
+        {
+            const uint64_t large_i = ofs & 0x7fffffff;
+            if (large_i >= (uint64_t) (buf.len - large_ofs) / 8)
+            {
+                PyErr_Format(PyExc_ValueError,
+                             "invalid large pack offset index %llu",
+                             (unsigned long long) large_i);
+                goto clean_and_return;
+            }
+            ofs = be64_at(m + large_ofs + large_i * 8);
+        }
+        entries[i].ofs = ofs;
+        entries[i].idx = (uint32_t) i;
+    }
+    qsort(entries, n, sizeof(struct ofs_entry), ofs_entry_cmp);
+
+    py_offsets = PyBytes_FromStringAndSize(NULL, n * sizeof(uint64_t));
+    py_idxs = PyBytes_FromStringAndSize(NULL, n * sizeof(uint32_t));
+    if (!py_offsets || !py_idxs)
+        goto clean_and_return;
+    uint64_t *offsets = (uint64_t *) PyBytes_AS_STRING(py_offsets);
+    uint32_t *idxs = (uint32_t *) PyBytes_AS_STRING(py_idxs);
+    for (i = 0; i < n; i++)
+    {
+        offsets[i] = entries[i].ofs;
+        idxs[i] = entries[i].idx;
+    }
+    result = Py_BuildValue("OO", py_offsets, py_idxs);
+
+ clean_and_return:
+    Py_XDECREF(py_offsets);
+    Py_XDECREF(py_idxs);
+    free(entries);
+    PyBuffer_Release(&buf);
+    return result;
+}
+
+// Return the smallest python integer type for x, like struct.unpack().
+static PyObject *py_from_u64(uint64_t x)
+{
+#if PY_MAJOR_VERSION < 3
+    if (x <= LONG_MAX)
+        return PyInt_FromLong((long) x);
+#endif
+    return PyLong_FromUnsignedLongLong(x);
+}
+
+// Return secs * 10**9 + ns.
+static PyObject *nsecs_from_timespec(int64_t secs, uint64_t ns)
+{
+    if (secs > -9000000000LL && secs < 9000000000LL && ns < 1000000000ULL)
+    {
+        const long long x = secs * 1000000000LL + (long long) ns;
+#if PY_MAJOR_VERSION < 3
+        if (x >= LONG_MIN && x <= LONG_MAX)
+            return PyInt_FromLong((long) x);
+#endif
+        return PyLong_FromLongLong(x);
+    }
+    PyObject *result = NULL;
+    PyObject *py_secs = PyLong_FromLongLong(secs);
+    PyObject *py_ns = PyLong_FromUnsignedLongLong(ns);
+    PyObject *billion = PyLong_FromLong(1000000000L);
+    if (py_secs && py_ns && billion)
+    {
+        PyObject *tmp = PyNumber_Multiply(py_secs, billion);
+        if (tmp)
+        {
+            result = PyNumber_Add(tmp, py_ns);
+            Py_DECREF(tmp);
+        }
+    }
+    Py_XDECREF(py_secs);
+    Py_XDECREF(py_ns);
+    Py_XDECREF(billion);
+    return result;
+}
+
+#define INDEX_ENTRY_LEN 130
+#define INDEX_ENTRY_FIELDS 14
+static const char * const index_field_names[INDEX_ENTRY_FIELDS] = {
+    "dev", "ino", "nlink", "ctime", "mtime", "atime", "size", "mode",
+    "gitmode", "sha", "flags", "children_ofs", "children_n", "meta_ofs"
+};
+static PyObject *index_field_keys[INDEX_ENTRY_FIELDS];
+
+// Add the fields of the bupindex record (cf. INDEX_SIG in index.py)
+// at ofs, with the times converted to nanoseconds, to the dict, except
+// for any that are already present.
+static PyObject *bup_index_entry_fields(PyObject *self, PyObject *args)
+{
+    Py_buffer buf;
+    Py_ssize_t ofs = 0;
+    PyObject *dict = NULL;
+    if (!PyArg_ParseTuple(args, wbuf_argf "nO!", &buf, &ofs,
+                          &PyDict_Type, &dict))
+	return NULL;
+
+    PyObject *result = NULL;
+    PyObject *vals[INDEX_ENTRY_FIELDS] = { NULL };
+    int i;
+    if (ofs < 0 || ofs > buf.len - INDEX_ENTRY_LEN)
+    {
+        PyErr_SetString(PyExc_ValueError, "invalid index entry offset");
+        goto clean_and_return;
+    }
+    for (i = 0; i < INDEX_ENTRY_FIELDS; i++)
+    {
+        if (index_field_keys[i])
+            continue;
+#if PY_MAJOR_VERSION < 3
+        index_field_keys[i] = PyString_InternFromString(index_field_names[i]);
+#else
+        index_field_keys[i] = PyUnicode_InternFromString(index_field_names[i]);
+#endif
+        if (!index_field_keys[i])
+            goto clean_and_return;
+    }
+
+    const unsigned char *p = (unsigned char *) buf.buf + ofs;
+    vals[0] = py_from_u64(be64_at(p));  // dev
+    vals[1] = py_from_u64(be64_at(p + 8));  // ino
+    vals[2] = py_from_u64(be64_at(p + 16));  // nlink
+    vals[3] = nsecs_from_timespec(be64_at(p + 24), be64_at(p + 32));  // ctime
+    vals[4] = nsecs_from_timespec(be64_at(p + 40), be64_at(p + 48));  // mtime
+    vals[5] = nsecs_from_timespec(be64_at(p + 56), be64_at(p + 64));  // atime
+    vals[6] = py_from_u64(be64_at(p + 72));  // size
+    vals[7] = py_from_u64(be32_at(p + 80));  // mode
+    vals[8] = py_from_u64(be32_at(p + 84));  // gitmode
+    vals[9] = PyBytes_FromStringAndSize((char *) p + 88, 20);  // sha
+    vals[10] = py_from_u64(((uint32_t) p[108] << 8) | p[109]);  // flags
+    vals[11] = py_from_u64(be64_at(p + 110));  // children_ofs
+    vals[12] = py_from_u64(be32_at(p + 118));  // children_n
+    vals[13] = py_from_u64(be64_at(p + 122));  // meta_ofs
+    for (i = 0; i < INDEX_ENTRY_FIELDS; i++)
+        if (!vals[i])
+            goto clean_and_return;
+
+    for (i = 0; i < INDEX_ENTRY_FIELDS; i++)
+    {
+        const int present = PyDict_Contains(dict, index_field_keys[i]);
+        if (present < 0)
+            goto clean_and_return;
+        if (!present
+            && PyDict_SetItem(dict, index_field_keys[i], vals[i]) != 0)
+            goto clean_and_return;
+    }
+    result = Py_None;
+    Py_INCREF(result);
+
+ clean_and_return:
+    for (i = 0; i < INDEX_ENTRY_FIELDS; i++)
+        Py_XDECREF(vals[i]);
+    PyBuffer_Release(&buf);
+    return result;
+}
+
+
 #define MIDX4_HEADERLEN 12
 
 static PyObject *merge_into(PyObject *self, PyObject *args)
@@ -1618,6 +2069,252 @@ static PyObject *bup_fstat(PyObject *self, PyObject *args)
 }
 
 
+#ifdef BUP_HAVE_DIRFD_OPS
+
+static PyObject *bup_open_dir_at(PyObject *self, PyObject *args)
+{
+    int dirfd, fd;
+    char *name;
+
+    if (!PyArg_ParseTuple(args, "i" cstr_argf, &dirfd, &name))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    fd = openat(dirfd, name,
+                O_RDONLY | O_NOFOLLOW | O_NDELAY | O_DIRECTORY | O_LARGEFILE);
+    Py_END_ALLOW_THREADS
+    if (fd < 0)
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, name);
+    return Py_BuildValue("i", fd);
+}
+
+
+struct bup_dirent
+{
+    char *name;
+    int err;
+    struct stat st;
+};
+
+static void free_dirents(struct bup_dirent *ents, size_t n)
+{
+    size_t i;
+    for (i = 0; i < n; i++)
+        free(ents[i].name);
+    free(ents);
+}
+
+// Read all of the entries (other than . and ..) in the directory
+// open as fd, and fstatat() each of them, with the GIL released.
+// On success, set *result and *result_n and return 0, else return
+// the errno.
+static int read_dirents(int fd, struct bup_dirent **result, size_t *result_n)
+{
+    struct bup_dirent *ents = NULL;
+    size_t n = 0, max_n = 0;
+    int err = 0;
+    DIR *dir;
+    int dir_fd = dup(fd);
+
+    if (dir_fd < 0)
+        return errno;
+    dir = fdopendir(dir_fd);
+    if (!dir)
+    {
+        err = errno;
+        close(dir_fd);
+        return err;
+    }
+    rewinddir(dir);
+    while (1)
+    {
+        struct dirent *d;
+        errno = 0;
+        d = readdir(dir);
+        if (!d)
+        {
+            err = errno;
+            break;
+        }
+        if (strcmp(d->d_name, ".") == 0 || strcmp(d->d_name, "..") == 0)
+            continue;
+        if (n == max_n)
+        {
+            size_t new_max = max_n ? max_n * 2 : 64;
+            struct bup_dirent *tmp = realloc(ents, new_max * sizeof(*ents));
+            if (!tmp)
+            {
+                err = ENOMEM;
+                break;
+            }
+            ents = tmp;
+            max_n = new_max;
+        }
+        ents[n].name = strdup(d->d_name);
+        if (!ents[n].name)
+        {
+            err = ENOMEM;
+            break;
+        }
+        if (fstatat(fd, d->d_name, &ents[n].st, AT_SYMLINK_NOFOLLOW) == 0)
+            ents[n].err = 0;
+        else
+            ents[n].err = errno;
+        n++;
+    }
+    closedir(dir);
+    if (err)
+    {
+        free_dirents(ents, n);
+        return err;
+    }
+    *result = ents;
+    *result_n = n;
+    return 0;
+}
+
+static PyObject *bup_lstat_dir_at(PyObject *self, PyObject *args)
+{
+    int fd, err;
+    struct bup_dirent *ents = NULL;
+    size_t n = 0, i;
+
+    if (!PyArg_ParseTuple(args, "i", &fd))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    err = read_dirents(fd, &ents, &n);
+    Py_END_ALLOW_THREADS
+    if (err)
+    {
+        errno = err;
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    PyObject *result = PyList_New(n);
+    if (!result)
+        goto fail;
+    for (i = 0; i < n; i++)
+    {
+        PyObject *st;
+        if (ents[i].err)
+            st = Py_BuildValue("i", ents[i].err);
+        else
+            st = stat_struct_to_py(&ents[i].st, ents[i].name, 0);
+        if (!st)
+            goto fail;
+        PyObject *item = Py_BuildValue("NN",
+                                       PyBytes_FromString(ents[i].name), st);
+        if (!item)
+            goto fail;
+        PyList_SET_ITEM(result, i, item);
+    }
+    free_dirents(ents, n);
+    return result;
+
+ fail:
+    Py_XDECREF(result);
+    free_dirents(ents, n);
+    return NULL;
+}
+
+#endif /* def BUP_HAVE_DIRFD_OPS */
+
+
+#ifdef BUP_HAVE_INOTIFY
+
+static PyObject *bup_inotify_init(PyObject *self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ""))
+        return NULL;
+    int fd = inotify_init1(IN_CLOEXEC);
+    if (fd < 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    return Py_BuildValue("i", fd);
+}
+
+static PyObject *bup_inotify_add_watch(PyObject *self, PyObject *args)
+{
+    int fd, wd;
+    char *path;
+    unsigned int mask;
+
+    if (!PyArg_ParseTuple(args, "i" cstr_argf "I", &fd, &path, &mask))
+        return NULL;
+    wd = inotify_add_watch(fd, path, mask);
+    if (wd < 0)
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    return Py_BuildValue("i", wd);
+}
+
+static PyObject *bup_inotify_rm_watch(PyObject *self, PyObject *args)
+{
+    int fd, wd;
+
+    if (!PyArg_ParseTuple(args, "ii", &fd, &wd))
+        return NULL;
+    if (inotify_rm_watch(fd, wd) != 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    Py_RETURN_NONE;
+}
+
+// Large enough for at least one event with the longest possible name.
+#define INOTIFY_BUF_LEN (64 * 1024)
+
+static PyObject *bup_inotify_read(PyObject *self, PyObject *args)
+{
+    int fd;
+    ssize_t len;
+    char *buf, *p;
+
+    if (!PyArg_ParseTuple(args, "i", &fd))
+        return NULL;
+    buf = malloc(INOTIFY_BUF_LEN);
+    if (!buf)
+        return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS
+    len = read(fd, buf, INOTIFY_BUF_LEN);
+    Py_END_ALLOW_THREADS
+    if (len < 0)
+    {
+        free(buf);
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    PyObject *result = PyList_New(0);
+    if (!result)
+        goto clean_and_return;
+    for (p = buf; p < buf + len; )
+    {
+        struct inotify_event ev;
+        memcpy(&ev, p, sizeof(ev));
+        // The name is padded with NULs (if there is one).
+        PyObject *item = Py_BuildValue("iII" rbuf_argf,
+                                       ev.wd, ev.mask, ev.cookie,
+                                       p + sizeof(ev),
+                                       (Py_ssize_t) (ev.len
+                                                     ? strlen(p + sizeof(ev))
+                                                     : 0));
+        if (!item || PyList_Append(result, item) != 0)
+        {
+            Py_XDECREF(item);
+            Py_DECREF(result);
+            result = NULL;
+            goto clean_and_return;
+        }
+        Py_DECREF(item);
+        p += sizeof(ev) + ev.len;
+    }
+
+ clean_and_return:
+    free(buf);
+    return result;
+}
+
+#endif /* def BUP_HAVE_INOTIFY */
+
+
 #ifdef HAVE_TM_TM_GMTOFF
 static PyObject *bup_localtime(PyObject *self, PyObject *args)
 {
@@ -1721,8 +2418,20 @@ static PyMethodDef helper_methods[] = {
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "bloom3_contains", bloom3_contains, METH_VARARGS,
+	"Check if a blocked (v3) bloom filter of 2^nbits bytes contains an object" },
+    { "bloom3_add", bloom3_add, METH_VARARGS,
+	"Add objects to a blocked (v3) bloom filter of 2^nbits bytes" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
+    { "index_names", bup_index_names, METH_VARARGS,
+      "Return (basename, record_ofs) for a run of bupindex entries." },
+    { "index_entry_fields", bup_index_entry_fields, METH_VARARGS,
+      "Add any missing fields of the bupindex record at an offset to a dict." },
+    { "find_shas", find_shas, METH_VARARGS,
+	"Mark the shas in a sorted batch that are present in a sorted sha table." },
+    { "pack_order", pack_order, METH_VARARGS,
+	"Return the pack offsets in an idx offset table, sorted, and their indexes." },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
     { "write_idx", write_idx, METH_VARARGS,
@@ -1762,6 +2471,28 @@ static PyMethodDef helper_methods[] = {
       "Extended version of lstat." },
     { "fstat", bup_fstat, METH_VARARGS,
       "Extended version of fstat." },
+#ifdef BUP_HAVE_DIRFD_OPS
+    { "open_dir_at", bup_open_dir_at, METH_VARARGS,
+      "Open the directory name in (the directory open as) dirfd, without"
+      " following symlinks, and return the new fd." },
+    { "lstat_dir_at", bup_lstat_dir_at, METH_VARARGS,
+      "Return a list of (name, stat) for the entries in the directory open"
+      " as fd, without following symlinks, where stat is like the result"
+      " of lstat(), or the errno if the entry couldn't be examined." },
+#endif
+#ifdef BUP_HAVE_INOTIFY
+    { "inotify_init", bup_inotify_init, METH_VARARGS,
+      "Return a new (close on exec) inotify fd." },
+    { "inotify_add_watch", bup_inotify_add_watch, METH_VARARGS,
+      "Watch path for the events in mask via the inotify fd, and return"
+      " the watch descriptor." },
+    { "inotify_rm_watch", bup_inotify_rm_watch, METH_VARARGS,
+      "Remove the watch descriptor wd from the inotify fd." },
+    { "inotify_read", bup_inotify_read, METH_VARARGS,
+      "Read at least one event from the inotify fd, blocking if necessary,"
+      " and return a list of (wd, mask, cookie, name) for all of the events"
+      " that were available." },
+#endif
 #ifdef HAVE_TM_TM_GMTOFF
     { "localtime", bup_localtime, METH_VARARGS,
       "Return struct_time elements plus the timezone offset and name." },
@@ -1867,6 +2598,35 @@ static int setup_module(PyObject *m)
         Py_DECREF(value);
     }
 #endif
+#ifdef BUP_HAVE_INOTIFY
+    {
+        static const struct { const char *name; unsigned int value; }
+        masks[] = {
+            { "IN_MODIFY", IN_MODIFY },
+            { "IN_ATTRIB", IN_ATTRIB },
+            { "IN_CLOSE_WRITE", IN_CLOSE_WRITE },
+            { "IN_MOVED_FROM", IN_MOVED_FROM },
+            { "IN_MOVED_TO", IN_MOVED_TO },
+            { "IN_CREATE", IN_CREATE },
+            { "IN_DELETE", IN_DELETE },
+            { "IN_DELETE_SELF", IN_DELETE_SELF },
+            { "IN_MOVE_SELF", IN_MOVE_SELF },
+            { "IN_UNMOUNT", IN_UNMOUNT },
+            { "IN_Q_OVERFLOW", IN_Q_OVERFLOW },
+            { "IN_IGNORED", IN_IGNORED },
+            { "IN_ONLYDIR", IN_ONLYDIR },
+            { "IN_DONT_FOLLOW", IN_DONT_FOLLOW },
+            { "IN_ISDIR", IN_ISDIR },
+        };
+        size_t i;
+        for (i = 0; i < sizeof(masks) / sizeof(masks[0]); i++)
+        {
+            PyObject *value = INTEGER_TO_PY(masks[i].value);
+            PyObject_SetAttrString(m, masks[i].name, value);
+            Py_DECREF(value);
+        }
+    }
+#endif
 #pragma clang diagnostic pop  // ignored "-Wtautological-compare"
 
     e = getenv("BUP_FORCE_TTY");
@@ -78,6 +78,25 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Version 3 filters are "blocked": the table is divided into 64 byte
+blocks (cache lines), the leading bits of the SHA pick a block, and
+all k bits for the object are set (and checked) within that block, so
+a lookup costs at most one cache miss (or page fault), no matter how
+big the filter is, instead of k of them.  For the same size and k, a
+blocked filter has a higher false positive rate, since some blocks are
+more crowded than others, but since the k bits are nearly free, it
+uses more of them (k=8).  That gives a lower rate than version 2
+(k=5) with more than about 11 bits per entry (e.g. 0.09% vs 0.14% at
+16), but a higher one with fewer (e.g. 1.17% vs 1.06% at 9.7), so a
+version 3 filter reaches MAX_PFALSE_POSITIVE, and is regenerated,
+slightly sooner.  The block is addressed by at most
+32 bits of the SHA and the positions by the 72 bits after the first
+64, so up to 2^38 byte (256 GiB) filters are possible.
+
+Version 2 filters (as described above) are still read, and updated
+in place, but whenever a filter has to be regenerated (e.g. via
+`bup bloom -f`), it's written as version 3.
 """
 
 from __future__ import absolute_import
@@ -88,9 +107,13 @@ from bup.helpers import (debug1, debug2, log, mmap_read, mmap_readwrite,
                          mmap_readwrite_private, unlink)
 
 
-BLOOM_VERSION = 2
+BLOOM_VERSION = 3
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
-MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
+MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8) (version 2)
+BLOOM3_BLOCK_SHIFT = 6 # 64 byte blocks
+BLOOM3_MIN_BITS = BLOOM3_BLOCK_SHIFT # one block
+BLOOM3_MAX_BITS = 38
+BLOOM3_K = 8
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
 
 _total_searches = 0
@@ -98,6 +121,8 @@ _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
 bloom_add = _helpers.bloom_add
+bloom3_contains = _helpers.bloom3_contains
+bloom3_add = _helpers.bloom3_add
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
 # The ownership semantics should be clarified since the caller needs
@@ -105,12 +130,16 @@ bloom_add = _helpers.bloom_add
 
 class ShaBloom:
     """Wrapper which contains data from multiple index files. """
-    def __init__(self, filename, f=None, readwrite=False, expected=-1):
+    def __init__(self, filename, f=None, readwrite=False, expected=-1,
+                 map=None):
         self.name = filename
         self.rwfile = None
         self.map = None
-        assert(filename.endswith(b'.bloom'))
-        if readwrite:
+        if map is not None:
+            # An ephemeral filter (cf. create_ephemeral()).
+            self.map = map
+        elif readwrite:
+            assert(filename.endswith(b'.bloom'))
             assert(expected > 0)
             self.rwfile = f = f or open(filename, 'r+b')
             f.seek(0)
@@ -139,6 +168,7 @@ class ShaBloom:
             else:
                 self.map = mmap_readwrite(self.rwfile, close=False)
         else:
+            assert(filename.endswith(b'.bloom'))
             self.rwfile = None
             f = f or open(filename, 'rb')
             self.map = mmap_read(f)
@@ -147,7 +177,7 @@ class ShaBloom:
             log('Warning: invalid BLOM header (%r) in %r\n' % (got, filename))
             return self._init_failed()
         ver = struct.unpack('!I', self.map[4:8])[0]
-        if ver < BLOOM_VERSION:
+        if ver < 2:
             log('Warning: ignoring old-style (v%d) bloom %r\n' 
                 % (ver, filename))
             return self._init_failed()
@@ -155,6 +185,11 @@ class ShaBloom:
             log('Warning: ignoring too-new (v%d) bloom %r\n'
                 % (ver, filename))
             return self._init_failed()
+        self.version = ver
+        if ver == 2:
+            self._contains, self._add = bloom_contains, bloom_add
+        else:
+            self._contains, self._add = bloom3_contains, bloom3_add
 
         self.bits, self.k, self.entries = struct.unpack('!HHI', self.map[8:16])
         idxnamestr = self.map[16 + 2**self.bits:]
@@ -171,6 +206,7 @@ class ShaBloom:
             self.rwfile = None
         self.idxnames = []
         self.bits = self.entries = 0
+        self.version = None
 
     def valid(self):
         return self.map and self.bits
@@ -193,16 +229,31 @@ class ShaBloom:
         self._init_failed()
 
     def pfalse_positive(self, additional=0):
+        """Return the expected false positive rate (as a percentage)
+        with `additional` more entries."""
         n = self.entries + additional
         m = 8*2**self.bits
         k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        if self.version == 2:
+            return 100*(1-math.exp(-k*float(n)/m))**k
+        # The number of entries in any given block is (nearly) Poisson
+        # distributed, and the more crowded blocks dominate the rate.
+        block_bits = 8 << BLOOM3_BLOCK_SHIFT
+        lam = float(n) / (m // block_bits)
+        if not lam:
+            return 0.
+        spread = 10 * math.sqrt(lam) + 10
+        p = 0.
+        for j in range(max(0, int(lam - spread)), int(lam + spread) + 1):
+            pj = math.exp(j * math.log(lam) - lam - math.lgamma(j + 1))
+            p += pj * (1 - (1 - 1. / block_bits)**(k * j))**k
+        return 100*p
 
     def add(self, ids):
         """Add the hashes in ids (packed binary 20-bytes) to the filter."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ids, self.bits, self.k)
+        self.entries += self._add(self.map, ids, self.bits, self.k)
 
     def add_idx(self, ix):
         """Add the object to the filter."""
@@ -220,25 +271,46 @@ class ShaBloom:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, sha, self.bits, self.k)
+        found, steps = self._contains(self.map, sha, self.bits, self.k)
         _total_steps += steps
         return found
 
+    def max_bits(self):
+        """Return the size (in bits) of the biggest possible filter
+        with the same version and k."""
+        if self.version == 2:
+            return MAX_BLOOM_BITS[self.k]
+        return BLOOM3_MAX_BITS
+
     def __len__(self):
         return int(self.entries)
 
 
-def create(name, expected, delaywrite=None, f=None, k=None):
-    """Create and return a bloom filter for `expected` entries."""
+def _shape(expected, k=None, version=BLOOM_VERSION):
+    """Return the (bits, k) for a filter with `expected` entries."""
     bits = int(math.floor(math.log(expected * MAX_BITS_EACH // 8, 2)))
-    k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
-    if bits > MAX_BLOOM_BITS[k]:
+    if version == 2:
+        k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
+        max_bits = MAX_BLOOM_BITS[k]
+    else:
+        assert(version == 3)
+        k = k or BLOOM3_K
+        max_bits = BLOOM3_MAX_BITS
+        bits = max(bits, BLOOM3_MIN_BITS)
+    if bits > max_bits:
         log('bloom: warning, max bits exceeded, non-optimal\n')
-        bits = MAX_BLOOM_BITS[k]
+        bits = max_bits
     debug1('bloom: using 2^%d bytes and %d hash functions\n' % (bits, k))
+    return bits, k
+
+
+def create(name, expected, delaywrite=None, f=None, k=None,
+           version=BLOOM_VERSION):
+    """Create and return a bloom filter for `expected` entries."""
+    bits, k = _shape(expected, k, version)
     f = f or open(name, 'w+b')
     f.write(b'BLOM')
-    f.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
+    f.write(struct.pack('!IHHI', version, bits, k, 0))
     assert(f.tell() == 16)
     # NOTE: On some systems this will not extend+zerofill, but it does on
     # darwin, linux, bsd and solaris.
@@ -250,5 +322,15 @@ def create(name, expected, delaywrite=None, f=None, k=None):
     return ShaBloom(name, f=f, readwrite=True, expected=expected)
 
 
+def create_ephemeral(expected, k=None, version=BLOOM_VERSION):
+    """Create and return a bloom filter for `expected` entries that only
+    exists in memory (an anonymous, shared mmap), and so disappears
+    when it's closed (or the process exits)."""
+    bits, k = _shape(expected, k, version)
+    m = mmap.mmap(-1, 16 + 2**bits)
+    m[0:16] = b'BLOM' + struct.pack('!IHHI', version, bits, k, 0)
+    return ShaBloom(None, map=m)
+
+
 def clear_bloom(dir):
     unlink(os.path.join(dir, b'bup.bloom'))
@@ -3,11 +3,12 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 from binascii import hexlify, unhexlify
+from itertools import islice
 import errno, os, re, struct, sys, time, zlib
 import socket
 
 from bup import git, ssh, vfs
-from bup.compat import environ, range, reraise
+from bup.compat import byte_int, environ, range, reraise
 from bup.helpers import (Conn, atomically_replaced_file, chunkyreader, debug1,
                          debug2, linereader, lines_until_sentinel,
                          mkdirp, progress, qprogress, DemuxConn, atoi)
@@ -17,6 +18,27 @@ from bup.vint import read_bvec, read_vuint, write_bvec
 
 bwlimit = None
 
+# The maximum number of refs cat_stream() will have in flight.  Keep
+# this small enough that the refs always fit in the pipe to the
+# server, so that sending one can never block.
+cat_stream_window = 64
+
+# When the server supports have-objects, PackWriter_Remote holds back
+# objects it doesn't know about until it has this many (or this much
+# data), and then asks the server which of them it already has.
+have_objects_batch = 1024
+have_objects_batch_bytes = 8 * 1024 * 1024
+
+# Whether to use have-objects (when available) instead of downloading
+# the idx files the server suggests during receive-objects-v2.
+use_have_objects = True
+
+# The have-objects answers are kept in the index-cache as idx files
+# with this prefix, valid as long as the server still has all of the
+# packs listed in have_packs_name.
+have_idx_prefix = b'have-'
+have_packs_name = b'have-packs'
+
 
 class ClientError(Exception):
     pass
@@ -71,6 +93,7 @@ class Client:
     def __init__(self, remote, create=False):
         self._busy = self.conn = None
         self.sock = self.p = self.pout = self.pin = None
+        self._use_have_objects = False
         is_reverse = environ.get(b'BUP_SERVER_REVERSE')
         if is_reverse:
             assert(not remote)
@@ -200,33 +223,46 @@ class Client:
             raise ClientError('server does not appear to provide %s command'
                               % name.encode('ascii'))
 
-    def sync_indexes(self):
+    def _list_indexes(self):
+        """Return a list of (idx, load) for each of the server's idx
+        files, where load is true if the server wants us to have it."""
         self._require_command(b'list-indexes')
         self.check_busy()
-        conn = self.conn
+        result = []
+        self.conn.write(b'list-indexes\n')
+        for line in linereader(self.conn):
+            if not line:
+                break
+            assert(line.find(b'/') < 0)
+            parts = line.split(b' ')
+            result.append((parts[0], len(parts) == 2 and parts[1] == b'load'))
+        self.check_ok()
+        return result
+
+    def sync_indexes(self):
         mkdirp(self.cachedir)
         # All cached idxs are extra until proven otherwise
         extra = set()
         for f in os.listdir(self.cachedir):
             debug1(path_msg(f) + '\n')
-            if f.endswith(b'.idx'):
+            if f.endswith(b'.idx') and not f.startswith(have_idx_prefix):
                 extra.add(f)
         needed = set()
-        conn.write(b'list-indexes\n')
-        for line in linereader(conn):
-            if not line:
-                break
-            assert(line.find(b'/') < 0)
-            parts = line.split(b' ')
-            idx = parts[0]
-            if len(parts) == 2 and parts[1] == b'load' and idx not in extra:
+        listed = self._list_indexes()
+        for idx, load in listed:
+            if load and idx not in extra:
                 # If the server requests that we load an idx and we don't
                 # already have a copy of it, it is needed
                 needed.add(idx)
             # Any idx that the server has heard of is proven not extra
             extra.discard(idx)
 
-        self.check_ok()
+        self._drop_stale_have_idxes(set(idx for idx, load in listed))
+        # A dumb server wants us to check everything against its
+        # indexes ourselves.
+        self._use_have_objects = (use_have_objects
+                                  and b'have-objects' in self._available_commands
+                                  and not needed)
         debug1('client: removing extra indexes: %s\n' % extra)
         for idx in extra:
             os.unlink(os.path.join(self.cachedir, idx))
@@ -258,14 +294,62 @@ class Client:
             progress('Receiving index from server: %d/%d, done.\n' % (count, n))
             self.check_ok()
 
+    def _drop_stale_have_idxes(self, listed):
+        """Remove the have idxes (cf. _remember_present()) if the server
+        no longer has all of the packs (listed) it had when they were
+        written, since the objects they record may have gone too (e.g.
+        via gc).  Otherwise return the set of recorded packs."""
+        packs_fn = os.path.join(self.cachedir, have_packs_name)
+        try:
+            with open(packs_fn, 'rb') as f:
+                packs = set(f.read().split())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        if packs <= listed:
+            return packs
+        debug1('client: server dropped packs; removing have idxes\n')
+        for f in os.listdir(self.cachedir):
+            if f.startswith(have_idx_prefix) and f.endswith(b'.idx'):
+                os.unlink(os.path.join(self.cachedir, f))
+        os.unlink(packs_fn)
+
+    def _remember_present(self, shas):
+        """Record the (binary) shas that have-objects reported present
+        in a have idx in the index-cache, so that later writers (and
+        so bup save) know about them without asking again."""
+        listed = set(idx for idx, load in self._list_indexes())
+        mkdirp(self.cachedir)
+        packs = self._drop_stale_have_idxes(listed) or set()
+        # Record every pack the answers could have come from before
+        # the idx, so that the idx never outlives one unnoticed.
+        with atomically_replaced_file(os.path.join(self.cachedir,
+                                                   have_packs_name),
+                                      'wb') as f:
+            f.write(b''.join(b'%s\n' % idx for idx in sorted(packs | listed)))
+        idx = list(list() for i in range(256))
+        for sha in shas:
+            idx[byte_int(sha[0])].append((sha, 0, 0))
+        tmp = os.path.join(self.cachedir, b'%s%d.tmp'
+                           % (have_idx_prefix, os.getpid()))
+        try:
+            name = git.write_pack_idx_v2(tmp, idx, len(shas), b'\0' * 20)
+            os.rename(tmp, os.path.join(self.cachedir, b'%s%s.idx'
+                                        % (have_idx_prefix, name)))
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        git.auto_midx(self.cachedir)
+
     def _make_objcache(self):
         return git.PackIdxList(self.cachedir)
 
-    def _suggest_packs(self):
-        ob = self._busy
-        if ob:
-            assert(ob == b'receive-objects-v2')
-            self.conn.write(b'\xff\xff\xff\xff')  # suspend receive-objects-v2
+    def _read_suggestions(self):
+        """Read the index suggestions (and the idx of any finished pack)
+        that the server sends during receive-objects-v2, and return a
+        list of (idx, completed) pairs."""
         suggested = []
         for line in linereader(self.conn):
             if not line:
@@ -275,40 +359,94 @@ class Client:
                 idx = line[6:]
                 debug1('client: received index suggestion: %s\n'
                        % git.shorten_hash(idx).decode('ascii'))
-                suggested.append(idx)
+                suggested.append((idx, False))
             else:
                 assert(line.endswith(b'.idx'))
                 debug1('client: completed writing pack, idx: %s\n'
                        % git.shorten_hash(line).decode('ascii'))
-                suggested.append(line)
+                suggested.append((line, True))
         self.check_ok()
+        return suggested
+
+    def _sync_suggested(self, suggested):
+        # With have-objects, there's no need to fetch the indexes of
+        # other packs, but keep the ones for the packs we wrote, so
+        # that (for example) bup save can tell what's already saved.
+        synced = False
+        for idx, completed in suggested:
+            if completed or not self._use_have_objects:
+                self.sync_index(idx)
+                synced = True
+        if synced:
+            git.auto_midx(self.cachedir)
+
+    def _suggest_packs(self):
+        ob = self._busy
+        if ob:
+            assert(ob == b'receive-objects-v2')
+            self.conn.write(b'\xff\xff\xff\xff')  # suspend receive-objects-v2
+        suggested = self._read_suggestions()
         if ob:
             self._busy = None
-        idx = None
-        for idx in suggested:
-            self.sync_index(idx)
-        git.auto_midx(self.cachedir)
+        self._sync_suggested(suggested)
         if ob:
             self._busy = ob
             self.conn.write(b'%s\n' % ob)
-        return idx
+        return suggested[-1][0] if suggested else None
+
+    def have_objects(self, shas):
+        """Return a list containing a true value for each of the
+        (binary) shas that the server already has, and a false value
+        for the others.  Any receive-objects-v2 in progress is
+        suspended for the duration."""
+        self._require_command(b'have-objects')
+        ob = self._busy
+        if ob:
+            assert(ob == b'receive-objects-v2')
+            self.conn.write(b'\xff\xff\xff\xff')  # suspend receive-objects-v2
+            suggested = self._read_suggestions()
+            self._busy = None
+            self._sync_suggested(suggested)
+        self._busy = b'have-objects'
+        conn = self.conn
+        conn.write(b'have-objects %d\n' % len(shas))
+        for sha in shas:
+            assert(len(sha) == 20)
+            conn.write(sha)
+        bits = bytearray(conn.read((len(shas) + 7) // 8))
+        if len(bits) != (len(shas) + 7) // 8:
+            raise ClientError('have-objects: expected %d bytes, got %d'
+                              % ((len(shas) + 7) // 8, len(bits)))
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+        if ob:
+            self._busy = ob
+            conn.write(b'%s\n' % ob)
+        return [bool(bits[i >> 3] & (1 << (i & 7))) for i in range(len(shas))]
 
     def new_packwriter(self, compression_level=1,
-                       max_pack_size=None, max_pack_objects=None):
+                       max_pack_size=None, max_pack_objects=None, jobs=1):
         self._require_command(b'receive-objects-v2')
         self.check_busy()
         def _set_busy():
             self._busy = b'receive-objects-v2'
             self.conn.write(b'receive-objects-v2\n')
+        have_objects = self._use_have_objects and self.have_objects or None
         return PackWriter_Remote(self.conn,
                                  objcache_maker = self._make_objcache,
                                  suggest_packs = self._suggest_packs,
+                                 have_objects = have_objects,
+                                 remember_present = self._remember_present,
                                  onopen = _set_busy,
                                  onclose = self._not_busy,
                                  ensure_busy = self.ensure_busy,
                                  compression_level=compression_level,
                                  max_pack_size=max_pack_size,
-                                 max_pack_objects=max_pack_objects)
+                                 max_pack_objects=max_pack_objects,
+                                 jobs=jobs)
 
     def read_ref(self, refname):
         self._require_command(b'read-ref')
@@ -380,6 +518,91 @@ class Client:
             raise not_ok
         self._not_busy()
 
+    def _read_cat_info(self):
+        info = self.conn.readline()
+        if info == b'missing\n':
+            return None, None, None
+        if not (info and info.endswith(b'\n')):
+            raise ClientError('Hit EOF while looking for object info: %r'
+                              % info)
+        oidx, oid_t, size = info.split(b' ')
+        return oidx, oid_t, int(size)
+
+    def cat_stream(self, refs, window=None):
+        """Yield (oidx, type, size, data_iterator) for each ref in refs
+        (or all Nones if the ref is missing), like cat_batch(), but
+        with up to window refs in flight, so that the server can
+        answer each one as soon as it arrives.  Refs are taken from
+        refs as needed, and each data_iterator must be finished before
+        the next item is requested.  If the generator is abandoned
+        early, the rest of the outstanding replies are discarded.
+
+        """
+        window = window or cat_stream_window
+        refs = iter(refs)
+        if b'cat-stream' not in self._available_commands:
+            # Older server; fall back to a cat-batch per window.
+            while True:
+                batch = tuple(islice(refs, window))
+                if not batch:
+                    return
+                for item in self.cat_batch(batch):
+                    yield item
+        self.check_busy()
+        self._busy = b'cat-stream'
+        conn = self.conn
+        conn.write(b'cat-stream\n')
+        def send(ref):
+            assert ref
+            assert b'\n' not in ref
+            conn.write(ref)
+            conn.write(b'\n')
+        pending = 0
+        for ref in islice(refs, window):
+            send(ref)
+            pending += 1
+        cr = None
+        try:
+            while pending:
+                oidx, oid_t, size = self._read_cat_info()
+                pending -= 1
+                # Keep the window full
+                ref = next(refs, None)
+                if ref is not None:
+                    send(ref)
+                    pending += 1
+                if not oidx:
+                    yield None, None, None, None
+                    continue
+                cr = chunkyreader(conn, size)
+                yield oidx, oid_t, size, cr
+                detritus = next(cr, None)
+                if detritus:
+                    raise ClientError('unexpected leftover data '
+                                      + repr(detritus))
+                cr = None
+        except GeneratorExit:
+            if cr:
+                for ignored in cr:
+                    pass
+            for i in range(pending):
+                oidx, oid_t, size = self._read_cat_info()
+                if oidx:
+                    for ignored in chunkyreader(conn, size):
+                        pass
+            conn.write(b'\n')
+            not_ok = self.check_ok()
+            if not_ok:
+                raise not_ok
+            self._not_busy()
+            raise
+        conn.write(b'\n')
+        # FIXME: confusing
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         patterns = patterns or tuple()
         self._require_command(b'refs')
@@ -483,20 +706,35 @@ class PackWriter_Remote(git.PackWriter):
     def __init__(self, conn, objcache_maker, suggest_packs,
                  onopen, onclose,
                  ensure_busy,
+                 have_objects=None,
+                 remember_present=None,
                  compression_level=1,
                  max_pack_size=None,
-                 max_pack_objects=None):
+                 max_pack_objects=None,
+                 jobs=1):
         git.PackWriter.__init__(self,
                                 objcache_maker=objcache_maker,
                                 compression_level=compression_level,
                                 max_pack_size=max_pack_size,
-                                max_pack_objects=max_pack_objects)
+                                max_pack_objects=max_pack_objects,
+                                jobs=jobs)
         self.file = conn
         self.filename = b'remote socket'
         self.suggest_packs = suggest_packs
         self.onopen = onopen
         self.onclose = onclose
         self.ensure_busy = ensure_busy
+        self.have_objects = have_objects
+        self.remember_present = remember_present
+        # The objects have_objects() reported present, for
+        # remember_present() once the pack is finished.
+        self._present = set()
+        # Objects waiting for have_objects() to decide whether they
+        # need to be sent: (sha, type, content) with a type of None
+        # for an already encoded blob.
+        self._pending = []
+        self._pending_shas = set()
+        self._pending_bytes = 0
         self._packopen = False
         self._bwcount = 0
         self._bwtime = time.time()
@@ -506,16 +744,84 @@ class PackWriter_Remote(git.PackWriter):
             self.onopen()
             self._packopen = True
 
+    def _queue(self, sha, type, content):
+        self._pending.append((sha, type, content))
+        self._pending_shas.add(sha)
+        self._pending_bytes += len(content)
+        if len(self._pending) >= have_objects_batch \
+           or self._pending_bytes >= have_objects_batch_bytes:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        self._pending_shas = set()
+        self._pending_bytes = 0
+        present = self.have_objects([sha for sha, type, content in pending])
+        debug2('client: server has %d of %d objects\n'
+               % (sum(present), len(pending)))
+        for (sha, type, content), have in zip(pending, present):
+            # A write may finish the pack (cf. max_pack_size), which
+            # drops the objcache.
+            self._require_objcache()
+            if have:
+                self.objcache.add(sha)
+                self._present.add(sha)
+            elif type is None:
+                self._write_encoded(sha, (content,))
+                self.objcache.add(sha)
+            else:
+                self.just_write(sha, type, content)
+
+    def exists(self, id, want_source=False):
+        """Return nonempty if an object is already known to be in the
+        repository (or is waiting to be sent).  Only what's known
+        locally is consulted."""
+        if id in self._pending_shas:
+            return True
+        return git.PackWriter.exists(self, id, want_source=want_source)
+
+    def maybe_write(self, type, content):
+        """Write an object to the pack file if not present and return its id."""
+        if not self.have_objects:
+            return git.PackWriter.maybe_write(self, type, content)
+        sha = git.calc_hash(type, content)
+        if not self.exists(sha):
+            self._queue(sha, type, content)
+        return sha
+
+    def _missing_blobs(self, shas):
+        missing = git.PackWriter._missing_blobs(self, shas)
+        if not self.have_objects:
+            return missing
+        return [m and sha not in self._pending_shas
+                for sha, m in zip(shas, missing)]
+
+    def _write_encoded_blobs(self, encoded_blobs):
+        if not self.have_objects:
+            return git.PackWriter._write_encoded_blobs(self, encoded_blobs)
+        for sha, encoded in encoded_blobs:
+            self._queue(sha, None, encoded)
+
     def _end(self, run_midx=True):
         assert(run_midx)  # We don't support this via remote yet
+        self._flush_pending()
+        result = None
         if self._packopen and self.file:
             self.file.write(b'\0\0\0\0')
             self._packopen = False
             self.onclose() # Unbusy
             self.objcache = None
-            return self.suggest_packs() # Returns last idx received
+            result = self.suggest_packs() # Returns last idx received
+        if self._present and self.remember_present:
+            present, self._present = self._present, set()
+            self.remember_present(present)
+        return result
 
     def close(self):
+        self._close_pool()
         id = self._end()
         self.file = None
         return id
@@ -1,7 +1,10 @@
 
 from __future__ import absolute_import
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import stat, os
 
+from bup import _helpers
 from bup.helpers import add_error, should_rx_exclude_path, debug1, resolve_parent
 from bup.io import path_msg
 import bup.xstat as xstat
@@ -54,11 +57,33 @@ def _dirlist():
     return l
 
 
+def _kept_dirlist(prefix, prepend, names):
+    """Return the (name, stat) list for names (a stable() result) in
+    the directory prefix, which is known to the caller as prepend."""
+    l = []
+    for n in names:
+        if n.endswith(b'/'):
+            n = n[:-1]
+        try:
+            st = xstat.lstat(prefix + n)
+        except OSError as e:
+            add_error(Exception('%s: %s' % (path_msg(prepend + n), str(e))))
+            continue
+        if (st.st_mode & _IFMT) == stat.S_IFDIR:
+            n += b'/'
+        l.append((n, st))
+    l.sort(reverse=True)
+    return l
+
+
 def _recursive_dirlist(prepend, xdev, bup_dir=None,
                        excluded_paths=None,
                        exclude_rxs=None,
-                       xdev_exceptions=frozenset()):
-    for (name,pst) in _dirlist():
+                       xdev_exceptions=frozenset(),
+                       stable=None, entries=None):
+    if entries is None:
+        entries = _dirlist()
+    for (name,pst) in entries:
         path = prepend + name
         if excluded_paths:
             if os.path.normpath(path) in excluded_paths:
@@ -75,26 +100,264 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
                and path not in xdev_exceptions:
                 debug1('Skipping contents of %r: different filesystem.\n'
                        % path_msg(path))
+                yield (path, pst)
+                continue
+            kept = stable(path, pst) if stable else None
+            if kept == []:
+                debug1('Skipping contents of %r: unchanged.\n'
+                       % path_msg(path))
             else:
                 try:
                     OsFile(name).fchdir()
                 except OSError as e:
                     add_error('%s: %s' % (prepend, e))
                 else:
+                    sub_entries = None
+                    if kept is not None:
+                        sub_entries = _kept_dirlist(b'', path, kept)
                     for i in _recursive_dirlist(prepend=prepend+name, xdev=xdev,
                                                 bup_dir=bup_dir,
                                                 excluded_paths=excluded_paths,
                                                 exclude_rxs=exclude_rxs,
-                                                xdev_exceptions=xdev_exceptions):
+                                                xdev_exceptions=xdev_exceptions,
+                                                stable=stable,
+                                                entries=sub_entries):
                         yield i
                     os.chdir(b'..')
         yield (path, pst)
 
 
+# With the necessary _helpers (i.e. openat(), fstatat(), and
+# fdopendir()), directories are traversed relative to directory fds
+# instead of via fchdir(): each subdirectory is opened relative to its
+# parent's fd, and listed (each entry lstat()ed) by a single call that
+# releases the GIL.  Given a thread pool, the subdirectories of each
+# directory are read ahead of the caller in parallel.  Either way, the
+# entries are produced in exactly the same (reverse sorted, depth
+# first) order as by _recursive_dirlist().
+
+_open_dir_at = getattr(_helpers, 'open_dir_at', None)
+_lstat_dir_at = getattr(_helpers, 'lstat_dir_at', None)
+
+# How many subdirectories a pool thread may read ahead.
+_dirs_per_job = 4
+
+
+class _ReadAhead:
+    """The number of subdirectories (each holding an open fd until
+    it's visited) that may be read ahead at once, shared by the whole
+    walk so that the number of open fds doesn't grow with the depth.
+    Only the walking thread touches it."""
+    def __init__(self, limit):
+        self.available = limit
+
+
+def _dirlist_at(fd, prepend, raw=None):
+    l = []
+    for n, st in (raw if raw is not None else _lstat_dir_at(fd)):
+        if not isinstance(st, tuple):
+            add_error(Exception('%s: %s' % (path_msg(prepend + n),
+                                            os.strerror(st))))
+            continue
+        st = xstat.stat_result.from_xstat_rep(st)
+        if (st.st_mode & _IFMT) == stat.S_IFDIR:
+            n += b'/'
+        l.append((n, st))
+    l.sort(reverse=True)
+    return l
+
+
+def _read_subdir(parent_fd, name):
+    """Return (fd, raw_entries) for the directory name (with a trailing
+    slash) in parent_fd, or (None, exception) if it can't be read."""
+    try:
+        fd = _open_dir_at(parent_fd, name[:-1])
+    except OSError as e:
+        return None, e
+    try:
+        return fd, _lstat_dir_at(fd)
+    except OSError as e:
+        os.close(fd)
+        return None, e
+
+
+def _recursive_dirlist_at(fd, entries, prepend, xdev, pool, budget,
+                          bup_dir=None,
+                          excluded_paths=None,
+                          exclude_rxs=None,
+                          xdev_exceptions=frozenset(),
+                          stable=None):
+    # Decide what to do with every entry first, so that the
+    # subdirectories we'll descend into can be read ahead.
+    todo = []
+    for (name,pst) in entries:
+        path = prepend + name
+        if excluded_paths:
+            if os.path.normpath(path) in excluded_paths:
+                debug1('Skipping %r: excluded.\n' % path_msg(path))
+                continue
+        if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
+            continue
+        descend = False
+        kept = None
+        if name.endswith(b'/'):
+            if bup_dir != None:
+                if os.path.normpath(path) == bup_dir:
+                    debug1('Skipping BUP_DIR.\n')
+                    continue
+            if xdev != None and pst.st_dev != xdev \
+               and path not in xdev_exceptions:
+                debug1('Skipping contents of %r: different filesystem.\n'
+                       % path_msg(path))
+            else:
+                kept = stable(path, pst) if stable else None
+                if kept == []:
+                    debug1('Skipping contents of %r: unchanged.\n'
+                           % path_msg(path))
+                else:
+                    descend = True
+        todo.append((name, path, pst, descend, kept))
+
+    # Only the subdirectories that have to be listed are read ahead.
+    subdirs = iter([name for name, path, pst, descend, kept in todo
+                    if descend and kept is None])
+    pending = deque()
+    def read_ahead():
+        if not pool:
+            return
+        while budget.available > 0:
+            name = next(subdirs, None)
+            if name is None:
+                return
+            budget.available -= 1
+            pending.append(pool.apply_async(_read_subdir, (fd, name)))
+    read_ahead()
+    try:
+        for name, path, pst, descend, kept in todo:
+            if descend:
+                if kept is not None:
+                    try:
+                        sub_fd, raw = _open_dir_at(fd, name[:-1]), None
+                    except OSError as e:
+                        sub_fd, raw = None, e
+                elif pending:
+                    sub_fd, raw = pending.popleft().get()
+                    budget.available += 1
+                else:
+                    # Anything read ahead by the levels above us (or
+                    # below us, earlier) may have used up the budget.
+                    sub_fd, raw = _read_subdir(fd, next(subdirs))
+                if sub_fd is None:
+                    add_error('%s: %s' % (path_msg(prepend), raw))
+                else:
+                    try:
+                        if kept is not None:
+                            sub_entries = _kept_dirlist(path, path, kept)
+                        else:
+                            sub_entries = _dirlist_at(sub_fd, path, raw=raw)
+                        for i in _recursive_dirlist_at(sub_fd, sub_entries,
+                                                       prepend=path,
+                                                       xdev=xdev, pool=pool,
+                                                       budget=budget,
+                                                       bup_dir=bup_dir,
+                                                       excluded_paths=excluded_paths,
+                                                       exclude_rxs=exclude_rxs,
+                                                       xdev_exceptions=xdev_exceptions,
+                                                       stable=stable):
+                            yield i
+                    finally:
+                        os.close(sub_fd)
+                # Now that the subdirectory's done (and has returned
+                # whatever it used), read ahead here again, since
+                # everything is visited depth first.
+                read_ahead()
+            yield (path, pst)
+    finally:
+        # Don't leak the fds for anything we read ahead but didn't use
+        # (i.e. if the caller stopped early).
+        while pending:
+            sub_fd, raw = pending.popleft().get()
+            budget.available += 1
+            if sub_fd is not None:
+                os.close(sub_fd)
+
+
+def _recursive_dirlist_fds(paths, xdev, bup_dir=None,
+                           excluded_paths=None,
+                           exclude_rxs=None,
+                           xdev_exceptions=frozenset(),
+                           jobs=1, stable=None):
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    budget = _ReadAhead(jobs * _dirs_per_job)
+    try:
+        for path in paths:
+            try:
+                pst = xstat.lstat(path)
+                if stat.S_ISLNK(pst.st_mode):
+                    yield (path, pst)
+                    continue
+            except OSError as e:
+                add_error('recursive_dirlist: %s' % e)
+                continue
+            try:
+                pfile = OsFile(path)
+            except OSError as e:
+                add_error(e)
+                continue
+            pst = pfile.stat()
+            if xdev:
+                xdev = pst.st_dev
+            else:
+                xdev = None
+            if stat.S_ISDIR(pst.st_mode):
+                prepend = os.path.join(path, b'')
+                try:
+                    entries = _dirlist_at(pfile.fd, prepend)
+                except OSError as e:
+                    add_error('%s: %s' % (path_msg(prepend), e))
+                else:
+                    for i in _recursive_dirlist_at(pfile.fd, entries,
+                                                   prepend=prepend,
+                                                   xdev=xdev, pool=pool,
+                                                   budget=budget,
+                                                   bup_dir=bup_dir,
+                                                   excluded_paths=excluded_paths,
+                                                   exclude_rxs=exclude_rxs,
+                                                   xdev_exceptions=xdev_exceptions,
+                                                   stable=stable):
+                        yield i
+            else:
+                prepend = path
+            yield (prepend,pst)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
 def recursive_dirlist(paths, xdev, bup_dir=None,
                       excluded_paths=None,
                       exclude_rxs=None,
-                      xdev_exceptions=frozenset()):
+                      xdev_exceptions=frozenset(),
+                      jobs=1, stable=None):
+    """Yield (path, stat) for each of the paths, and (recursively)
+    everything in the directories among them, with each directory's
+    contents in reverse sorted order, before the directory itself.
+    If possible, list directories with up to jobs threads.
+
+    If stable is specified, it's called as stable(path, stat) for each
+    subdirectory that would be listed, and may return a list of the
+    names (as found by a previous listing) that are the only ones that
+    still need to be visited, in which case the directory isn't listed
+    at all, and nothing else in it is produced."""
+    if _open_dir_at:
+        for i in _recursive_dirlist_fds(paths, xdev, bup_dir=bup_dir,
+                                        excluded_paths=excluded_paths,
+                                        exclude_rxs=exclude_rxs,
+                                        xdev_exceptions=xdev_exceptions,
+                                        jobs=jobs, stable=stable):
+            yield i
+        return
     startdir = OsFile(b'.')
     try:
         assert(type(paths) != type(''))
@@ -124,7 +387,8 @@ def recursive_dirlist(paths, xdev, bup_dir=None,
                                             bup_dir=bup_dir,
                                             excluded_paths=excluded_paths,
                                             exclude_rxs=exclude_rxs,
-                                            xdev_exceptions=xdev_exceptions):
+                                            xdev_exceptions=xdev_exceptions,
+                                            stable=stable):
                     yield i
                 startdir.fchdir()
             else:
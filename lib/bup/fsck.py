@@ -0,0 +1,236 @@
+"""In-process pack verification (cf. bup fsck)."""
+
+from __future__ import absolute_import
+from binascii import hexlify
+import os, struct, zlib
+
+from bup import git
+from bup.compat import range
+from bup.helpers import Sha1, mmap_read
+
+# The most problems reported (individually) for any one pack.
+MAX_PACK_ERRORS = 20
+
+_chunk = 1024 * 1024
+
+
+def _sha1_range(m, start, end):
+    sum = Sha1()
+    for ofs in range(start, end, _chunk):
+        sum.update(m[ofs : min(end, ofs + _chunk)])
+    return sum.digest()
+
+
+class _Errors:
+    def __init__(self):
+        self.messages = []
+        self.count = 0
+
+    def add(self, msg):
+        self.count += 1
+        if len(self.messages) < MAX_PACK_ERRORS:
+            self.messages.append(msg)
+
+
+def _check_trailers(m, idx, errors):
+    if m[:4] != b'PACK':
+        errors.add('invalid pack header')
+    else:
+        ver, count = struct.unpack('!II', m[4:12])
+        if ver not in (2, 3):
+            errors.add('unsupported pack version %d' % ver)
+        if count != len(idx):
+            errors.add('pack has %d objects, index has %d'
+                       % (count, len(idx)))
+    pack_sum = m[-20:]
+    if _sha1_range(m, 0, len(m) - 20) != pack_sum:
+        errors.add('pack checksum mismatch')
+    im = idx.map
+    if im[-40:-20] != pack_sum:
+        errors.add('index is for a different pack (%s)'
+                   % hexlify(im[-40:-20]).decode('ascii'))
+    if _sha1_range(im, 0, len(im) - 20) != im[-20:]:
+        errors.add('index checksum mismatch')
+
+
+def _check_idx_tables(idx, pack_len, errors):
+    """Check the index's structure, and return true if its tables can
+    be trusted enough to look at the pack's objects."""
+    n = len(idx)
+    if isinstance(idx, git.PackIdxV2):
+        min_len = idx.ofs64table_ofs + 40
+    else:
+        min_len = idx.sha_ofs + n * 24 + 40
+    if len(idx.map) < min_len:
+        errors.add('index is truncated (or its fanout table is damaged)')
+        return False
+    ok = True
+    prev = 0
+    for b in range(256):
+        if idx.fanout[b] < prev:
+            errors.add('fanout table is not in order at %02x' % b)
+            return False
+        prev = idx.fanout[b]
+    prev = None
+    for i, sha in enumerate(idx):
+        if prev is not None and sha <= prev:
+            errors.add('index entry %d (%s) is out of order'
+                       % (i, hexlify(sha).decode('ascii')))
+            ok = False
+        first = ord(sha[:1])
+        if not idx.fanout[first - 1] <= i < idx.fanout[first]:
+            errors.add('index entry %d (%s) is outside its fanout range'
+                       % (i, hexlify(sha).decode('ascii')))
+            ok = False
+        prev = sha
+    try:
+        offsets, _ = idx._pack_order()
+    except (IndexError, ValueError, struct.error) as e:
+        errors.add('invalid offset table: %s' % e)
+        return False
+    if offsets and offsets[0] != 12:
+        errors.add('first object is at offset %d, not 12' % offsets[0])
+        ok = False
+    for i in range(len(offsets)):
+        if offsets[i] >= pack_len - 20 \
+           or (i and offsets[i] == offsets[i - 1]):
+            errors.add('invalid object offset %d' % offsets[i])
+            ok = False
+    return ok
+
+
+def _check_crcs(m, idx, errors):
+    offsets, idxs = idx._pack_order()
+    for i in range(len(offsets)):
+        ofs = offsets[i]
+        end = offsets[i + 1] if i + 1 < len(offsets) else len(m) - 20
+        crc = idx._crc_from_idx(idxs[i])
+        if crc is None:
+            return
+        if zlib.crc32(m[ofs:end]) & 0xffffffff != crc:
+            errors.add('CRC mismatch for %s at offset %d'
+                       % (hexlify(idx._idx_to_hash(idxs[i])).decode('ascii'),
+                          ofs))
+
+
+def _object_headers(m, idx, errors):
+    """Return {ofs: (type, size, data_ofs, base_ofs)} for all of the
+    objects in the pack, where base_ofs is the offset of a delta's
+    base object (otherwise None)."""
+    result = {}
+    offsets, idxs = idx._pack_order()
+    starts = frozenset(offsets)
+    for ofs, i in zip(offsets, idxs):
+        try:
+            typ, sz, data_ofs = git._packobj_header(m, ofs)
+        except IndexError:
+            errors.add('truncated object header at offset %d' % ofs)
+            continue
+        base_ofs = None
+        if typ == git._ofs_delta_type:
+            c = ord(m[data_ofs : data_ofs + 1])
+            data_ofs += 1
+            rel = c & 0x7f
+            while c & 0x80 and data_ofs < len(m):
+                c = ord(m[data_ofs : data_ofs + 1])
+                data_ofs += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base_ofs = ofs - rel
+        elif typ == git._ref_delta_type:
+            base_ofs = idx.find_offset(m[data_ofs : data_ofs + 20])
+            data_ofs += 20
+        elif typ not in git._typermap:
+            errors.add('unknown type %d for object at offset %d' % (typ, ofs))
+            continue
+        if typ in (git._ofs_delta_type, git._ref_delta_type) \
+           and base_ofs not in starts:
+            errors.add('missing delta base for object at offset %d' % ofs)
+            continue
+        result[ofs] = typ, sz, data_ofs, base_ofs
+    return result
+
+
+def _check_objects(m, idx, errors):
+    headers = _object_headers(m, idx, errors)
+    # Keep each delta base's content until its last delta is done.
+    refs = {}
+    for typ, sz, data_ofs, base_ofs in headers.values():
+        if base_ofs is not None:
+            refs[base_ofs] = refs.get(base_ofs, 0) + 1
+    cache = {}
+
+    def content(ofs):
+        chain = []
+        while ofs not in cache:
+            if ofs not in headers or ofs in chain:
+                raise git.GitError('invalid delta base at offset %d' % ofs)
+            chain.append(ofs)
+            base_ofs = headers[ofs][3]
+            if base_ofs is None:
+                break
+            ofs = base_ofs
+        if ofs in cache:
+            typ, data = cache[ofs]
+        else:
+            typ, sz, data_ofs, _ = headers[chain.pop()]
+            data = b''.join(git._inflate_packobj(m, data_ofs, sz))
+            typ = git._typermap[typ]
+            if refs.get(ofs):
+                cache[ofs] = typ, data
+        for ofs in reversed(chain):
+            _, sz, data_ofs, base_ofs = headers[ofs]
+            delta = b''.join(git._inflate_packobj(m, data_ofs, sz))
+            data = git._apply_delta(data, delta)
+            refs[base_ofs] -= 1
+            if refs[base_ofs] <= 0:
+                cache.pop(base_ofs, None)
+            if refs.get(ofs):
+                cache[ofs] = typ, data
+        return typ, data
+
+    offsets, idxs = idx._pack_order()
+    for ofs, i in zip(offsets, idxs):
+        if ofs not in headers:
+            continue
+        sha = idx._idx_to_hash(i)
+        try:
+            typ, data = content(ofs)
+        except (git.GitError, IndexError, zlib.error) as e:
+            errors.add('cannot read %s at offset %d: %s'
+                       % (hexlify(sha).decode('ascii'), ofs, e))
+            continue
+        if git.calc_hash(typ, data) != sha:
+            errors.add('SHA-1 mismatch for %s at offset %d'
+                       % (hexlify(sha).decode('ascii'), ofs))
+
+
+def verify_pack(base, full=True):
+    """Check the pack base + '.pack' and its index base + '.idx', and
+    return a dict with the number of 'objects' and 'bytes' in the pack,
+    the total 'error_count', and the first few 'errors' (strings).
+    The pack and index checksums, the index's structure, and (for v2
+    indexes) each object's CRC32 are always checked.  If full is true,
+    each object is inflated (with any deltas applied) and its SHA-1
+    compared to its name too."""
+    errors = _Errors()
+    report = {'objects': 0, 'bytes': 0}
+    try:
+        idx = git.open_idx(base + b'.idx')
+        with open(base + b'.pack', 'rb') as f:
+            report['bytes'] = os.fstat(f.fileno()).st_size
+            m = mmap_read(f) if report['bytes'] else b''
+    except (IOError, OSError, git.GitError) as e:
+        errors.add(str(e))
+    else:
+        report['objects'] = len(idx)
+        if len(m) < 32 or len(idx.map) < 1064:
+            errors.add('pack or index is truncated')
+        else:
+            _check_trailers(m, idx, errors)
+            if _check_idx_tables(idx, len(m), errors):
+                _check_crcs(m, idx, errors)
+                if full:
+                    _check_objects(m, idx, errors)
+    report['error_count'] = errors.count
+    report['errors'] = errors.messages
+    return report
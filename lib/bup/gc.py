@@ -1,27 +1,35 @@
 
 from __future__ import absolute_import
 from binascii import hexlify, unhexlify
+from collections import deque
+from multiprocessing import Pool
 from os.path import basename
-import glob, os, subprocess, sys, tempfile
+import glob, mmap, os, subprocess, sys
 
-from bup import bloom, git, midx
-from bup.compat import hexstr, range
-from bup.git import MissingObject, walk_object
-from bup.helpers import Nonlocal, log, progress, qprogress
+from bup import bloom, git, locmap, midx
+from bup.compat import byte_int, bytes_from_uint, hexstr, range
+from bup.git import MissingObject, walk_objects
+from bup.helpers import Nonlocal, log, mmap_read, progress, qprogress
 from bup.io import path_msg
+from bup.repo import LocalRepo
 
 # This garbage collector uses a Bloom filter to track the live objects
 # during the mark phase.  This means that the collection is
 # probabilistic; it may retain some (known) percentage of garbage, but
 # it can also work within a reasonable, fixed RAM budget for any
-# particular percentage and repository size.
+# particular percentage and repository size.  When it fits within the
+# (configurable) budget, an exact bitmap, indexed by each object's
+# position in the repository's indexes, is used instead, and then
+# exactly the unreachable objects are removed.  Either way, the
+# "liveness" set only exists in memory.
 #
 # The collection proceeds as follows:
 #
 #   - Scan all live objects by walking all of the refs, and insert
-#     every hash encountered into a new Bloom "liveness" filter.
-#     Compute the size of the liveness filter based on the total
-#     number of objects in the repository.  This is the "mark phase".
+#     every hash encountered into a new Bloom "liveness" filter (or
+#     bitmap).  Compute the size of the liveness filter based on the
+#     total number of objects in the repository.  This is the "mark
+#     phase".
 #
 #   - Clear the data that's dependent on the repository's object set,
 #     i.e. the reflog, the normal Bloom filter, and the midxes.
@@ -33,15 +41,22 @@ from bup.io import path_msg
 #     than (currently) 10% garbage (computed by an initial traversal
 #     of the packfile in consultation with the liveness filter).  To
 #     rewrite, traverse the packfile (again) and write each hash that
-#     tests positive against the liveness filter to a packwriter.
+#     tests positive against the liveness filter to a packwriter,
+#     copying the compressed pack records as-is whenever possible.
 #
 #     During the traversal of all of the packfiles, delete redundant,
 #     old packfiles only after the packwriter has finished the pack
 #     that contains all of their live objects.
 #
-# The current code unconditionally tracks the set of tree hashes seen
-# during the mark phase, and skips any that have already been visited.
-# This should decrease the IO load at the cost of increased RAM use.
+#     With --jobs, the packs are examined by a pool of processes, but
+#     everything is still written (and removed) by the main process,
+#     in the same order.
+#
+# The mark phase walks the refs breadth first, reading many commits
+# and trees at a time (with --jobs, via several threads), and it
+# tracks the set of commits and trees seen so far, skipping any that
+# have already been visited via some other ref.  This should decrease
+# the IO load at the cost of increased RAM use.
 
 # FIXME: add a bloom filter tuning parameter?
 
@@ -96,46 +111,224 @@ def report_live_item(n, total, ref_name, ref_id, item, verbosity):
         log('%s %s:%s%s\n' % (status, hex_id, path_msg(ps), path_msg(dirslash)))
 
 
-def find_live_objects(existing_count, cat_pipe, verbosity=0):
-    prune_visited_trees = True # In case we want a command line option later
-    pack_dir = git.repo(b'objects/pack')
-    ffd, bloom_filename = tempfile.mkstemp(b'.bloom', b'tmp-gc-', pack_dir)
-    os.close(ffd)
-    # FIXME: allow selection of k?
-    # FIXME: support ephemeral bloom filters (i.e. *never* written to disk)
-    live_objs = bloom.create(bloom_filename, expected=existing_count, k=None)
-    # live_objs will hold on to the fd until close or exit
-    os.unlink(bloom_filename)
-    stop_at, trees_visited = None, None
-    if prune_visited_trees:
-        trees_visited = set()
-        stop_at = lambda x: unhexlify(x) in trees_visited
-    approx_live_count = 0
-    for ref_name, ref_id in git.list_refs():
-        for item in walk_object(cat_pipe.get, hexlify(ref_id), stop_at=stop_at,
-                                include_data=None):
-            # FIXME: batch ids
-            if verbosity:
-                report_live_item(approx_live_count, existing_count,
-                                 ref_name, ref_id, item, verbosity)
-            if trees_visited is not None and item.type == b'tree':
-                trees_visited.add(item.oid)
+def _index_span(ix):
+    """Return the number of distinct positions ix._idx_from_hash() might
+    return for the index ix (an idx, midx, or location map)."""
+    if isinstance(ix, locmap.LocMap):
+        return ix.slots
+    return len(ix)
+
+
+class LiveBitmap:
+    """An exact record of the live objects for the collector, in place
+    of the Bloom filter.  It's a bitmap in an anonymous (shared) mmap,
+    indexed by the position of each object in the repository's
+    indexes (usually a midx or location map), as seen by the PackIdxList
+    idxlist.  Objects that aren't in any of the indexes (i.e. not in
+    any pack) are ignored."""
+    def __init__(self, idxlist):
+        self.idxlist = idxlist  # Keep the index maps open
+        self.bases = []
+        size = 0
+        for ix in idxlist.packs:
+            self.bases.append((size, ix))
+            size += _index_span(ix)
+        self.map = mmap.mmap(-1, max(1, (size + 7) // 8))
+        self.entries = 0
+
+    @staticmethod
+    def size_for(idxlist):
+        """Return the number of bytes the bitmap for idxlist would need."""
+        return (sum(_index_span(ix) for ix in idxlist.packs) + 7) // 8
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.idxlist = self.bases = None
+
+    def __len__(self):
+        return self.entries
+
+    def _position(self, sha):
+        for base, ix in self.bases:
+            i = ix._idx_from_hash(sha)
+            if i is not None:
+                return base + i
+        return None
+
+    def add(self, ids):
+        """Add the hashes in ids (packed binary 20-bytes) to the set."""
+        m = self.map
+        for ofs in range(0, len(ids), 20):
+            i = self._position(ids[ofs : ofs + 20])
+            if i is None:
+                continue
+            byte, bit = i >> 3, 1 << (i & 7)
+            c = byte_int(m[byte])
+            if not c & bit:
+                m[byte] = bytes_from_uint(c | bit)
+                self.entries += 1
+
+    def exists(self, sha):
+        """Return true if the object is in the set."""
+        i = self._position(sha)
+        if i is None:
+            return False
+        return bool(byte_int(self.map[i >> 3]) & (1 << (i & 7)))
+
+    def pfalse_positive(self):
+        return 0.0
+
+
+def find_live_objects(existing_count, verbosity=0, jobs=1,
+                      max_bitmap_size=0):
+    """Return a set (with add(), exists(), and close()) of the objects
+    reachable from any ref.  If an exact LiveBitmap would need no more
+    than max_bitmap_size bytes, return one of those, otherwise return
+    a Bloom filter.  Either way, it only exists in memory."""
+    live_objs = None
+    if max_bitmap_size:
+        idxlist = git.PackIdxList(git.repo(b'objects/pack'))
+        bitmap_size = LiveBitmap.size_for(idxlist)
+        if bitmap_size <= max_bitmap_size:
             if verbosity:
-                if not live_objs.exists(item.oid):
+                log('tracking live objects exactly (%d byte bitmap)\n'
+                    % bitmap_size)
+            live_objs = LiveBitmap(idxlist)
+        elif verbosity:
+            log('live object bitmap would need %d bytes, using bloom filter\n'
+                % bitmap_size)
+    if live_objs is None:
+        # FIXME: allow selection of k?
+        live_objs = bloom.create_ephemeral(expected=existing_count, k=None)
+    # The commits and trees reached from any ref so far, so that
+    # shared history is only read once.
+    visited = set()
+    approx_live_count = 0
+    repo = LocalRepo(cat_jobs=jobs)
+    try:
+        for ref_name, ref_id in git.list_refs():
+            for item in walk_objects(repo.cat_many, [hexlify(ref_id)],
+                                     visited):
+                if verbosity:
+                    report_live_item(approx_live_count, existing_count,
+                                     ref_name, ref_id, item, verbosity)
+                if verbosity:
+                    if not live_objs.exists(item.oid):
+                        live_objs.add(item.oid)
+                        approx_live_count += 1
+                else:
                     live_objs.add(item.oid)
-                    approx_live_count += 1
-            else:
-                live_objs.add(item.oid)
-    trees_visited = None
-    if verbosity:
+    finally:
+        repo.close()
+    visited = None
+    if verbosity and live_objs.pfalse_positive():
         log('expecting to retain about %.2f%% unnecessary objects\n'
             % live_objs.pfalse_positive())
     return live_objs
 
 
+# The number of objects each sweep() job examines at a time.
+_sweep_chunk = 1000
+
+# The _Sweeper for this process (cf. _init_sweeper()).
+_sweeper = None
+
+
+class _Sweeper:
+    """Examine packs on behalf of sweep(), either in-process, or in one
+    of its worker processes."""
+    def __init__(self, live_objects, compression, cat_pipe=None):
+        self.live_objects = live_objects
+        self.compression = compression
+        self.cat_pipe = cat_pipe
+        self.pack = None  # (idx_name, idx, pack_map)
+
+    def close(self):
+        if self.pack:
+            self.pack[2].close()
+            self.pack = None
+
+    def count_live(self, idx_name):
+        """Return (live_count, count) for the objects in the index."""
+        exists = self.live_objects.exists
+        idx = git.open_idx(idx_name)
+        live_count = 0
+        for sha in idx:
+            if exists(sha):
+                live_count += 1
+        return live_count, len(idx)
+
+    def _open_pack(self, idx_name):
+        if not self.pack or self.pack[0] != idx_name:
+            self.close()
+            idx = git.open_idx(idx_name)
+            pack_map = mmap_read(open(idx_name[:-3] + b'pack', 'rb'))
+            self.pack = idx_name, idx, pack_map
+        return self.pack[1:]
+
+    def live_records(self, idx_name, start, end):
+        """Return a list of (sha, record) for each live object among the
+        index's entries [start, end), where record is a complete pack
+        record for the object."""
+        idx, pack_map = self._open_pack(idx_name)
+        exists = self.live_objects.exists
+        result = []
+        for i in range(start, end):
+            sha = idx._idx_to_hash(i)
+            if not exists(sha):
+                continue
+            # Copy the compressed records for whole objects straight
+            # from the old pack, and only inflate and recompress deltas
+            # (and objects stored at some other compression level).
+            raw = git.packed_record(pack_map, idx, idx._ofs_from_idx(i),
+                                    compression_level=self.compression)
+            if raw:
+                result.append((sha, raw[1]))
+                continue
+            if not self.cat_pipe:
+                self.cat_pipe = git.CatPipe()
+            item_it = self.cat_pipe.get(hexlify(sha))
+            _, typ, _ = next(item_it)
+            result.append((sha, b''.join(git._encode_packobj(typ,
+                                                             b''.join(item_it),
+                                                             self.compression))))
+        return result
+
+
+def _init_sweeper(live_objects, compression, cat_pipe=None):
+    global _sweeper
+    _sweeper = _Sweeper(live_objects, compression, cat_pipe=cat_pipe)
+
+
+def _count_live(idx_name):
+    return _sweeper.count_live(idx_name)
+
+
+def _live_records(task):
+    return _sweeper.live_records(*task)
+
+
+def _ordered_results(pool, fn, items, window):
+    """Yield fn(item) for each item, in order, computed by the pool,
+    with at most window results outstanding at a time."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(fn, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
-          verbosity):
-    # Traverse all the packs, saving the (probably) live data.
+          verbosity, jobs=1):
+    # Traverse all the packs, saving the (probably) live data.  With
+    # more than one job, the packs are examined (and the live objects'
+    # records prepared) by a pool of worker processes, but the results
+    # are still written and the old packs removed here, in order, so
+    # the outcome is the same as the serial sweep.
 
     ns = Nonlocal()
     ns.stale_files = []
@@ -148,8 +341,10 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
             if verbosity:
                 log('removing ' + path_msg(basename(p)) + '\n')
             os.unlink(p)
-        if ns.stale_files:  # So git cat-pipe will close them
-            cat_pipe.restart()
+        if ns.stale_files:
+            # Release the removed packs (their maps, and the indexes),
+            # so that the space is actually freed.
+            cat_pipe.close()
         ns.stale_files = []
 
     writer = git.PackWriter(objcache_maker=None,
@@ -158,45 +353,76 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
                             on_pack_finish=remove_stale_files)
 
     # FIXME: sanity check .idx names vs .pack names?
-    collect_count = 0
-    for idx_name in glob.glob(os.path.join(git.repo(b'objects/pack'), b'*.idx')):
+    idx_names = glob.glob(os.path.join(git.repo(b'objects/pack'), b'*.idx'))
+    global _sweeper
+    if jobs > 1:
+        # The workers are forked, so they share the live_objects map.
+        pool = Pool(jobs, _init_sweeper, (live_objects, compression))
+        run = lambda fn, items: _ordered_results(pool, fn, items, jobs * 2)
+    else:
+        pool = None
+        _init_sweeper(live_objects, compression, cat_pipe=cat_pipe)
+        run = lambda fn, items: (fn(x) for x in items)
+
+    def rewrite_wanted(live_count, count):
+        return live_count \
+            and live_count / float(count) <= ((100 - threshold) / 100.0)
+
+    try:
         if verbosity:
-            qprogress('preserving live data (%d%% complete)\r'
-                      % ((float(collect_count) / existing_count) * 100))
-        idx = git.open_idx(idx_name)
+            qprogress('counting live objects\r')
+        counts = list(run(_count_live, idx_names))
 
-        idx_live_count = 0
-        for sha in idx:
-            if live_objects.exists(sha):
-                idx_live_count += 1
+        def rewrite_tasks():
+            for idx_name, (live_count, count) in zip(idx_names, counts):
+                if rewrite_wanted(live_count, count):
+                    for start in range(0, count, _sweep_chunk):
+                        yield idx_name, start, min(count, start + _sweep_chunk)
+        records = run(_live_records, rewrite_tasks())
 
-        collect_count += idx_live_count
-        if idx_live_count == 0:
+        collect_count = 0
+        for idx_name, (live_count, count) in zip(idx_names, counts):
             if verbosity:
-                log('deleting %s\n'
-                    % path_msg(git.repo_rel(basename(idx_name))))
-            ns.stale_files.append(idx_name)
-            ns.stale_files.append(idx_name[:-3] + b'pack')
-            continue
+                qprogress('preserving live data (%d%% complete)\r'
+                          % ((float(collect_count) / existing_count) * 100))
+            collect_count += live_count
+            if live_count == 0:
+                if verbosity:
+                    log('deleting %s\n'
+                        % path_msg(git.repo_rel(basename(idx_name))))
+                ns.stale_files.append(idx_name)
+                ns.stale_files.append(idx_name[:-3] + b'pack')
+                continue
 
-        live_frac = idx_live_count / float(len(idx))
-        if live_frac > ((100 - threshold) / 100.0):
-            if verbosity:
-                log('keeping %s (%d%% live)\n' % (git.repo_rel(basename(idx_name)),
-                                                  live_frac * 100))
-            continue
+            live_frac = live_count / float(count)
+            if not rewrite_wanted(live_count, count):
+                if verbosity:
+                    log('keeping %s (%d%% live)\n' % (git.repo_rel(basename(idx_name)),
+                                                      live_frac * 100))
+                continue
 
-        if verbosity:
-            log('rewriting %s (%.2f%% live)\n' % (basename(idx_name),
-                                                  live_frac * 100))
-        for sha in idx:
-            if live_objects.exists(sha):
-                item_it = cat_pipe.get(hexlify(sha))
-                _, typ, _ = next(item_it)
-                writer.just_write(sha, typ, b''.join(item_it))
+            if verbosity:
+                log('rewriting %s (%.2f%% live)\n' % (basename(idx_name),
+                                                      live_frac * 100))
+            for start in range(0, count, _sweep_chunk):
+                for sha, record in next(records):
+                    writer.just_write_raw(sha, record)
 
-        ns.stale_files.append(idx_name)
-        ns.stale_files.append(idx_name[:-3] + b'pack')
+            ns.stale_files.append(idx_name)
+            ns.stale_files.append(idx_name[:-3] + b'pack')
+    except BaseException:
+        if pool:
+            pool.terminate()
+            pool.join()
+            pool = None
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if _sweeper:
+            _sweeper.close()
+            _sweeper = None
 
     if verbosity:
         progress('preserving live data (%d%% complete)\n'
@@ -218,7 +444,8 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
                / float(existing_count) * 100))
 
 
-def bup_gc(threshold=10, compression=1, verbosity=0):
+def bup_gc(threshold=10, compression=1, verbosity=0, jobs=1,
+           max_bitmap_size=0):
     cat_pipe = git.cp()
     existing_count = count_objects(git.repo(b'objects/pack'), verbosity)
     if verbosity:
@@ -228,8 +455,9 @@ def bup_gc(threshold=10, compression=1, verbosity=0):
             log('nothing to collect\n')
     else:
         try:
-            live_objects = find_live_objects(existing_count, cat_pipe,
-                                             verbosity=verbosity)
+            live_objects = find_live_objects(existing_count,
+                                             verbosity=verbosity, jobs=jobs,
+                                             max_bitmap_size=max_bitmap_size)
         except MissingObject as ex:
             log('bup: missing object %r \n' % hexstr(ex.oid))
             sys.exit(1)
@@ -241,6 +469,10 @@ def bup_gc(threshold=10, compression=1, verbosity=0):
             midx.clear_midxes(packdir)
             if verbosity: log('clearing bloom filter\n')
             bloom.clear_bloom(packdir)
+            had_locmap = os.path.exists(os.path.join(packdir, b'bup.locmap'))
+            if had_locmap:
+                if verbosity: log('clearing location map\n')
+                locmap.clear_locmap(packdir)
             if verbosity: log('clearing reflog\n')
             expirelog_cmd = [b'git', b'reflog', b'expire', b'--all', b'--expire=all']
             expirelog = subprocess.Popen(expirelog_cmd, env=git._gitenv())
@@ -248,6 +480,9 @@ def bup_gc(threshold=10, compression=1, verbosity=0):
             if verbosity: log('removing unreachable data\n')
             sweep(live_objects, existing_count, cat_pipe,
                   threshold, compression,
-                  verbosity)
+                  verbosity, jobs=jobs)
+            if had_locmap:
+                if verbosity: log('rebuilding location map\n')
+                git.update_locmap(packdir, create=True)
         finally:
             live_objects.close()
@@ -4,14 +4,19 @@ interact with the Git data structures.
 """
 
 from __future__ import absolute_import, print_function
-import errno, os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
+import errno, math, os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
+import resource
 from array import array
+from bisect import bisect_left
 from binascii import hexlify, unhexlify
-from collections import namedtuple
+from collections import deque, namedtuple
+from functools import partial
 from itertools import islice
+from multiprocessing.pool import ThreadPool
 from numbers import Integral
 
-from bup import _helpers, compat, hashsplit, path, midx, bloom, xstat
+from bup import (_helpers, compat, hashsplit, path, midx, bloom, locmap,
+                 xstat)
 from bup.compat import (buffer,
                         byte_int, bytes_from_byte, bytes_from_uint,
                         environ,
@@ -19,7 +24,8 @@ from bup.compat import (buffer,
                         range,
                         reraise)
 from bup.io import path_msg
-from bup.helpers import (Sha1, add_error, chunkyreader, debug1, debug2,
+from bup.helpers import (Sha1, add_error, atomically_replaced_file,
+                         chunkyreader, debug1, debug2,
                          fdatasync,
                          hostname, localtime, log,
                          merge_dict,
@@ -57,13 +63,20 @@ def _git_wait(cmd, p):
     if rv != 0:
         raise GitError('%r returned %d' % (cmd, rv))
 
-def git_config_get(option, repo_dir=None):
-    cmd = (b'git', b'config', b'--get', option)
+def git_config_get(option, repo_dir=None, opttype=None):
+    cmd = [b'git', b'config']
+    if opttype == 'bool':
+        cmd.append(b'--bool')
+    else:
+        assert opttype is None
+    cmd.extend([b'--get', option])
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                          env=_gitenv(repo_dir=repo_dir))
     r = p.stdout.read()
     rc = p.wait()
     if rc == 0:
+        if opttype == 'bool':
+            return r.strip() == b'true'
         return r
     if rc != 1:
         raise GitError('%r returned %d' % (cmd, rc))
@@ -189,25 +202,15 @@ def all_packdirs():
 
 
 def auto_midx(objdir):
-    args = [path.exe(), b'midx', b'--auto', b'--dir', objdir]
-    try:
-        rv = subprocess.call(args, stdout=open(os.devnull, 'w'))
-    except OSError as e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
-
-    args = [path.exe(), b'bloom', b'--dir', objdir]
-    try:
-        rv = subprocess.call(args, stdout=open(os.devnull, 'w'))
-    except OSError as e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+    """Bring the midx files and the bloom filter in objdir up to date,
+    as `bup midx --auto` and `bup bloom` would.  Since the caller's
+    pack is already complete, any failure is only recorded (via
+    add_error()), as it was when these ran as subprocesses."""
+    for update in (partial(update_midxes, auto=True), update_bloom):
+        try:
+            update(objdir)
+        except Exception as e:
+            add_error('%s: %s' % (path_msg(objdir), e))
 
 
 def mangle_name(name, mode, gitmode):
@@ -314,6 +317,12 @@ def _encode_packobj(type, content, compression_level=1):
     yield z.flush()
 
 
+def _encode_blob(content, compression_level):
+    # Runs in the PackWriter worker threads (as does the hashing); the
+    # compression releases the GIL for any reasonably sized blob.
+    return b''.join(_encode_packobj(b'blob', content, compression_level))
+
+
 def _encode_looseobj(type, content, compression_level=1):
     z = zlib.compressobj(compression_level)
     yield z.compress(b'%s %d\0' % (type, len(content)))
@@ -352,7 +361,161 @@ def _decode_packobj(buf):
     return (type, zlib.decompress(buf[i+1:]))
 
 
+# Pack object types that aren't objects themselves.
+_ofs_delta_type = 6
+_ref_delta_type = 7
+
+# How much compressed data to feed to zlib (and how much data to ask
+# for back) at a time when reading packed objects.
+_inflate_chunk = 65536
+
+
+def _zlib_flevel(level):
+    """Return the FLEVEL that zlib records in the header of a stream
+    compressed at level (cf. RFC 1950)."""
+    if level < 0:
+        level = 6  # Z_DEFAULT_COMPRESSION
+    if level < 2:
+        return 0
+    if level < 6:
+        return 1
+    if level == 6:
+        return 2
+    return 3
+
+
+def packed_record(pack_map, ix, ofs, compression_level=None):
+    """Return (type, record) for the object at offset ofs in pack_map
+    (an mmap of the pack whose PackIdx is ix) if it's stored whole,
+    i.e. not as a delta, where record is the object's complete pack
+    record (header and zlib stream), suitable for
+    PackWriter.just_write_raw().  Otherwise return None.  If
+    compression_level is not None, also return None unless the record
+    looks (as far as the zlib header can tell) like it was compressed
+    at that level.  Raise a GitError if the record doesn't match the
+    CRC in the index."""
+    typ, sz, data_ofs = _packobj_header(pack_map, ofs)
+    if typ not in _typermap:
+        return None
+    if compression_level is not None \
+       and byte_int(pack_map[data_ofs + 1]) >> 6 != _zlib_flevel(compression_level):
+        return None
+    end, crc = ix.record_span(ofs, len(pack_map))
+    record = pack_map[ofs:end]
+    if crc is not None and zlib.crc32(record) & 0xffffffff != crc:
+        raise GitError('CRC mismatch for packed object at offset %d in %s'
+                       % (ofs, path_msg(ix.name)))
+    return _typermap[typ], record
+
+
+def _packobj_header(m, ofs):
+    """Return (type, size, data_ofs) for the packed object at offset ofs
+    in the pack map m.  For deltas, data_ofs is the position of the
+    base reference, not the compressed data."""
+    c = byte_int(m[ofs])
+    typ = (c & 0x70) >> 4
+    sz = c & 0x0f
+    shift = 4
+    ofs += 1
+    while c & 0x80:
+        c = byte_int(m[ofs])
+        ofs += 1
+        sz |= (c & 0x7f) << shift
+        shift += 7
+    return typ, sz, ofs
+
+
+def _inflate_packobj(m, ofs, size):
+    """Yield the size bytes of uncompressed data for the zlib stream at
+    offset ofs in the pack map m, in chunks."""
+    d = zlib.decompressobj()
+    left = size
+    tail = b''
+    while left > 0:
+        if not tail:
+            tail = m[ofs : ofs + _inflate_chunk]
+            if not tail:
+                raise GitError('truncated packed object')
+            ofs += len(tail)
+        data = d.decompress(tail, _inflate_chunk)
+        tail = d.unconsumed_tail
+        if data:
+            left -= len(data)
+            yield data
+    if left:
+        raise GitError('packed object larger than expected')
+
+
+def _delta_varint(delta, i):
+    n = shift = 0
+    while True:
+        c = byte_int(delta[i])
+        i += 1
+        n |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return n, i
+
+
+def _apply_delta(base, delta):
+    """Return the result of applying the git delta to base."""
+    src_size, i = _delta_varint(delta, 0)
+    dst_size, i = _delta_varint(delta, i)
+    if src_size != len(base):
+        raise GitError('delta base size mismatch (%d != %d)'
+                       % (src_size, len(base)))
+    result = []
+    while i < len(delta):
+        c = byte_int(delta[i])
+        i += 1
+        if c & 0x80:
+            # copy from base
+            ofs = sz = 0
+            for bit in range(4):
+                if c & (1 << bit):
+                    ofs |= byte_int(delta[i]) << (8 * bit)
+                    i += 1
+            for bit in range(3):
+                if c & (0x10 << bit):
+                    sz |= byte_int(delta[i]) << (8 * bit)
+                    i += 1
+            result.append(base[ofs : ofs + (sz or 0x10000)])
+        elif c:
+            # insert from delta
+            result.append(delta[i : i + c])
+            i += c
+        else:
+            raise GitError('invalid delta opcode 0')
+    result = b''.join(result)
+    if len(result) != dst_size:
+        raise GitError('delta result size mismatch (%d != %d)'
+                       % (len(result), dst_size))
+    return result
+
+
+def _uint_array(itemsize, data):
+    """Return an array of the native itemsize byte unsigned integers in
+    data.  (Python 2's array has no 'Q', but its 'L' is 64 bits
+    wherever a long is.)"""
+    for code in ('I', 'L', 'Q'):
+        try:
+            result = array(code)
+        except ValueError:
+            continue
+        if result.itemsize == itemsize:
+            break
+    else:
+        raise GitError('no %d byte array type' % itemsize)
+    if hasattr(result, 'frombytes'):
+        result.frombytes(data)
+    else:
+        result.fromstring(data)
+    return result
+
+
 class PackIdx:
+    _by_ofs = None
+
     def __init__(self):
         assert(0)
 
@@ -369,6 +532,14 @@ class PackIdx:
             return want_source and os.path.basename(self.name) or True
         return None
 
+    def _find_many(self, batch, found):
+        """Set found[i] for each not yet found sha i in the sorted batch
+        (concatenated binary shas) that's in this index, and return
+        the number of shas that were newly found."""
+        return _helpers.find_shas(self.map, self.sha_ofs + self._sha_skip,
+                                  self.nsha, self._sha_stride,
+                                  batch, found)
+
     def _idx_from_hash(self, hash):
         global _total_searches, _total_steps
         _total_searches += 1
@@ -390,6 +561,34 @@ class PackIdx:
                 return mid
         return None
 
+    def _crc_from_idx(self, idx):
+        """Return the CRC32 of the packed object at idx, or None if the
+        index doesn't record it."""
+        return None
+
+    def _pack_order(self):
+        """Return (offsets, idxs), the pack offsets of all of the objects
+        in ascending order, and the corresponding index positions, as
+        compact arrays, since they're kept for the life of the idx."""
+        if self._by_ofs is None:
+            offsets, idxs = _helpers.pack_order(self.map, len(self),
+                                                *self._ofs_table())
+            self._by_ofs = _uint_array(8, offsets), _uint_array(4, idxs)
+        return self._by_ofs
+
+    def record_span(self, ofs, pack_len):
+        """Return (end, crc) for the object at offset ofs in the pack
+        (which is pack_len bytes long), where end is the offset just
+        past the object's record, and crc is the record's CRC32, or
+        None if the index doesn't have it."""
+        offsets, idxs = self._pack_order()
+        i = bisect_left(offsets, ofs)
+        if i == len(offsets) or offsets[i] != ofs:
+            raise GitError('no object at offset %d in %s'
+                           % (ofs, path_msg(self.name)))
+        end = offsets[i + 1] if i + 1 < len(offsets) else pack_len - 20
+        return end, self._crc_from_idx(idxs[i])
+
 
 class PackIdxV1(PackIdx):
     """Object representation of a Git pack index (version 1) file."""
@@ -402,12 +601,19 @@ class PackIdxV1(PackIdx):
         self.fanout.append(0)  # entry "-1"
         self.nsha = self.fanout[255]
         self.sha_ofs = 256 * 4
+        self._sha_skip, self._sha_stride = 4, 24
         # Avoid slicing shatable for individual hashes (very high overhead)
         self.shatable = buffer(self.map, self.sha_ofs, self.nsha * 24)
 
     def __len__(self):
         return int(self.nsha)  # int() from long for python 2
 
+    def _ofs_table(self):
+        """Return (start, stride, large_start) for the pack offset
+        table, where large_start is the start of the 64-bit offsets, or
+        -1 if there aren't any."""
+        return self.sha_ofs, 24, -1
+
     def _ofs_from_idx(self, idx):
         if idx >= self.nsha or idx < 0:
             raise IndexError('invalid pack index index %d' % idx)
@@ -438,6 +644,7 @@ class PackIdxV2(PackIdx):
         self.fanout.append(0)
         self.nsha = self.fanout[255]
         self.sha_ofs = 8 + 256*4
+        self._sha_skip, self._sha_stride = 0, 20
         self.ofstable_ofs = self.sha_ofs + self.nsha * 20 + self.nsha * 4
         self.ofs64table_ofs = self.ofstable_ofs + self.nsha * 4
         # Avoid slicing this for individual hashes (very high overhead)
@@ -446,6 +653,9 @@ class PackIdxV2(PackIdx):
     def __len__(self):
         return int(self.nsha)  # int() from long for python 2
 
+    def _ofs_table(self):
+        return self.ofstable_ofs, 4, self.ofs64table_ofs
+
     def _ofs_from_idx(self, idx):
         if idx >= self.nsha or idx < 0:
             raise IndexError('invalid pack index index %d' % idx)
@@ -457,6 +667,12 @@ class PackIdxV2(PackIdx):
             ofs = struct.unpack_from('!Q', self.map, offset=ofs64_ofs)[0]
         return ofs
 
+    def _crc_from_idx(self, idx):
+        if idx >= self.nsha or idx < 0:
+            raise IndexError('invalid pack index index %d' % idx)
+        ofs = self.sha_ofs + self.nsha * 20 + idx * 4
+        return struct.unpack_from('!I', self.map, offset=ofs)[0]
+
     def _idx_to_hash(self, idx):
         if idx >= self.nsha or idx < 0:
             raise IndexError('invalid pack index index %d' % idx)
@@ -469,25 +685,18 @@ class PackIdxV2(PackIdx):
             yield self.map[ofs : ofs + 20]
 
 
-_mpi_count = 0
 class PackIdxList:
     def __init__(self, dir, ignore_midx=False):
-        global _mpi_count
-        assert(_mpi_count == 0) # these things suck tons of VM; don't waste it
-        _mpi_count += 1
         self.dir = dir
         self.also = set()
         self.packs = []
         self.do_bloom = False
         self.bloom = None
+        self.locmap = None
         self.ignore_midx = ignore_midx
+        self._midx_subs = {}  # idxs opened by locate() for a midx
         self.refresh()
 
-    def __del__(self):
-        global _mpi_count
-        _mpi_count -= 1
-        assert(_mpi_count == 0)
-
     def __iter__(self):
         return iter(idxmerge(self.packs))
 
@@ -512,11 +721,42 @@ class PackIdxList:
             ix = p.exists(hash, want_source=want_source)
             if ix:
                 # reorder so most recently used packs are searched first
-                self.packs = [p] + self.packs[:i] + self.packs[i+1:]
+                if i:
+                    del self.packs[i]
+                    self.packs.insert(0, p)
                 return ix
         self.do_bloom = True
         return None
 
+    def exists_many(self, hashes):
+        """Return a list containing a true value for each of the hashes
+        that exists in the index files, and a false value for the
+        others.
+
+        The hashes are sorted and then resolved via a single merged
+        pass over each index, which is much less expensive than
+        calling exists() for each of them.
+        """
+        global _total_searches
+        _total_searches += len(hashes)
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        batch = b''.join(hashes[i] for i in order)
+        found = bytearray(len(hashes))
+        remaining = len(hashes)
+        if self.also:
+            for pos, i in enumerate(order):
+                if hashes[i] in self.also:
+                    found[pos] = 1
+                    remaining -= 1
+        for p in self.packs:
+            if not remaining:
+                break
+            remaining -= p._find_many(batch, found)
+        result = [False] * len(hashes)
+        for pos, i in enumerate(order):
+            result[i] = bool(found[pos])
+        return result
+
     def refresh(self, skip_midx = False):
         """Refresh the index list.
         This method verifies if .midx files were superseded (e.g. all of its
@@ -533,11 +773,46 @@ class PackIdxList:
             self.bloom.close()
         self.bloom = None # Always reopen the bloom as it may have been relaced
         self.do_bloom = False
+        # Likewise the locmap, which may have been rebuilt.
+        if self.locmap is not None:
+            self.locmap.close()
+        self.locmap = None
+        self._midx_subs = {}
         skip_midx = skip_midx or self.ignore_midx
         d = dict((p.name, p) for p in self.packs
-                 if not skip_midx or not isinstance(p, midx.PackMidx))
+                 if not isinstance(p, locmap.LocMap)
+                 and (not skip_midx or not isinstance(p, midx.PackMidx)))
         if os.path.exists(self.dir):
+            covered = frozenset()
+            idxfiles = glob.glob(os.path.join(self.dir, b'*.idx'))
+            # Forget any idx that's been removed (e.g. by gc), and any
+            # midx that refers to one (cf. the broken check below).
+            present = frozenset(os.path.basename(n) for n in idxfiles)
+            for name, ix in list(d.items()):
+                if isinstance(ix, PackIdx):
+                    if os.path.basename(name) not in present:
+                        del d[name]
+                elif not present.issuperset(ix.idxnames):
+                    del d[name]
+                    if ix in self.packs:
+                        self.packs.remove(ix)
+                        ix.close()
             if not skip_midx:
+                self.locmap = open_locmap(self.dir)
+                if self.locmap:
+                    covered = frozenset(self.locmap.idxnames)
+                    if covered.issuperset(os.path.basename(n)
+                                          for n in idxfiles):
+                        # The locmap has everything, so there's no
+                        # need to open (or even look at) any (m)idx,
+                        # or the bloom, which couldn't make a lookup
+                        # any cheaper.
+                        for ix in d.values():
+                            if isinstance(ix, midx.PackMidx):
+                                ix.close()
+                        self.packs = [self.locmap]
+                        debug1('PackIdxList: using the locmap.\n')
+                        return
                 midxl = []
                 midxes = set(glob.glob(os.path.join(self.dir, b'*.midx')))
                 # remove any *.midx files from our list that no longer exist
@@ -590,8 +865,8 @@ class PackIdxList:
                                % path_msg(os.path.basename(ix.name)))
                         ix.close()
                         unlink(ix.name)
-            for full in glob.glob(os.path.join(self.dir, b'*.idx')):
-                if not d.get(full):
+            for full in idxfiles:
+                if not d.get(full) and os.path.basename(full) not in covered:
                     try:
                         ix = open_idx(full)
                     except GitError as e:
@@ -602,6 +877,12 @@ class PackIdxList:
             if self.bloom is None and os.path.exists(bfull):
                 self.bloom = bloom.ShaBloom(bfull)
             self.packs = list(set(d.values()))
+            if self.locmap:
+                # Don't bother with any (m)idx the locmap covers.
+                self.packs = [p for p in self.packs
+                              if not covered.issuperset(os.path.basename(n)
+                                                        for n in p.idxnames)]
+                self.packs.append(self.locmap)
             self.packs.sort(reverse=True, key=lambda x: len(x))
             if self.bloom and self.bloom.valid() and len(self.bloom) >= len(self):
                 self.do_bloom = True
@@ -610,11 +891,374 @@ class PackIdxList:
         debug1('PackIdxList: using %d index%s.\n'
             % (len(self.packs), len(self.packs)!=1 and 'es' or ''))
 
+    def locate(self, hash):
+        """Return (idxname, offset) for the object if it's in one of the
+        indexes (idxname being the basename of the relevant .idx), or
+        None if it isn't.  Unlike exists(), ignore the "also" set."""
+        if self.bloom and not self.bloom.exists(hash):
+            return None
+        for p in self.packs:
+            if isinstance(p, locmap.LocMap):
+                loc = p.locate(hash)
+                if loc:
+                    return loc
+                continue
+            if isinstance(p, midx.PackMidx):
+                name = p.exists(hash, want_source=True)
+                if not name:
+                    continue
+                ix = self._midx_subs.get(name)
+                if not ix:
+                    ix = open_idx(os.path.join(self.dir, name))
+                    self._midx_subs[name] = ix
+                return name, ix.find_offset(hash)
+            ofs = p.find_offset(hash)
+            if ofs is not None:
+                return os.path.basename(p.name), ofs
+        return None
+
     def add(self, hash):
         """Insert an additional object in the list."""
         self.also.add(hash)
 
 
+def open_locmap(dir):
+    """Return the LocMap for dir if there is a usable one, else None."""
+    name = os.path.join(dir, b'bup.locmap')
+    if not os.path.exists(name):
+        return None
+    lm = locmap.LocMap(name)
+    if not lm.valid():
+        lm.close()
+        return None
+    for n in lm.idxnames:
+        if not os.path.exists(os.path.join(dir, n)):
+            debug1('locmap: ignoring stale map (index %s missing)\n'
+                   % path_msg(n))
+            lm.close()
+            return None
+    return lm
+
+
+def update_locmap(dir, create=False):
+    """Add any .idx files in dir that aren't covered by its location map
+    (bup.locmap) to the map, rebuilding the map if it's stale or too
+    full.  Do nothing if there isn't a map, unless create is true."""
+    name = os.path.join(dir, b'bup.locmap')
+    if not create and not os.path.exists(name):
+        return
+    with locmap.lock(dir):
+        idxnames = set(os.path.basename(n)
+                       for n in glob.glob(os.path.join(dir, b'*.idx')))
+        if os.path.exists(name):
+            lm = locmap.LocMap(name, readwrite=True)
+            if lm.valid() and idxnames.issuperset(lm.idxnames):
+                new = [open_idx(os.path.join(dir, n))
+                       for n in sorted(idxnames.difference(lm.idxnames))]
+                if lm.has_room(sum(len(ix) for ix in new)):
+                    for ix in new:
+                        debug1('locmap: adding %s\n'
+                               % path_msg(os.path.basename(ix.name)))
+                        lm.add_idx(ix)
+                    lm.close()
+                    return
+            lm.close()
+        idxes = [open_idx(os.path.join(dir, n)) for n in sorted(idxnames)]
+        locmap.create(name, idxes)
+
+
+def idx_count(filename):
+    """Return the number of objects in the .idx file filename, which is
+    read from its fanout table, without mapping (or checking) the rest
+    of the file."""
+    with open(filename, 'rb') as f:
+        header = f.read(8)
+        fanout_ofs = 8 if header[0:4] == b'\377tOc' else 0
+        f.seek(fanout_ofs + 255 * 4)
+        last = f.read(4)
+    if len(last) != 4:
+        raise GitError('%s: truncated index' % path_msg(filename))
+    return struct.unpack('!I', last)[0]
+
+
+SHA_PER_PAGE = 4096 / 20.
+
+def write_midx(outdir, outfilename, infilenames, prefixstr=b'',
+               auto=False, force=False):
+    """Merge the .idx/.midx files infilenames into a new .midx (named
+    outfilename, or by default, after the inputs, in outdir), and
+    return (object count, midx name), or None if auto or force says
+    there's nothing worth doing."""
+    if not outfilename:
+        assert(outdir)
+        sum = hexlify(Sha1(b'\0'.join(infilenames)).digest())
+        outfilename = b'%s/midx-%s.midx' % (outdir, sum)
+
+    inp = []
+    total = 0
+    allfilenames = []
+    midxs = []
+    try:
+        for name in infilenames:
+            ix = open_idx(name)
+            midxs.append(ix)
+            inp.append((
+                ix.map,
+                len(ix),
+                ix.sha_ofs,
+                isinstance(ix, midx.PackMidx) and ix.which_ofs or 0,
+                len(allfilenames),
+            ))
+            for n in ix.idxnames:
+                allfilenames.append(os.path.basename(n))
+            total += len(ix)
+        inp.sort(reverse=True, key=lambda x: x[0][x[2] : x[2] + 20])
+
+        debug1('midx: %screating from %d files (%d objects).\n'
+               % (path_msg(prefixstr), len(infilenames), total))
+        if (auto and (total < 1024 and len(infilenames) < 3)) \
+           or ((auto or force) and len(infilenames) < 2) \
+           or (force and not total):
+            debug1('midx: nothing to do.\n')
+            return None
+
+        pages = int(total/SHA_PER_PAGE) or 1
+        bits = int(math.ceil(math.log(pages, 2)))
+        entries = 2**bits
+        debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
+
+        unlink(outfilename)
+        with atomically_replaced_file(outfilename, 'wb') as f:
+            f.write(b'MIDX')
+            f.write(struct.pack('!II', midx.MIDX_VERSION, bits))
+            assert(f.tell() == 12)
+
+            f.truncate(12 + 4*entries + 20*total + 4*total)
+            f.flush()
+            fdatasync(f.fileno())
+
+            fmap = mmap_readwrite(f, close=False)
+            count = _helpers.merge_into(fmap, bits, total, inp)
+            del fmap # Assume this calls msync() now.
+            f.seek(0, os.SEEK_END)
+            f.write(b'\0'.join(allfilenames))
+    finally:
+        for ix in midxs:
+            if isinstance(ix, midx.PackMidx):
+                ix.close()
+        midxs = None
+        inp = None
+
+    return total, outfilename
+
+
+def max_midx_files():
+    """Return the number of files a midx merge may open at once."""
+    mf = min(resource.getrlimit(resource.RLIMIT_NOFILE))
+    if mf > 32:
+        mf -= 20  # just a safety margin
+    else:
+        mf -= 6   # minimum safety margin
+    return mf
+
+
+def _midx_group(outdir, outfilename, infiles, max_files, auto, force,
+                stats):
+    groups = [infiles[i : i + max_files]
+              for i in range(0, len(infiles), max_files)]
+    gprefix = b''
+    for n, sublist in enumerate(groups):
+        if len(groups) != 1:
+            gprefix = b'Group %d: ' % (n + 1)
+        rv = write_midx(outdir, outfilename, sublist, gprefix,
+                        auto=auto, force=force)
+        if rv:
+            if stats is not None:
+                stats['merges'] = stats.get('merges', 0) + 1
+                stats['objects'] = stats.get('objects', 0) + rv[0]
+                stats['bytes'] = (stats.get('bytes', 0)
+                                  + os.path.getsize(rv[1]))
+            yield rv
+
+
+# The automatic (--auto) midx policy is size tiered: a file with n
+# objects is in tier floor(log_F(n / MIDX_TIER_BASE)) (or tier 0 if
+# it's smaller than that), and whenever any tier has F
+# (MIDX_TIER_FACTOR) files, they're merged into one, which normally
+# lands in the next tier up.  So each object is rewritten at most once
+# per tier (i.e. about log_F(total / MIDX_TIER_BASE) times in all), and
+# a lookup never has to consult more than F - 1 files per tier.
+MIDX_TIER_FACTOR = 4
+MIDX_TIER_BASE = 1024
+
+def midx_tier(count):
+    """Return the tier of a .idx/.midx with count objects."""
+    tier = 0
+    limit = MIDX_TIER_BASE * MIDX_TIER_FACTOR
+    while count >= limit:
+        tier += 1
+        limit *= MIDX_TIER_FACTOR
+    return tier
+
+
+def update_midxes(dir, outfilename=None, auto=False, force=False,
+                  max_files=None, stats=None):
+    """Merge the .idx/.midx files in dir according to the tiered policy
+    (or with force, into just one), removing any redundant .midx files
+    along the way, and return the names of the new files.  If stats is
+    a dict, add the number of 'merges' and the 'objects' and 'bytes'
+    written to it."""
+    max_files = max_files or max_midx_files()
+    already = {}
+    sizes = {}
+    if force and not auto:
+        midxs = []   # don't use existing midx files
+    else:
+        midxs = glob.glob(b'%s/*.midx' % dir)
+        contents = {}
+        for mname in midxs:
+            m = open_idx(mname)
+            contents[mname] = [(b'%s/%s' % (dir, i)) for i in m.idxnames]
+            sizes[mname] = len(m)
+            m.close()
+
+        # sort the biggest+newest midxes first, so that we can eliminate
+        # smaller (or older) redundant ones that come later in the list
+        midxs.sort(key=lambda ix: (-sizes[ix], -xstat.stat(ix).st_mtime))
+
+        for mname in midxs:
+            any = 0
+            for iname in contents[mname]:
+                if not already.get(iname):
+                    already[iname] = 1
+                    any = 1
+            if not any:
+                debug1('%r is redundant\n' % mname)
+                unlink(mname)
+                already[mname] = 1
+
+    midxs = [k for k in midxs if not already.get(k)]
+    idxs = [k for k in glob.glob(b'%s/*.idx' % dir) if not already.get(k)]
+
+    for iname in idxs:
+        sizes[iname] = idx_count(iname)
+
+    all = [(sizes[n],n) for n in (midxs + idxs)]
+    existed = dict((name,1) for sz,name in all)
+    if force:
+        while len(all) > 1:
+            all = list(_midx_group(dir, outfilename,
+                                   [name for sz, name in sorted(all)],
+                                   max_files, auto, force, stats))
+    else:
+        while True:
+            tiers = {}
+            for sz, name in all:
+                tiers.setdefault(midx_tier(sz), []).append((sz, name))
+            full = [t for t in sorted(tiers)
+                    if len(tiers[t]) >= MIDX_TIER_FACTOR]
+            if not full:
+                debug1('midx: %d indexes in %d tiers; nothing to do.\n'
+                       % (len(all), len(tiers)))
+                break
+            merge = sorted(tiers[full[0]])
+            debug1('midx: merging the %d indexes in tier %d\n'
+                   % (len(merge), full[0]))
+            merged = list(_midx_group(dir, outfilename,
+                                      [name for sz, name in merge],
+                                      max_files, auto, force, stats))
+            all = [x for x in all if x not in merge] + merged
+
+    return [name for sz, name in all if not existed.get(name)]
+
+
+def update_bloom(dir, outfilename=None, k=None, force=False):
+    """Add the objects in any .idx files in dir that aren't covered by
+    its bloom filter (bup.bloom, or outfilename) to the filter,
+    regenerating it from scratch if it's invalid, too full, or force
+    is true."""
+    assert k is None or 1 <= k <= bloom.BLOOM3_K
+    outfilename = outfilename or os.path.join(dir, b'bup.bloom')
+    b = None
+    if os.path.exists(outfilename) and not force:
+        b = bloom.ShaBloom(outfilename)
+        if not b.valid():
+            debug1("bloom: Existing invalid bloom found, regenerating.\n")
+            b = None
+        elif b.version != bloom.BLOOM_VERSION:
+            # Keep adding to it; it'll be converted when it has to be
+            # regenerated (or via bup bloom -f).
+            debug1("bloom: existing filter is version %d\n" % b.version)
+
+    # Only the new indexes have to be opened; the sizes of the others
+    # (to check the filter's count) are in their fanout tables.
+    add = []
+    rest = []
+    add_count = 0
+    rest_count = 0
+    for i, name in enumerate(glob.glob(b'%s/*.idx' % dir)):
+        progress('bloom: counting: %d\r' % i)
+        ixbase = os.path.basename(name)
+        if b and (ixbase in b.idxnames):
+            rest.append(name)
+            rest_count += idx_count(name)
+        else:
+            add.append(name)
+            add_count += idx_count(name)
+
+    if not add:
+        debug1("bloom: nothing to do.\n")
+        return
+
+    if b:
+        if len(b) != rest_count:
+            debug1("bloom: size %d != idx total %d, regenerating\n"
+                   % (len(b), rest_count))
+            b = None
+        elif k is not None and k != b.k:
+            debug1("bloom: new k %d != existing k %d, regenerating\n"
+                   % (k, b.k))
+            b = None
+        elif (b.bits < b.max_bits() and
+              b.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE):
+            debug1("bloom: regenerating: adding %d entries gives "
+                   "%.2f%% false positives.\n"
+                   % (add_count, b.pfalse_positive(add_count)))
+            b = None
+        else:
+            b = bloom.ShaBloom(outfilename, readwrite=True, expected=add_count)
+    if not b: # Need all idxs to build from scratch
+        add += rest
+        add_count += rest_count
+    del rest
+    del rest_count
+
+    msg = b is None and 'creating from' or 'adding'
+    progress('bloom: %s %d file%s (%d object%s).\r'
+        % (msg,
+           len(add), len(add)!=1 and 's' or '',
+           add_count, add_count!=1 and 's' or ''))
+
+    tfname = None
+    if b is None:
+        tfname = os.path.join(dir, b'bup.tmp.bloom')
+        b = bloom.create(tfname, expected=add_count, k=k)
+    icount = 0
+    for name in add:
+        ix = open_idx(name)
+        qprogress('bloom: writing %.2f%% (%d/%d objects)\r'
+                  % (icount*100.0/add_count, icount, add_count))
+        b.add_idx(ix)
+        icount += len(ix)
+
+    # Currently, there's an open file object for tfname inside b.
+    # Make sure it's closed before rename.
+    b.close()
+
+    if tfname:
+        os.rename(tfname, outfilename)
+
+
 def open_idx(filename):
     if filename.endswith(b'.idx'):
         f = open(filename, 'rb')
@@ -652,6 +1296,9 @@ def idxmerge(idxlist, final_progress=True):
 def _make_objcache():
     return PackIdxList(repo(b'objects/pack'))
 
+# How many blobs new_blobs() allows to be in flight per worker.
+_blobs_per_job = 4
+
 # bup-gc assumes that it can disable all PackWriter activities
 # (bloom/midx/cache) via the constructor and close() arguments.
 
@@ -659,7 +1306,8 @@ class PackWriter:
     """Writes Git objects inside a pack file."""
     def __init__(self, objcache_maker=_make_objcache, compression_level=1,
                  run_midx=True, on_pack_finish=None,
-                 max_pack_size=None, max_pack_objects=None, repo_dir=None):
+                 max_pack_size=None, max_pack_objects=None, repo_dir=None,
+                 jobs=1):
         self.repo_dir = repo_dir or repo()
         self.file = None
         self.parentfd = None
@@ -672,6 +1320,8 @@ class PackWriter:
         self.compression_level = compression_level
         self.run_midx=run_midx
         self.on_pack_finish = on_pack_finish
+        self.jobs = jobs or 1
+        self._pool = None
         if not max_pack_size:
             max_pack_size = git_config_get(b'pack.packSizeLimit',
                                            repo_dir=self.repo_dir)
@@ -742,13 +1392,16 @@ class PackWriter:
                                                self.file.tell() - size))
 
     def _write(self, sha, type, content):
-        if verbose:
-            log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        return self._write_encoded(sha,
+                                   _encode_packobj(type, content,
+                                                   self.compression_level))
+
+    def _write_encoded(self, sha, datalist):
+        if verbose:
+            log('>')
+        size, crc = self._raw_write(datalist, sha=sha)
         if self.outbytes >= self.max_pack_size \
            or self.count >= self.max_pack_objects:
             self.breakpoint()
@@ -772,6 +1425,12 @@ class PackWriter:
         self._require_objcache()
         return self.objcache.exists(id, want_source=want_source)
 
+    def exists_many(self, ids):
+        """Return a list with a true value for each of the ids found in
+        the object cache (cf. PackIdxList.exists_many())."""
+        self._require_objcache()
+        return self.objcache.exists_many(ids)
+
     def just_write(self, sha, type, content):
         """Write an object to the pack file without checking for duplication."""
         self._write(sha, type, content)
@@ -779,6 +1438,14 @@ class PackWriter:
         if self.objcache is not None:
             self.objcache.add(sha)
 
+    def just_write_raw(self, sha, record):
+        """Write a complete pack record (as returned by CatPipe.get_raw())
+        for the object sha to the pack file without checking for
+        duplication."""
+        self._write_encoded(sha, (record,))
+        if self.objcache is not None:
+            self.objcache.add(sha)
+
     def maybe_write(self, type, content):
         """Write an object to the pack file if not present and return its id."""
         sha = calc_hash(type, content)
@@ -791,6 +1458,76 @@ class PackWriter:
         """Create a blob object in the pack with the supplied content."""
         return self.maybe_write(b'blob', blob)
 
+    def _missing_blobs(self, shas):
+        """Return a list with a true value for each of the shas that
+        has to be written, i.e. that isn't already present, and isn't
+        a duplicate of an earlier one in the list."""
+        result = []
+        seen = set()
+        for sha, present in zip(shas, self.exists_many(shas)):
+            result.append(not present and sha not in seen)
+            seen.add(sha)
+        return result
+
+    def _write_encoded_blobs(self, encoded_blobs):
+        """Write the (sha, encoded) blobs (cf. _missing_blobs()), in
+        order."""
+        for sha, encoded in encoded_blobs:
+            self._write_encoded(sha, (encoded,))
+            if self.objcache is not None:
+                self.objcache.add(sha)
+
+    def new_blobs(self, items):
+        """Create a blob for the content of each (blob, info) pair in items,
+        and yield the corresponding (blob_id, info) pairs in order.
+
+        When the writer has more than one job, the hashing is handed
+        to a pool of worker threads, and then, once a batch has been
+        checked (all at once), so is the compression of the blobs that
+        are actually missing, which are still written here, in the
+        original order, so the pack is the same as the one produced by
+        calling new_blob() for each item.
+        """
+        if self.jobs < 2:
+            for blob, info in items:
+                yield self.new_blob(blob), info
+            return
+        if not self._pool:
+            self._pool = ThreadPool(self.jobs)
+        pool = self._pool
+        max_pending = self.jobs * _blobs_per_job
+        batch_size = max(1, max_pending // 2)
+        pending = deque()
+        def finish_batch():
+            batch = [pending.popleft() for i in range(min(batch_size,
+                                                          len(pending)))]
+            shas = [result.get() for result, blob, info in batch]
+            encoding = [(sha, pool.apply_async(_encode_blob,
+                                               (blob, self.compression_level)))
+                        for sha, missing, (result, blob, info)
+                        in zip(shas, self._missing_blobs(shas), batch)
+                        if missing]
+            self._write_encoded_blobs([(sha, result.get())
+                                       for sha, result in encoding])
+            return [(sha, info) for sha, (result, blob, info)
+                    in zip(shas, batch)]
+        for blob, info in items:
+            pending.append((pool.apply_async(calc_hash, (b'blob', blob)),
+                            blob, info))
+            if len(pending) >= max_pending:
+                for x in finish_batch():
+                    yield x
+        while pending:
+            for x in finish_batch():
+                yield x
+
+    def _close_pool(self):
+        pool = self._pool
+        if pool:
+            self._pool = None
+            pool.close()
+            pool.join()
+
     def new_tree(self, shalist):
         """Create a tree object in the pack."""
         content = tree_encode(shalist)
@@ -821,6 +1558,7 @@ class PackWriter:
 
     def abort(self):
         """Remove the pack file from disk."""
+        self._close_pool()
         f = self.file
         if f:
             pfd = self.parentfd
@@ -850,13 +1588,19 @@ class PackWriter:
             cp = struct.pack('!i', self.count)
             assert(len(cp) == 4)
             f.write(cp)
-
-            # calculate the pack sha1sum
-            f.seek(0)
-            sum = Sha1()
-            for b in chunkyreader(f):
-                sum.update(b)
-            packbin = sum.digest()
+            f.flush()
+
+            # Calculate the pack sha1sum.  Since the sha1 starts with
+            # the header, which includes the final object count, it
+            # can't be computed while writing, but hashing the
+            # (normally still cached) pages via mmap avoids copying
+            # the whole pack through python read buffers.
+            pack_map = mmap_read(f, close=False)
+            try:
+                packbin = Sha1(pack_map).digest()
+            finally:
+                pack_map.close()
+            f.seek(0, os.SEEK_END)
             f.write(packbin)
             fdatasync(f.fileno())
         finally:
@@ -875,6 +1619,7 @@ class PackWriter:
         finally:
             os.close(self.parentfd)
 
+        update_locmap(os.path.join(self.repo_dir, b'objects/pack'))
         if run_midx:
             auto_midx(os.path.join(self.repo_dir, b'objects/pack'))
 
@@ -885,53 +1630,51 @@ class PackWriter:
 
     def close(self, run_midx=True):
         """Close the pack file and move it to its definitive path."""
+        self._close_pool()
         return self._end(run_midx=run_midx)
 
     def _write_pack_idx_v2(self, filename, idx, packbin):
-        ofs64_count = 0
-        for section in idx:
-            for entry in section:
-                if entry[2] >= 2**31:
-                    ofs64_count += 1
-
-        # Length: header + fan-out + shas-and-crcs + overflow-offsets
-        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
-        idx_map = None
-        idx_f = open(filename, 'w+b')
-        try:
-            idx_f.truncate(index_len)
-            fdatasync(idx_f.fileno())
-            idx_map = mmap_readwrite(idx_f, close=False)
-            try:
-                count = _helpers.write_idx(filename, idx_map, idx, self.count)
-                assert(count == self.count)
-                idx_map.flush()
-            finally:
-                idx_map.close()
-        finally:
-            idx_f.close()
-
-        idx_f = open(filename, 'a+b')
+        return write_pack_idx_v2(filename, idx, self.count, packbin)
+
+
+def write_pack_idx_v2(filename, idx, count, packbin):
+    """Write a v2 idx for the count objects in idx (256 lists of (sha,
+    crc, ofs), one per first sha byte) and the pack whose sha is
+    packbin to filename, and return the hex sha of the sorted object
+    ids (i.e. the pack's name)."""
+    ofs64_count = 0
+    for section in idx:
+        for entry in section:
+            if entry[2] >= 2**31:
+                ofs64_count += 1
+
+    # Length: header + fan-out + shas-and-crcs + overflow-offsets
+    index_len = 8 + (4 * 256) + (28 * count) + (8 * ofs64_count)
+    sha_ofs = 8 + (4 * 256)
+    idx_map = None
+    idx_f = open(filename, 'w+b')
+    try:
+        # Leave room for the pack and idx checksums, so that the
+        # whole idx, trailer included, is produced from the map
+        # without reading any of it back from the file.
+        idx_f.truncate(index_len + 40)
+        fdatasync(idx_f.fileno())
+        idx_map = mmap_readwrite(idx_f, close=False)
         try:
-            idx_f.write(packbin)
-            idx_f.seek(0)
-            idx_sum = Sha1()
-            b = idx_f.read(8 + 4*256)
-            idx_sum.update(b)
-
-            obj_list_sum = Sha1()
-            for b in chunkyreader(idx_f, 20*self.count):
-                idx_sum.update(b)
-                obj_list_sum.update(b)
+            written = _helpers.write_idx(filename, idx_map, idx, count)
+            assert(written == count)
+            idx_map[index_len : index_len + 20] = packbin
+            obj_list_sum = Sha1(buffer(idx_map, sha_ofs, 20 * count))
             namebase = hexlify(obj_list_sum.digest())
-
-            for b in chunkyreader(idx_f):
-                idx_sum.update(b)
-            idx_f.write(idx_sum.digest())
-            fdatasync(idx_f.fileno())
-            return namebase
+            idx_sum = Sha1(buffer(idx_map, 0, index_len + 20))
+            idx_map[index_len + 20 : index_len + 40] = idx_sum.digest()
+            idx_map.flush()
         finally:
-            idx_f.close()
+            idx_map.close()
+        fdatasync(idx_f.fileno())
+        return namebase
+    finally:
+        idx_f.close()
 
 
 def list_refs(patterns=None, repo_dir=None,
@@ -1197,8 +1940,16 @@ class _AbortableIter:
         self.abort()
 
 
+_oidx_rx = re.compile(br'^[0-9a-f]{40}$')
+
 class CatPipe:
-    """Link to 'git cat-file' that is used to retrieve blob data."""
+    """Retrieves objects from a repository.
+
+    Objects named by their (hex) id are read directly from the
+    repository's packs when possible, and everything else (refs, other
+    revision expressions, loose objects, and missing objects) is
+    handled via a 'git cat-file --batch' subprocess.
+    """
     def __init__(self, repo_dir = None):
         self.repo_dir = repo_dir
         wanted = (1, 5, 6)
@@ -1206,6 +1957,10 @@ class CatPipe:
             log('error: git version must be at least 1.5.6\n')
             sys.exit(1)
         self.p = self.inprogress = None
+        self._idxlist = None
+        self._packdir_key = None
+        self._packmaps = {}
+        self._packidxes = {}
 
     def _abort(self):
         if self.p:
@@ -1214,6 +1969,19 @@ class CatPipe:
         self.p = None
         self.inprogress = None
 
+    def close(self):
+        """Stop the subprocess (if any) and release the packs and
+        indexes.  The pipe may still be used afterward."""
+        p = self.p
+        self._abort()
+        if p:
+            p.wait()
+        for m in self._packmaps.values():
+            m.close()
+        self._packmaps.clear()
+        self._packidxes.clear()
+        self._idxlist = self._packdir_key = None
+
     def restart(self):
         self._abort()
         self.p = subprocess.Popen([b'git', b'cat-file', b'--batch'],
@@ -1223,11 +1991,157 @@ class CatPipe:
                                   bufsize = 4096,
                                   env=_gitenv(self.repo_dir))
 
+    def _packmap(self, idxname):
+        m = self._packmaps.get(idxname)
+        if m is None:
+            packdir = repo(b'objects/pack', repo_dir=self.repo_dir)
+            with open(os.path.join(packdir, idxname[:-4] + b'.pack'),
+                      'rb') as f:
+                m = mmap_read(f, close=False)
+            self._packmaps[idxname] = m
+        return m
+
+    def _packdir_changed(self, packdir):
+        """Return true if packdir may have changed since the last call
+        that returned true.  A directory modified within the last
+        couple of seconds is assumed to have (possibly) changed again,
+        since the timestamps are coarse."""
+        st = os.stat(packdir)
+        key = (st.st_ino, st.st_mtime, st.st_ctime, st.st_size)
+        if key == self._packdir_key:
+            return False
+        if time.time() - st.st_mtime < 2:
+            key = None
+        self._packdir_key = key
+        return True
+
+    def _locate_idx(self, oid):
+        """Return (idxname, offset) for the object, or None if it's not
+        in any of the packs."""
+        packdir = repo(b'objects/pack', repo_dir=self.repo_dir)
+        if self._idxlist is None:
+            self._packdir_changed(packdir)
+            self._idxlist = PackIdxList(packdir)
+            return self._idxlist.locate(oid)
+        loc = self._idxlist.locate(oid)
+        # Packs may have been added since we last looked, but there's
+        # no need to look again (for a loose object, say) if the pack
+        # directory hasn't changed.
+        if not loc and self._packdir_changed(packdir):
+            self._idxlist.refresh()
+            loc = self._idxlist.locate(oid)
+        return loc
+
+    def _locate_packed(self, oid, want_idx=False):
+        """Return (pack_map, idx, offset) for the object, or None if it's
+        not in any of the packs.  The idx (a PackIdx) is None unless
+        want_idx is true."""
+        loc = self._locate_idx(oid)
+        if not loc:
+            return None
+        try:
+            return (self._packmap(loc[0]),
+                    self._packidx(loc[0]) if want_idx else None,
+                    loc[1])
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        # The pack has been removed (e.g. by gc) since the indexes were
+        # read, so look again.
+        m = self._packmaps.pop(loc[0], None)
+        if m is not None:
+            m.close()
+        self._packidxes.pop(loc[0], None)
+        self._idxlist.refresh()
+        loc = self._idxlist.locate(oid)
+        if not loc:
+            return None
+        return (self._packmap(loc[0]),
+                self._packidx(loc[0]) if want_idx else None,
+                loc[1])
+
+    def _locate(self, oid):
+        """Return (pack_map, offset) for the object, or None if it's not
+        in any of the packs."""
+        loc = self._locate_packed(oid)
+        if not loc:
+            return None
+        return loc[0], loc[2]
+
+    def _packidx(self, idxname):
+        ix = self._packidxes.get(idxname)
+        if ix is None:
+            packdir = repo(b'objects/pack', repo_dir=self.repo_dir)
+            ix = open_idx(os.path.join(packdir, idxname))
+            self._packidxes[idxname] = ix
+        return ix
+
+    def get_raw(self, oidx, compression_level=None):
+        """Return (type, record) for the object named by oidx (hex) if
+        it's stored whole (i.e. not as a delta) in one of the packs,
+        otherwise None (cf. packed_record())."""
+        loc = self._locate_packed(unhexlify(oidx), want_idx=True)
+        if not loc:
+            return None
+        m, ix, ofs = loc
+        return packed_record(m, ix, ofs, compression_level=compression_level)
+
+    def _read_packed(self, m, ofs):
+        """Return (type, size, data) for the packed object at offset ofs
+        in the pack map m, where data is an iterator for the object's
+        content.  Resolve any deltas."""
+        typ, sz, data_ofs = _packobj_header(m, ofs)
+        if typ not in (_ofs_delta_type, _ref_delta_type):
+            if typ not in _typermap:
+                raise GitError('unexpected pack object type %d' % typ)
+            return _typermap[typ], sz, _inflate_packobj(m, data_ofs, sz)
+        # Collect the chain of deltas down to the base object, and then
+        # apply them in reverse.
+        deltas = []
+        while typ in (_ofs_delta_type, _ref_delta_type):
+            if typ == _ofs_delta_type:
+                c = byte_int(m[data_ofs])
+                data_ofs += 1
+                rel = c & 0x7f
+                while c & 0x80:
+                    c = byte_int(m[data_ofs])
+                    data_ofs += 1
+                    rel = ((rel + 1) << 7) | (c & 0x7f)
+                deltas.append(b''.join(_inflate_packobj(m, data_ofs, sz)))
+                ofs -= rel
+            else:
+                base_oid = m[data_ofs : data_ofs + 20]
+                deltas.append(b''.join(_inflate_packobj(m, data_ofs + 20, sz)))
+                loc = self._locate(base_oid)
+                if not loc:
+                    raise MissingObject(base_oid)
+                m, ofs = loc
+            typ, sz, data_ofs = _packobj_header(m, ofs)
+        if typ not in _typermap:
+            raise GitError('unexpected pack object type %d' % typ)
+        data = b''.join(_inflate_packobj(m, data_ofs, sz))
+        for delta in reversed(deltas):
+            data = _apply_delta(data, delta)
+        return _typermap[typ], len(data), iter((data,))
+
+    def _get_packed(self, oidx, loc):
+        typ, size, it = self._read_packed(*loc)
+        yield oidx, typ, size
+        for blob in it:
+            yield blob
+
     def get(self, ref):
         """Yield (oidx, type, size), followed by the data referred to by ref.
         If ref does not exist, only yield (None, None, None).
 
         """
+        if _oidx_rx.match(ref):
+            loc = self._locate(unhexlify(ref))
+            if loc:
+                return self._get_packed(ref, loc)
+        return self._get_via_pipe(ref)
+
+    def _get_via_pipe(self, ref):
         if not self.p or self.p.poll() != None:
             self.restart()
         assert(self.p)
@@ -1396,15 +2310,80 @@ def walk_object(get_ref, oidx, stop_at=None, include_data=None):
                             hashsplit.GIT_MODE_TREE))
         elif typ == b'tree':
             for mode, name, ent_id in tree_decode(data):
-                demangled, bup_type = demangle_name(name, mode)
-                if chunk_path:
-                    sub_path = parent_path
-                    sub_chunk_path = chunk_path + [name]
-                else:
-                    sub_path = parent_path + [name]
-                    if bup_type == BUP_CHUNKED:
-                        sub_chunk_path = [b'']
-                    else:
-                        sub_chunk_path = chunk_path
+                sub_path, sub_chunk_path = _walk_sub_paths(parent_path,
+                                                           chunk_path,
+                                                           mode, name)
                 pending.append((hexlify(ent_id), sub_path, sub_chunk_path,
                                 mode))
+
+
+def _walk_sub_paths(parent_path, chunk_path, mode, name):
+    """Return the (path, chunk_path) for the tree entry name (cf. WalkItem)."""
+    if chunk_path:
+        return parent_path, chunk_path + [name]
+    demangled, bup_type = demangle_name(name, mode)
+    if bup_type == BUP_CHUNKED:
+        return parent_path + [name], [b'']
+    return parent_path + [name], chunk_path
+
+
+# How many objects walk_objects() asks get_many() for at a time.
+_walk_batch = 1024
+
+def walk_objects(get_many, oidxs, visited):
+    """Yield everything reachable from the oidxs (hex) as a WalkItem
+    (with no data), breadth first, reading the commits and trees via
+    get_many, which must behave like LocalRepo.cat_many(), up to
+    _walk_batch at a time.  The visited set must support "in" and
+    add(), and records the (binary) ids of the commits and trees that
+    have been reached, so that each one is read and yielded at most
+    once, even across calls that share the set.  Blobs are never read,
+    and are yielded whenever they're reached from a tree.  Throw
+    MissingObject if an object that must be read is missing.
+
+    """
+    pending = deque()
+    for oidx in oidxs:
+        oid = unhexlify(oidx)
+        if oid not in visited:
+            visited.add(oid)
+            pending.append((oidx, [], [], None))
+    while pending:
+        batch = [pending.popleft()
+                 for i in range(min(_walk_batch, len(pending)))]
+        for i, info in enumerate(get_many([x[0] for x in batch])):
+            oidx, parent_path, chunk_path, mode = batch[i]
+            get_oidx, typ, _, data = info
+            if not get_oidx:
+                raise MissingObject(unhexlify(oidx))
+            if typ not in (b'blob', b'commit', b'tree'):
+                raise Exception('unexpected repository object type %r' % typ)
+            yield WalkItem(oid=unhexlify(oidx), type=typ,
+                           chunk_path=chunk_path, path=parent_path,
+                           mode=mode, data=None)
+            if typ == b'commit':
+                commit_items = parse_commit(data)
+                for pid in commit_items.parents:
+                    oid = unhexlify(pid)
+                    if oid not in visited:
+                        visited.add(oid)
+                        pending.append((pid, parent_path, chunk_path, mode))
+                oid = unhexlify(commit_items.tree)
+                if oid not in visited:
+                    visited.add(oid)
+                    pending.append((commit_items.tree, parent_path, chunk_path,
+                                    hashsplit.GIT_MODE_TREE))
+            elif typ == b'tree':
+                for ent_mode, name, ent_id in tree_decode(data):
+                    sub_path, sub_chunk_path = _walk_sub_paths(parent_path,
+                                                               chunk_path,
+                                                               ent_mode, name)
+                    if not stat.S_ISDIR(ent_mode):
+                        yield WalkItem(oid=ent_id, type=b'blob',
+                                       chunk_path=sub_chunk_path,
+                                       path=sub_path, mode=ent_mode,
+                                       data=None)
+                    elif ent_id not in visited:
+                        visited.add(ent_id)
+                        pending.append((hexlify(ent_id), sub_path,
+                                        sub_chunk_path, ent_mode))
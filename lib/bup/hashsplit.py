@@ -183,15 +183,29 @@ def hashsplit_iter(files, keep_boundaries, progress):
         return _hashsplit_iter(files, progress)
 
 
+def _serial_makeblobs(makeblob):
+    return lambda items: ((makeblob(blob), info) for blob, info in items)
+
+
 total_split = 0
-def split_to_blobs(makeblob, files, keep_boundaries, progress):
+def split_to_blobs(makeblob, files, keep_boundaries, progress,
+                   makeblobs=None):
+    """Yield (sha, size, level) for each blob split from files.  If
+    makeblobs is provided, it will be handed an iterator of (blob,
+    info) pairs, and must yield the corresponding (sha, info) pairs in
+    the same order (cf. PackWriter.new_blobs()), otherwise makeblob
+    will be called for each blob.
+    """
     global total_split
-    for (blob, level) in hashsplit_iter(files, keep_boundaries, progress):
-        sha = makeblob(blob)
-        total_split += len(blob)
+    makeblobs = makeblobs or _serial_makeblobs(makeblob)
+    blobs = ((blob, (len(blob), level))
+             for blob, level in hashsplit_iter(files, keep_boundaries,
+                                               progress))
+    for sha, (size, level) in makeblobs(blobs):
+        total_split += size
         if progress_callback:
-            progress_callback(len(blob))
-        yield (sha, len(blob), level)
+            progress_callback(size)
+        yield (sha, size, level)
 
 
 def _make_shalist(l):
@@ -223,8 +237,9 @@ def _squish(maketree, stacks, n):
 
 
 def split_to_shalist(makeblob, maketree, files,
-                     keep_boundaries, progress=None):
-    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+                     keep_boundaries, progress=None, makeblobs=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress,
+                        makeblobs=makeblobs)
     assert(fanout != 0)
     if not fanout:
         shal = []
@@ -243,9 +258,10 @@ def split_to_shalist(makeblob, maketree, files,
 
 
 def split_to_blob_or_tree(makeblob, maketree, files,
-                          keep_boundaries, progress=None):
+                          keep_boundaries, progress=None, makeblobs=None):
     shalist = list(split_to_shalist(makeblob, maketree,
-                                    files, keep_boundaries, progress))
+                                    files, keep_boundaries, progress,
+                                    makeblobs=makeblobs))
     if len(shalist) == 1:
         return (shalist[0][0], shalist[0][2])
     elif len(shalist) == 0:
@@ -1,8 +1,43 @@
+"""Hard link database.
+
+The hard link database (e.g. bupindex.hlink) records the paths
+associated with each (dev, ino) node that has more than one link, and
+the node for each of those paths.  It's a single file containing two
+mmapped, open addressed hash tables, followed by a heap of path lists,
+so that it can be queried and updated in place without reading the
+whole thing.  The format (all integers are big endian) is:
+
+  header: 'BHLK' version(4) node_bits(4) path_bits(4)
+          node_used(8) path_used(8) garbage(8)
+  nodes:  2**node_bits slots of dev(8) ino(8) paths_ofs(8)
+  paths:  2**path_bits slots of sha(20) state(4) dev(8) ino(8)
+  heap:   path lists, each a length(4) and the NUL separated paths
+
+A node slot is empty if its paths_ofs is 0, and deleted if it's 1,
+otherwise paths_ofs is the position of the node's current path list in
+the file.  A path slot's sha is the SHA-1 of the path, and its state
+is 0 (empty), 1 (in use), or 2 (deleted).  The *_used counts include
+deleted slots, and garbage is the number of heap bytes that are no
+longer referenced.
+
+Changes are kept in memory until commit_save().  prepare_save()
+writes them to a journal (filename + '.tmp-journal'), and
+commit_save() renames that to filename + '.journal' before applying
+it, and only removes it afterward, so an interrupted commit is
+completed (the changes are idempotent) by whoever opens the database
+next.  When the tables become too full, or the heap is mostly garbage,
+the whole file is rewritten instead.
+
+Databases in the original (pickled dict) format are read as-is, and
+converted when they're next saved.
+"""
 
 from __future__ import absolute_import
-import errno, os, tempfile
+import errno, hashlib, os, struct
 
 from bup import compat
+from bup._helpers import extract_bits
+from bup.helpers import mmap_read, mmap_readwrite, unlink
 
 if compat.py_maj > 2:
     import pickle
@@ -10,18 +45,208 @@ else:
     import cPickle as pickle
 
 
+HLINKDB_VERSION = 1
+MAX_LOAD = 2.0 / 3
+MIN_BITS = 8
+
+_header = struct.Struct('!4sIIIQQQ')
+_node_slot = struct.Struct('!QQQ')
+_path_slot = struct.Struct('!20sIQQ')
+_heap_len = struct.Struct('!I')
+
+_EMPTY, _USED, _DELETED = 0, 1, 2
+
+
 class Error(Exception):
     pass
 
+
+def _node_sha(node):
+    return hashlib.sha1(struct.pack('!QQ', *node)).digest()
+
+def _path_sha(path):
+    return hashlib.sha1(path).digest()
+
+def _bits_for(count):
+    bits = MIN_BITS
+    while 2**bits * MAX_LOAD < count * 2:
+        bits += 1
+    return bits
+
+
+class _Tables:
+    """The tables and heap of an existing database file."""
+    def __init__(self, filename, readwrite=False):
+        self.map = self.file = None
+        self.readwrite = readwrite
+        self.file = open(filename, 'r+b' if readwrite else 'rb')
+        hdr = self.file.read(_header.size)
+        if len(hdr) < _header.size:
+            raise Error('%r is truncated' % filename)
+        magic, ver, self.node_bits, self.path_bits, \
+            self.node_used, self.path_used, self.garbage = _header.unpack(hdr)
+        if magic != b'BHLK' or ver != HLINKDB_VERSION:
+            raise Error('%r is not a supported hardlink database' % filename)
+        self.nodes_ofs = _header.size
+        self.paths_ofs = self.nodes_ofs + 2**self.node_bits * _node_slot.size
+        self.heap_ofs = self.paths_ofs + 2**self.path_bits * _path_slot.size
+        if readwrite:
+            self.map = mmap_readwrite(self.file, self.heap_ofs, close=False)
+        else:
+            self.map = mmap_read(self.file, self.heap_ofs, close=False)
+
+    def close(self):
+        if self.map is not None:
+            if self.readwrite:
+                self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def save_header(self):
+        _header.pack_into(self.map, 0, b'BHLK', HLINKDB_VERSION,
+                          self.node_bits, self.path_bits,
+                          self.node_used, self.path_used, self.garbage)
+
+    def _node_slot(self, node):
+        """Return (ofs, paths_ofs) for the node's slot if it's present,
+        otherwise (ofs, None) for the slot it should be added to."""
+        m = self.map
+        mask = 2**self.node_bits - 1
+        i = extract_bits(_node_sha(node), self.node_bits)
+        free = None
+        while True:
+            ofs = self.nodes_ofs + i * _node_slot.size
+            dev, ino, paths_ofs = _node_slot.unpack_from(m, ofs)
+            if not paths_ofs:
+                return (ofs if free is None else free), None
+            if paths_ofs == 1:
+                if free is None:
+                    free = ofs
+            elif (dev, ino) == node:
+                return ofs, paths_ofs
+            i = (i + 1) & mask
+
+    def _path_slot(self, sha):
+        """Return (ofs, node) for sha's slot if it's present, otherwise
+        (ofs, None) for the slot it should be added to."""
+        m = self.map
+        mask = 2**self.path_bits - 1
+        i = extract_bits(sha, self.path_bits)
+        free = None
+        while True:
+            ofs = self.paths_ofs + i * _path_slot.size
+            slot_sha, state, dev, ino = _path_slot.unpack_from(m, ofs)
+            if state == _EMPTY:
+                return (ofs if free is None else free), None
+            if state == _DELETED:
+                if free is None:
+                    free = ofs
+            elif slot_sha == sha:
+                return ofs, (dev, ino)
+            i = (i + 1) & mask
+
+    def _read_paths(self, paths_ofs):
+        self.file.seek(paths_ofs)
+        n = _heap_len.unpack(self.file.read(_heap_len.size))[0]
+        return self.file.read(n)
+
+    def node_paths(self, node):
+        paths_ofs = self._node_slot(node)[1]
+        if paths_ofs is None:
+            return None
+        return self._read_paths(paths_ofs).split(b'\0')
+
+    def path_node(self, path):
+        return self._path_slot(_path_sha(path))[1]
+
+    def nodes(self):
+        m = self.map
+        for ofs in range(self.nodes_ofs, self.paths_ofs, _node_slot.size):
+            dev, ino, paths_ofs = _node_slot.unpack_from(m, ofs)
+            if paths_ofs > 1:
+                yield (dev, ino), self._read_paths(paths_ofs).split(b'\0')
+
+    def has_room(self, nodes, paths):
+        return self.node_used + nodes <= 2**self.node_bits * MAX_LOAD \
+            and self.path_used + paths <= 2**self.path_bits * MAX_LOAD
+
+    def heap_size(self):
+        self.file.seek(0, os.SEEK_END)
+        return self.file.tell() - self.heap_ofs
+
+    def set_node_paths(self, node, paths):
+        ofs, paths_ofs = self._node_slot(node)
+        if paths_ofs is not None:
+            self.garbage += _heap_len.size + len(self._read_paths(paths_ofs))
+        elif not paths:
+            return
+        if not paths:
+            _node_slot.pack_into(self.map, ofs, 0, 0, 1)
+            return
+        data = b'\0'.join(paths)
+        self.file.seek(0, os.SEEK_END)
+        new_ofs = self.file.tell()
+        self.file.write(_heap_len.pack(len(data)) + data)
+        self.file.flush()
+        if paths_ofs is None and \
+           _node_slot.unpack_from(self.map, ofs)[2] != 1:
+            self.node_used += 1
+        _node_slot.pack_into(self.map, ofs, node[0], node[1], new_ofs)
+
+    def set_path_node(self, path, node):
+        sha = _path_sha(path)
+        ofs, prev = self._path_slot(sha)
+        if node is None:
+            if prev is not None:
+                _path_slot.pack_into(self.map, ofs, sha, _DELETED, 0, 0)
+            return
+        if prev is None and \
+           _path_slot.unpack_from(self.map, ofs)[1] != _DELETED:
+            self.path_used += 1
+        _path_slot.pack_into(self.map, ofs, sha, _USED, node[0], node[1])
+
+
+def _write_db(filename, node_paths):
+    """Write a new database containing node_paths (a dict mapping each
+    (dev, ino) node to its paths) to filename."""
+    npaths = sum(len(paths) for node, paths in compat.items(node_paths))
+    node_bits = _bits_for(len(node_paths))
+    path_bits = _bits_for(npaths)
+    tmpname = filename + b'.tmp'
+    with open(tmpname, 'w+b') as f:
+        f.write(_header.pack(b'BHLK', HLINKDB_VERSION, node_bits, path_bits,
+                             0, 0, 0))
+        f.truncate(_header.size + 2**node_bits * _node_slot.size
+                   + 2**path_bits * _path_slot.size)
+    tables = _Tables(tmpname, readwrite=True)
+    try:
+        for node, paths in compat.items(node_paths):
+            tables.set_node_paths(node, paths)
+            for path in paths:
+                tables.set_path_node(path, node)
+        tables.save_header()
+    finally:
+        tables.close()
+    os.rename(tmpname, filename)
+
+
 class HLinkDB:
     def __init__(self, filename):
-        # Map a "dev:ino" node to a list of paths associated with that node.
-        self._node_paths = {}
-        # Map a path to a "dev:ino" node.
-        self._path_node = {}
         self._filename = filename
+        self._tables = None
         self._save_prepared = None
         self._tmpname = None
+        # Changes that haven't been committed yet: map each affected
+        # (dev, ino) node to its paths, and each affected path to its
+        # node (or None if it has been removed).
+        self._node_paths = {}
+        self._path_node = {}
+        # True if the file needs to be rewritten (it's in the original
+        # format).
+        self._rewrite = False
         f = None
         try:
             f = open(filename, 'rb')
@@ -32,38 +257,68 @@ class HLinkDB:
                 raise
         if f:
             try:
-                self._node_paths = pickle.load(f)
+                magic = f.read(4)
+                if magic == b'BHLK':
+                    self._tables = _Tables(filename)
+                elif magic:
+                    f.seek(0)
+                    self._load_pickled(f)
             finally:
                 f.close()
                 f = None
-        # Set up the reverse hard link index.
-        for node, paths in compat.items(self._node_paths):
+        self._load_journal(filename + b'.journal')
+
+    def _load_pickled(self, f):
+        # The original format: a dict mapping 'dev:ino' to paths.
+        for node, paths in compat.items(pickle.load(f)):
+            dev, ino = node.split(':')
+            node = (int(dev), int(ino))
+            self._node_paths[node] = paths
             for path in paths:
                 self._path_node[path] = node
+        self._rewrite = True
+
+    def _load_journal(self, name):
+        try:
+            f = open(name, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with f:
+            node_paths, path_node = pickle.load(f)
+        self._node_paths.update(node_paths)
+        self._path_node.update(path_node)
+
+    def _get_node_paths(self, node):
+        paths = self._node_paths.get(node)
+        if paths is not None:
+            return paths
+        if self._tables and not self._rewrite:
+            return self._tables.node_paths(node)
+        return None
+
+    def _get_path_node(self, path):
+        if path in self._path_node:
+            return self._path_node[path]
+        if self._tables and not self._rewrite:
+            return self._tables.path_node(path)
+        return None
 
     def prepare_save(self):
         """ Commit all of the relevant data to disk.  Do as much work
         as possible without actually making the changes visible."""
         if self._save_prepared:
             raise Error('save of %r already in progress' % self._filename)
-        if self._node_paths:
-            (dir, name) = os.path.split(self._filename)
-            (ffd, self._tmpname) = tempfile.mkstemp(b'.tmp', name, dir)
+        if self._node_paths or self._path_node:
+            self._tmpname = self._filename + b'.tmp-journal'
             try:
-                try:
-                    f = os.fdopen(ffd, 'wb', 65536)
-                except:
-                    os.close(ffd)
-                    raise
-                try:
-                    pickle.dump(self._node_paths, f, 2)
-                finally:
-                    f.close()
-                    f = None
+                with open(self._tmpname, 'wb') as f:
+                    pickle.dump((self._node_paths, self._path_node), f, 2)
             except:
                 tmpname = self._tmpname
                 self._tmpname = None
-                os.unlink(tmpname)
+                unlink(tmpname)
                 raise
         self._save_prepared = True
 
@@ -72,18 +327,52 @@ class HLinkDB:
             raise Error('cannot commit save of %r; no save prepared'
                         % self._filename)
         if self._tmpname:
-            os.rename(self._tmpname, self._filename)
+            journal = self._filename + b'.journal'
+            os.rename(self._tmpname, journal)
             self._tmpname = None
-        else: # No data -- delete _filename if it exists.
-            try:
-                os.unlink(self._filename)
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    pass
-                else:
-                    raise
+            self._apply()
+            unlink(journal)
+            self._node_paths = {}
+            self._path_node = {}
         self._save_prepared = None
 
+    def _apply(self):
+        tables = self._tables
+        if tables:
+            tables.close()
+            self._tables = None
+        if not self._rewrite and os.path.exists(self._filename):
+            tables = _Tables(self._filename, readwrite=True)
+            heap = tables.heap_size()
+            if tables.has_room(len(self._node_paths), len(self._path_node)) \
+               and (heap < 65536 or tables.garbage < heap // 2):
+                try:
+                    for node, paths in compat.items(self._node_paths):
+                        tables.set_node_paths(node, paths)
+                    for path, node in compat.items(self._path_node):
+                        tables.set_path_node(path, node)
+                    tables.save_header()
+                finally:
+                    tables.close()
+                self._tables = _Tables(self._filename)
+                return
+        else:
+            tables = None
+        # Rewrite everything, including the changes.
+        node_paths = {}
+        if tables:
+            for node, paths in tables.nodes():
+                node_paths[node] = paths
+            tables.close()
+        for node, paths in compat.items(self._node_paths):
+            if paths:
+                node_paths[node] = paths
+            else:
+                node_paths.pop(node, None)
+        _write_db(self._filename, node_paths)
+        self._rewrite = False
+        self._tables = _Tables(self._filename)
+
     def abort_save(self):
         if self._tmpname:
             os.unlink(self._tmpname)
@@ -91,36 +380,41 @@ class HLinkDB:
 
     def __del__(self):
         self.abort_save()
+        if self._tables:
+            self._tables.close()
+            self._tables = None
 
     def add_path(self, path, dev, ino):
         # Assume path is new.
-        node = '%s:%s' % (dev, ino)
+        node = (dev, ino)
         self._path_node[path] = node
-        link_paths = self._node_paths.get(node)
+        link_paths = self._get_node_paths(node)
         if link_paths and path not in link_paths:
-            link_paths.append(path)
-        else:
+            self._node_paths[node] = link_paths + [path]
+        elif not link_paths:
             self._node_paths[node] = [path]
 
     def _del_node_path(self, node, path):
-        link_paths = self._node_paths[node]
-        link_paths.remove(path)
-        if not link_paths:
-            del self._node_paths[node]
+        link_paths = list(self._get_node_paths(node) or ())
+        if path in link_paths:
+            link_paths.remove(path)
+        self._node_paths[node] = link_paths
 
     def change_path(self, path, new_dev, new_ino):
-        prev_node = self._path_node.get(path)
+        prev_node = self._get_path_node(path)
         if prev_node:
             self._del_node_path(prev_node, path)
-        self.add_path(new_dev, new_ino, path)
+        self.add_path(path, new_dev, new_ino)
 
     def del_path(self, path):
         # Path may not be in db (if updating a pre-hardlink support index).
-        node = self._path_node.get(path)
+        node = self._get_path_node(path)
         if node:
             self._del_node_path(node, path)
-            del self._path_node[path]
+            self._path_node[path] = None
 
     def node_paths(self, dev, ino):
-        node = '%s:%s' % (dev, ino)
-        return self._node_paths[node]
+        paths = self._get_node_paths((dev, ino))
+        if not paths:
+            raise KeyError((dev, ino))
+        return paths
@@ -1,12 +1,14 @@
 
 from __future__ import absolute_import, print_function
-import errno, os, stat, struct, tempfile
+import errno, hashlib, os, stat, struct, tempfile
 
-from bup import compat, metadata, xstat
-from bup._helpers import UINT_MAX, bytescmp
+from bup import _helpers, compat, metadata, xstat
+from bup._helpers import UINT_MAX, bytescmp, extract_bits
 from bup.compat import range
-from bup.helpers import (add_error, log, merge_iter, mmap_readwrite,
-                         progress, qprogress, resolve_parent, slashappend)
+from bup.helpers import (add_error, fdatasync, log, merge_iter,
+                         mmap_readwrite, progress, qprogress, resolve_parent,
+                         slashappend, unlink)
+from bup.io import path_msg
 
 EMPTY_SHA = b'\0' * 20
 FAKE_SHA = b'\x01' * 20
@@ -37,9 +39,31 @@ INDEX_SIG = ('!'
              'Q')               # meta_ofs
 
 ENTLEN = struct.calcsize(INDEX_SIG)
+assert(ENTLEN == 130)  # cf. INDEX_ENTRY_LEN in _helpers.c
 FOOTER_SIG = '!Q'
 FOOTLEN = struct.calcsize(FOOTER_SIG)
 
+# An index may be accompanied by a delta (e.g. bupindex.delta), so
+# that a small update doesn't have to rewrite the whole thing (cf.
+# update_delta()).  The delta contains copies of the child arrays of
+# the directories (and their ancestors) that have gained entries,
+# followed by a new root and footer, which replace the ones at the end
+# of the index.  Its offsets are "virtual": those below the size of
+# the index refer to the (unchanged) arrays there, and the rest to
+# the delta itself, as if it were appended to the index.  The delta
+# starts with a header:
+#
+#   'BUPD' version(4) index_ino(8) index_size(8)
+#
+# and it's ignored if the inode number or size of the index doesn't
+# match, i.e. if the index has been rewritten since.  Once the delta
+# grows beyond DELTA_MAX_FRACTION of the index, the next update merges
+# everything into a new index instead.
+
+DELTA_HDR = b'BUPD\0\0\0\1'
+_delta_hdr = struct.Struct('!8sQQ')
+DELTA_MAX_FRACTION = 0.1
+
 IX_EXISTS = 0x8000        # file exists on filesystem
 IX_HASHVALID = 0x4000     # the stored sha1 matches the filesystem
 IX_SHAMISSING = 0x2000    # the stored sha1 object doesn't seem to exist
@@ -51,6 +75,7 @@ class Error(Exception):
 class MetaStoreReader:
     def __init__(self, filename):
         self._file = None
+        finish_compaction(filename)
         self._file = open(filename, 'rb')
 
     def close(self):
@@ -66,56 +91,352 @@ class MetaStoreReader:
         return metadata.Metadata.read(self._file)
 
 
+# A metadata offset table (e.g. bupindex.meta.ofs) is an mmapped, open
+# addressed hash table that maps the SHA-1 of each (encoded) record in
+# a metadata store to the record's offset, so that a MetaStoreWriter
+# doesn't have to read the whole store to avoid adding duplicates.
+# The format (all integers are big endian) is:
+#
+#   header: 'BMOF' version(4) bits(4) entries(4) meta_ino(8) meta_len(8)
+#   table:  2**bits slots of sha(20) offset+1(8)
+#
+# A slot is empty if its offset is 0.  The table covers the first
+# meta_len bytes of the store whose inode number is meta_ino; anything
+# past that is added when the table is next opened for writing.  While
+# it's open for writing, meta_len is set to _META_OFS_DIRTY, so a table
+# that wasn't closed cleanly will be rebuilt from scratch.
+
+META_OFS_VERSION = 1
+_meta_ofs_hdr = struct.Struct('!4sIIIQQ')
+_meta_ofs_slot = struct.Struct('!20sQ')
+_META_OFS_DIRTY = 2**64 - 1
+_META_OFS_MIN_BITS = 10
+_META_OFS_MAX_LOAD = 2.0 / 3
+
+
+def _meta_ofs_bits(count):
+    bits = _META_OFS_MIN_BITS
+    while 2**bits * _META_OFS_MAX_LOAD < count * 2:
+        bits += 1
+    return bits
+
+
+class MetaOffsets:
+    """An open (read/write) metadata offset table (cf. above)."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.map = self._file = None
+        self._file = open(filename, 'r+b')
+        self.map = mmap_readwrite(self._file, close=False)
+        if len(self.map) < _meta_ofs_hdr.size:
+            raise Error('truncated metadata offset table %r'
+                        % path_msg(filename))
+        magic, ver, self.bits, self.entries, self.meta_ino, self.meta_len \
+            = _meta_ofs_hdr.unpack_from(self.map, 0)
+        if magic != b'BMOF' or ver != META_OFS_VERSION:
+            raise Error('unrecognized metadata offset table %r'
+                        % path_msg(filename))
+        if len(self.map) != _meta_ofs_hdr.size \
+           + 2**self.bits * _meta_ofs_slot.size:
+            raise Error('truncated metadata offset table %r'
+                        % path_msg(filename))
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return int(self.entries)
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _slot_ofs(self, sha):
+        m = self.map
+        mask = 2**self.bits - 1
+        i = extract_bits(sha, self.bits)
+        while True:
+            ofs = _meta_ofs_hdr.size + i * _meta_ofs_slot.size
+            slot_sha, slot_ofs = _meta_ofs_slot.unpack_from(m, ofs)
+            if not slot_ofs or slot_sha == sha:
+                return ofs
+            i = (i + 1) & mask
+
+    def get(self, sha):
+        """Return the offset of the record with the given SHA-1, or None."""
+        ofs = _meta_ofs_slot.unpack_from(self.map, self._slot_ofs(sha))[1]
+        return ofs - 1 if ofs else None
+
+    def add(self, sha, meta_ofs):
+        if (self.entries + 1) > 2**self.bits * _META_OFS_MAX_LOAD:
+            self._grow()
+        ofs = self._slot_ofs(sha)
+        if _meta_ofs_slot.unpack_from(self.map, ofs)[1]:
+            return
+        _meta_ofs_slot.pack_into(self.map, ofs, sha, meta_ofs + 1)
+        self.entries += 1
+
+    def items(self):
+        m = self.map
+        end = len(m)
+        for ofs in range(_meta_ofs_hdr.size, end, _meta_ofs_slot.size):
+            sha, meta_ofs = _meta_ofs_slot.unpack_from(m, ofs)
+            if meta_ofs:
+                yield sha, meta_ofs - 1
+
+    def set_coverage(self, meta_ino, meta_len):
+        """Record that the table covers the first meta_len bytes of the
+        store with inode number meta_ino."""
+        self.meta_ino, self.meta_len = meta_ino, meta_len
+        _meta_ofs_hdr.pack_into(self.map, 0, b'BMOF', META_OFS_VERSION,
+                                self.bits, self.entries,
+                                meta_ino, meta_len)
+
+    def _grow(self):
+        tmpname = self.filename + b'.tmp'
+        bigger = create_meta_offsets(tmpname, self.meta_ino,
+                                     expected=self.entries)
+        for sha, meta_ofs in self.items():
+            bigger.add(sha, meta_ofs)
+        bigger.set_coverage(self.meta_ino, self.meta_len)
+        bigger.close()
+        self.close()
+        os.rename(tmpname, self.filename)
+        self.__init__(self.filename)
+
+
+def create_meta_offsets(filename, meta_ino, expected=0):
+    """Create (or replace) the metadata offset table filename, with
+    room for at least expected entries, and return it open."""
+    bits = _meta_ofs_bits(expected)
+    # Don't truncate a table that someone else may have mapped.
+    tmpname = filename + b'.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(_meta_ofs_hdr.pack(b'BMOF', META_OFS_VERSION, bits, 0,
+                                   meta_ino, 0))
+        f.truncate(_meta_ofs_hdr.size + 2**bits * _meta_ofs_slot.size)
+    os.rename(tmpname, filename)
+    return MetaOffsets(filename)
+
+
+def _meta_sha(meta_encoded):
+    return hashlib.sha1(meta_encoded).digest()
+
+
+def _reencoded_meta(m):
+    # Metadata.read() returns None for an empty record, i.e. the one
+    # stored for Metadata().
+    if m is None:
+        m = metadata.Metadata()
+    return m.encode(include_path=False)
+
+
 class MetaStoreWriter:
     # For now, we just append to the file, and try to handle any
-    # truncation or corruption somewhat sensibly.
+    # truncation or corruption somewhat sensibly.  Existing records
+    # are found via the store's offset table (cf. MetaOffsets), and
+    # only the part of the store that the table doesn't cover yet
+    # (normally nothing) has to be read.
 
     def __init__(self, filename):
-        # Map metadata hashes to bupindex.meta offsets.
-        self._offsets = {}
+        self._offsets = None
         self._filename = filename
         self._file = None
-        # FIXME: see how slow this is; does it matter?
-        m_file = open(filename, 'ab+')
+        finish_compaction(filename)
+        m_file = open(filename, 'ab')
+        st = os.fstat(m_file.fileno())
+        offsets = _open_meta_offsets(filename + b'.ofs', st.st_ino, st.st_size)
+        covered = offsets.meta_len
+        offsets.set_coverage(st.st_ino, _META_OFS_DIRTY)
+        offsets.map.flush()
         try:
-            m_file.seek(0)
+            if covered < st.st_size:
+                self._read_offsets(offsets, covered)
+        except:
+            offsets.close()
+            m_file.close()
+            raise
+        self._offsets = offsets
+        self._file = m_file
+
+    def _read_offsets(self, offsets, start):
+        with open(self._filename, 'rb') as m_file:
+            m_file.seek(start)
             try:
-                m_off = m_file.tell()
-                m = metadata.Metadata.read(m_file)
-                while m:
-                    m_encoded = m.encode()
-                    self._offsets[m_encoded] = m_off
+                while True:
                     m_off = m_file.tell()
                     m = metadata.Metadata.read(m_file)
+                    offsets.add(_meta_sha(_reencoded_meta(m)), m_off)
             except EOFError:
                 pass
             except:
-                log('index metadata in %r appears to be corrupt' % filename)
+                log('index metadata in %r appears to be corrupt'
+                    % self._filename)
                 raise
-        finally:
-            m_file.close()
-        self._file = open(filename, 'ab')
 
     def close(self):
         if self._file:
+            self._file.flush()
+            meta_len = os.fstat(self._file.fileno()).st_size
             self._file.close()
             self._file = None
+            # Existing offsets remain available to store() until we're
+            # released.
+            self._offsets.set_coverage(self._offsets.meta_ino, meta_len)
+            self._offsets.map.flush()
 
     def __del__(self):
         # Be optimistic.
         self.close()
+        if self._offsets:
+            self._offsets.close()
+            self._offsets = None
 
     def store(self, metadata):
         meta_encoded = metadata.encode(include_path=False)
-        ofs = self._offsets.get(meta_encoded)
-        if ofs:
+        sha = _meta_sha(meta_encoded)
+        ofs = self._offsets.get(sha)
+        if ofs is not None:
             return ofs
         ofs = self._file.tell()
         self._file.write(meta_encoded)
-        self._offsets[meta_encoded] = ofs
+        self._offsets.add(sha, ofs)
         return ofs
 
 
+def _open_meta_offsets(filename, meta_ino, meta_size):
+    """Return the offset table filename, if it's usable for the store
+    with inode number meta_ino and size meta_size, otherwise, a new,
+    empty table (which will have to be filled from the store)."""
+    try:
+        offsets = MetaOffsets(filename)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except Error as e:
+        log('warning: %s; rebuilding it\n' % e)
+    else:
+        if offsets.meta_ino == meta_ino and offsets.meta_len <= meta_size:
+            return offsets
+        offsets.close()
+    # Guess that records average at least 64 bytes.
+    return create_meta_offsets(filename, meta_ino, expected=meta_size // 64)
+
+
+def _compaction_files(meta_name):
+    """Return the (temporary, final) names of the files that
+    compact_metastore() swaps into place, in order."""
+    indexfile = meta_name[:-len(b'.meta')]
+    return ((meta_name + b'.tmp.ofs', meta_name + b'.ofs'),
+            (meta_name + b'.tmp', meta_name),
+            (indexfile + b'.compact.tmp', indexfile))
+
+def _compaction_marker(meta_name):
+    return meta_name + b'.compacted'
+
+def _sync_file(name):
+    with open(name, 'rb') as f:
+        fdatasync(f.fileno())
+
+def _sync_dir(name):
+    fd = os.open(os.path.dirname(name) or b'.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def finish_compaction(meta_name):
+    """If compact_metastore() was interrupted while swapping in the
+    compacted metadata store (meta_name) and the matching index, finish
+    the swap, so that the index never refers to the wrong store.  This
+    is done automatically whenever either one is opened."""
+    marker = _compaction_marker(meta_name)
+    if not os.path.exists(marker):
+        return
+    # The marker is only written once all of the temporary files are
+    # complete (and synced), so any that remain just need to be moved
+    # into place.
+    for tmp, final in _compaction_files(meta_name):
+        try:
+            os.rename(tmp, final)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    _sync_dir(marker)
+    unlink(marker)
+
+
+def compact_metastore(indexfile):
+    """Rewrite the metadata store for indexfile (i.e. indexfile +
+    '.meta') so that it only contains the records the index refers to,
+    adjusting the index to match, and return the number of bytes
+    reclaimed.  Any delta is folded into the index first."""
+    meta_name = indexfile + b'.meta'
+    fold_delta(indexfile)
+    (tmp_ofs, _), (tmp_meta, _), (tmp_index, _) = _compaction_files(meta_name)
+    ri = Reader(indexfile)
+    if not ri.exists():
+        ri.close()
+        return 0
+    try:
+        old_size = os.stat(meta_name).st_size
+        msr = MetaStoreReader(meta_name)
+        try:
+            new_ofs = {}
+            with open(tmp_meta, 'wb') as meta_out:
+                st = os.fstat(meta_out.fileno())
+                offsets = create_meta_offsets(tmp_ofs, st.st_ino)
+                for e in ri.forward_iter():
+                    if e.meta_ofs in new_ofs:
+                        continue
+                    meta_encoded = _reencoded_meta(msr.metadata_at(e.meta_ofs))
+                    sha = _meta_sha(meta_encoded)
+                    ofs = offsets.get(sha)
+                    if ofs is None:
+                        ofs = meta_out.tell()
+                        meta_out.write(meta_encoded)
+                        offsets.add(sha, ofs)
+                    new_ofs[e.meta_ofs] = ofs
+                new_size = meta_out.tell()
+                meta_out.flush()
+                fdatasync(meta_out.fileno())
+            offsets.set_coverage(st.st_ino, new_size)
+            offsets.close()
+            # Rewrite a copy of the index, so that nothing changes if
+            # we're interrupted before this point.
+            with open(tmp_index, 'wb') as f:
+                f.write(ri.m)
+            tmp_ri = Reader(tmp_index)
+            for e in tmp_ri.forward_iter():
+                struct.pack_into('!Q', tmp_ri.m, e._ofs + ENTLEN - 8,
+                                 new_ofs[e.meta_ofs])
+            tmp_ri.close()
+            _sync_file(tmp_ofs)
+            _sync_file(tmp_index)
+        except:
+            for name in (tmp_meta, tmp_ofs, tmp_index):
+                unlink(name)
+            raise
+        finally:
+            msr.close()
+    finally:
+        ri.close()
+    # Once the marker exists, the swap is finished by whoever gets
+    # there first (cf. finish_compaction()), even after a crash.
+    marker = _compaction_marker(meta_name)
+    with open(marker, 'wb') as f:
+        fdatasync(f.fileno())
+    _sync_dir(marker)
+    finish_compaction(meta_name)
+    return old_size - new_size
+
+
 class Level:
     def __init__(self, ename, parent):
         self.parent = parent
@@ -340,20 +661,43 @@ class BlankNewEntry(NewEntry):
                           0, EMPTY_SHA, 0, meta_ofs, 0, 0)
 
 
+_index_names = _helpers.index_names
+_index_entry_fields = _helpers.index_entry_fields
+
+# The ExistingEntry attributes that are decoded from the index record.
+_entry_fields = frozenset(('dev', 'ino', 'nlink', 'ctime', 'mtime', 'atime',
+                           'size', 'mode', 'gitmode', 'sha', 'flags',
+                           'children_ofs', 'children_n', 'meta_ofs'))
+
 class ExistingEntry(Entry):
-    def __init__(self, parent, basename, name, m, ofs):
-        Entry.__init__(self, basename, name, None, None)
+    # Entries are created a directory at a time from the names found
+    # by _helpers.index_names(), but the fixed length part of each one
+    # isn't decoded until one of its fields is first needed (cf.
+    # __getattr__), so the (potentially enormous) parts of the index
+    # that the caller only passes over stay cheap.  The entry keeps
+    # the reader's map alive until then.  When the index has a delta,
+    # maps is the reader's (index map, delta map, delta base), which
+    # is needed to find the children.
+    def __init__(self, parent, basename, name, m, ofs, maps=None):
+        assert basename is None or type(basename) == bytes
+        assert name is None or type(name) == bytes
+        self.basename = basename
+        self.name = name
+        self.tmax = None
         self.parent = parent
         self._m = m
         self._ofs = ofs
-        (self.dev, self.ino, self.nlink,
-         self.ctime, ctime_ns, self.mtime, mtime_ns, self.atime, atime_ns,
-         self.size, self.mode, self.gitmode, self.sha,
-         self.flags, self.children_ofs, self.children_n, self.meta_ofs
-         ) = struct.unpack(INDEX_SIG, m[ofs : ofs + ENTLEN])
-        self.atime = xstat.timespec_to_nsecs((self.atime, atime_ns))
-        self.mtime = xstat.timespec_to_nsecs((self.mtime, mtime_ns))
-        self.ctime = xstat.timespec_to_nsecs((self.ctime, ctime_ns))
+        self._maps = maps
+
+    def __getattr__(self, name):
+        if name not in _entry_fields:
+            raise AttributeError(name)
+        self._decode()
+        return self.__dict__[name]
+
+    def _decode(self):
+        # Doesn't clobber anything that's been assigned already.
+        _index_entry_fields(self._m, self._ofs, self.__dict__)
 
     # effectively, we don't bother messing with IX_SHAMISSING if
     # not IX_HASHVALID, since it's redundant, and repacking is more
@@ -379,41 +723,80 @@ class ExistingEntry(Entry):
             self.parent.invalidate()
             self.parent.repack()
 
+    def children(self):
+        """Return a list of the entry's immediate children."""
+        ofs = self.children_ofs
+        n = self.children_n
+        maps = self._maps
+        if not maps:
+            m = self._m
+        elif ofs >= maps[2]:
+            m = maps[1]
+            ofs -= maps[2]
+        else:
+            m = maps[0]
+        assert(ofs <= len(m))
+        assert(n <= UINT_MAX)  # i.e. python struct 'I'
+        if not n:
+            return []
+        prefix = self.name
+        result = [ExistingEntry(self, basename, prefix + basename, m, rec_ofs,
+                                maps)
+                  for basename, rec_ofs
+                  in _index_names(m, ofs, n, ENTLEN, len(m))]
+        assert(len(result) == n)
+        return result
+
     def iter(self, name=None, wantrecurse=None):
+        # Equivalent to recursively yielding each child's (matching)
+        # descendants, followed by the child itself (if it matches),
+        # but without a generator per level, since every entry would
+        # otherwise be passed up through each of its ancestors.
         dname = name
         if dname and not dname.endswith(b'/'):
             dname += b'/'
-        ofs = self.children_ofs
-        assert(ofs <= len(self._m))
-        assert(self.children_n <= UINT_MAX)  # i.e. python struct 'I'
-        for i in range(self.children_n):
-            eon = self._m.find(b'\0', ofs)
-            assert(eon >= 0)
-            assert(eon >= ofs)
-            assert(eon > ofs)
-            basename = self._m[ofs : ofs + (eon - ofs)]
-            child = ExistingEntry(self, basename, self.name + basename,
-                                  self._m, eon+1)
-            if (not dname
-                 or child.name.startswith(dname)
-                 or child.name.endswith(b'/') and dname.startswith(child.name)):
-                if not wantrecurse or wantrecurse(child):
-                    for e in child.iter(name=name, wantrecurse=wantrecurse):
-                        yield e
-            if not name or child.name == name or child.name.startswith(dname):
+        # Each element is (the entry to yield once its children are
+        # exhausted, if any, an iterator over the children).
+        stack = [(None, iter(self.children()))]
+        while stack:
+            after, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if after is not None:
+                    yield after
+                continue
+            cname = child.name
+            wanted = not name or cname == name or cname.startswith(dname)
+            # Only directories (which end with '/') have children.
+            if cname.endswith(b'/') \
+               and (not dname
+                    or cname.startswith(dname)
+                    or dname.startswith(cname)) \
+               and (not wantrecurse or wantrecurse(child)):
+                stack.append((child if wanted else None,
+                              iter(child.children())))
+            elif wanted:
                 yield child
-            ofs = eon + 1 + ENTLEN
 
     def __iter__(self):
         return self.iter()
             
 
+def delta_name(indexfile):
+    return indexfile + b'.delta'
+
+
 class Reader:
     def __init__(self, filename):
         self.filename = filename
         self.m = b''
+        self.delta = None
+        self._maps = None
+        self.ino = None
         self.writable = False
         self.count = 0
+        finish_compaction(filename + b'.meta')
         f = None
         try:
             f = open(filename, 'rb+')
@@ -431,10 +814,29 @@ class Reader:
                 st = os.fstat(f.fileno())
                 if st.st_size:
                     self.m = mmap_readwrite(f)
+                    self.ino = st.st_ino
                     self.writable = True
                     self.count = struct.unpack(FOOTER_SIG,
                                                self.m[st.st_size - FOOTLEN
                                                       : st.st_size])[0]
+                    self._open_delta(st)
+
+    def _open_delta(self, st):
+        try:
+            f = open(delta_name(self.filename), 'rb+')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        hdr = f.read(_delta_hdr.size)
+        if len(hdr) < _delta_hdr.size \
+           or _delta_hdr.unpack(hdr) != (DELTA_HDR, st.st_ino, st.st_size):
+            # Left over from before the index was rewritten.
+            f.close()
+            return
+        self.delta = mmap_readwrite(f)
+        self._maps = (self.m, self.delta, st.st_size)
+        self.count = struct.unpack(FOOTER_SIG, self.delta[-FOOTLEN:])[0]
 
     def __del__(self):
         self.close()
@@ -443,23 +845,41 @@ class Reader:
         return int(self.count)
 
     def forward_iter(self):
+        if self.delta:
+            # The entries are spread across the index and the delta
+            # (along with some that have been superseded), so just
+            # produce them children first, as they would have been
+            # written.
+            for e in self.iter():
+                yield e
+            return
+        m = self.m
         ofs = len(INDEX_HDR)
-        while ofs+ENTLEN <= len(self.m)-FOOTLEN:
-            eon = self.m.find(b'\0', ofs)
-            assert(eon >= 0)
-            assert(eon >= ofs)
-            assert(eon > ofs)
-            basename = self.m[ofs : ofs + (eon - ofs)]
-            yield ExistingEntry(None, basename, basename, self.m, eon+1)
-            ofs = eon + 1 + ENTLEN
+        end = len(m) - FOOTLEN
+        while True:
+            names = _index_names(m, ofs, 1024, ENTLEN, end) if m else None
+            if not names:
+                break
+            for basename, rec_ofs in names:
+                yield ExistingEntry(None, basename, basename, m, rec_ofs)
+            ofs = names[-1][1] + ENTLEN
+
+    def root(self):
+        """Return the entry for /, or None if the index is empty."""
+        if self.delta:
+            return ExistingEntry(None, b'/', b'/', self.delta,
+                                 len(self.delta)-FOOTLEN-ENTLEN, self._maps)
+        if len(self.m) > len(INDEX_HDR)+ENTLEN:
+            return ExistingEntry(None, b'/', b'/',
+                                 self.m, len(self.m)-FOOTLEN-ENTLEN)
+        return None
 
     def iter(self, name=None, wantrecurse=None):
-        if len(self.m) > len(INDEX_HDR)+ENTLEN:
+        root = self.root()
+        if root:
             dname = name
             if dname and not dname.endswith(b'/'):
                 dname += b'/'
-            root = ExistingEntry(None, b'/', b'/',
-                                 self.m, len(self.m)-FOOTLEN-ENTLEN)
             for sub in root.iter(name=name, wantrecurse=wantrecurse):
                 yield sub
             if not dname or dname == root.name:
@@ -479,12 +899,17 @@ class Reader:
     def save(self):
         if self.writable and self.m:
             self.m.flush()
+            if self.delta:
+                self.delta.flush()
 
     def close(self):
         self.save()
         if self.writable and self.m:
-            self.m.close()
+            # Don't close the maps, since entries that haven't been
+            # decoded yet may still need them.  They'll be unmapped when
+            # the last of them is gone.
             self.m = None
+            self.delta = self._maps = None
             self.writable = False
 
     def filter(self, prefixes, wantrecurse=None):
@@ -558,6 +983,8 @@ class Writer:
         if f:
             f.close()
             os.rename(self.tmpname, self.filename)
+            # The delta (if any) no longer applies.
+            unlink(delta_name(self.filename))
 
     def _add(self, ename, entry):
         if self.lastfile and self.lastfile <= ename:
@@ -653,3 +1080,116 @@ def merge(*iters):
     def pfinal(count, total):
         progress('bup: merging indexes (%d/%d), done.\n' % (count, total))
     return merge_iter(iters, 1024, pfunc, pfinal, key='name')
+
+
+class _DeltaTooBig(Exception):
+    pass
+
+
+def _write_children(f, base, old, new, keep_below, limit):
+    """Write the child arrays of the merge of old and new (entries for
+    the same directory, either of which may be None) to f, children
+    first, as merge() and Writer would, and return (children_ofs,
+    children_n, added) for the merged directory, where added is the
+    number of entries that came from new (i.e. weren't in old).  Any
+    of old's arrays that start before keep_below, and that new
+    doesn't add to, are left where they are."""
+    if old and old.children_n and old.children_ofs < keep_below \
+       and not (new and new.children_n):
+        return old.children_ofs, old.children_n, 0
+    oc = old.children() if old else []
+    nc = new.children() if new else []
+    # Both lists are in reverse name order (cf. Entry._cmp).
+    merged = []
+    added = i = j = 0
+    while i < len(oc) or j < len(nc):
+        o = oc[i] if i < len(oc) else None
+        n = nc[j] if j < len(nc) else None
+        if o and n and o.name == n.name:
+            i += 1
+            j += 1
+        elif n is None or (o and o.name > n.name):
+            i += 1
+            n = None
+        else:
+            j += 1
+            o = None
+            added += 1
+        # As in merge(), the lesser of any duplicates wins.
+        e = n if n is not None and (o is None or n < o) else o
+        if e.name.endswith(b'/'):
+            e.children_ofs, e.children_n, sub_added \
+                = _write_children(f, base, o, n, keep_below, limit)
+            added += sub_added
+        merged.append(e)
+    ofs = base + f.tell()
+    for e in merged:
+        e.write(f)
+    if limit is not None and f.tell() > limit:
+        raise _DeltaTooBig()
+    return ofs, len(merged), added
+
+
+def _write_tree(f, base, old, new, keep_below=0, limit=None):
+    """Write the merge of the (non-empty) index old and the index new
+    (which may be None), i.e. the child arrays, root, and footer, and
+    return the number of entries (cf. _write_children())."""
+    o = old.root()
+    n = new.root() if new else None
+    root = n if n is not None and n < o else o
+    root.children_ofs, root.children_n, added \
+        = _write_children(f, base, o, n, keep_below, limit)
+    root.write(f)
+    count = len(old) + added
+    f.write(struct.pack(FOOTER_SIG, count))
+    return count
+
+
+def update_delta(reader, new_reader):
+    """Add the entries in new_reader (cf. Writer.new_reader()) to the
+    index that reader has open, by replacing its delta, and return
+    true, unless the delta would grow beyond DELTA_MAX_FRACTION of the
+    index, in which case return false, and the caller should merge()
+    them into a new index instead.  Entries in both are handled as
+    merge() would."""
+    assert reader.exists()
+    base = len(reader.m)
+    name = delta_name(reader.filename)
+    tmpname = name + b'.tmp'
+    try:
+        with open(tmpname, 'wb') as f:
+            f.write(_delta_hdr.pack(DELTA_HDR, reader.ino, base))
+            _write_tree(f, base, reader, new_reader, keep_below=base,
+                        limit=base * DELTA_MAX_FRACTION)
+    except _DeltaTooBig:
+        unlink(tmpname)
+        return False
+    except:
+        unlink(tmpname)
+        raise
+    os.rename(tmpname, name)
+    return True
+
+
+def fold_delta(indexfile):
+    """Rewrite indexfile to include its delta (if any), and return
+    true if there was one."""
+    ri = Reader(indexfile)
+    try:
+        if not ri.delta:
+            return False
+        filename = resolve_parent(indexfile)
+        ffd, tmpname = tempfile.mkstemp(b'.tmp', filename,
+                                        os.path.dirname(filename))
+        try:
+            with os.fdopen(ffd, 'wb', 65536) as f:
+                f.write(INDEX_HDR)
+                _write_tree(f, 0, ri, None)
+        except:
+            os.unlink(tmpname)
+            raise
+    finally:
+        ri.close()
+    os.rename(tmpname, indexfile)
+    unlink(delta_name(indexfile))
+    return True
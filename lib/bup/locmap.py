@@ -0,0 +1,289 @@
+"""Object location map.
+
+A location map (objects/pack/bup.locmap) is a single mmapped hash
+table that maps every object id in a pack directory to the index
+(and so the pack) that contains it, and to the object's offset in
+that pack.  Unlike a midx, which has to be binary searched, and is
+regenerated (and usually merged with others) whenever packs are
+added, the table is open addressed, so a lookup normally touches a
+single slot (one page), and new packs are added to it in place as
+they're finished.  That lets any number of readers share one
+up-to-date structure instead of each opening (and searching) a
+growing collection of idx/midx files.
+
+The file format (all integers are big endian) is:
+
+  header: 'BLOC' version(4) bits(4) entries(4)
+  table:  2**bits slots of sha(20) idxnum(4) offset(8)
+  idxnames: the basenames of the covered idx files, joined by '\0'
+
+A slot is empty if its idxnum is 0, otherwise idxnum - 1 is the
+position of the object's idx in idxnames.  A sha's home slot is the
+value of its first `bits` bits, and collisions are resolved by linear
+probing.  When adding another index would push the table past
+MAX_LOAD, the whole map is rebuilt (via a temporary file and rename)
+at a larger size.
+
+Updates are serialized via flock() on the pack directory.  Each slot's
+idxnum is written after the rest of the slot and the new idx name is
+appended before any of its slots are, so a concurrent reader will, at
+worst, miss an object that's in the process of being added.
+"""
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+import fcntl, math, os, struct
+
+from bup import _helpers
+from bup.compat import range
+from bup.helpers import debug1, log, mmap_read, mmap_readwrite, unlink
+from bup.io import path_msg
+
+
+LOCMAP_VERSION = 1
+MAX_LOAD = 2.0 / 3  # fraction of slots in use that forces a rebuild
+MIN_BITS = 10
+MAX_BITS = 32  # the limit of extract_bits()
+
+_header = struct.Struct('!4sIII')
+_slot_tail = struct.Struct('!IQ')
+HEADER_LEN = _header.size
+SLOT_LEN = 20 + _slot_tail.size
+assert(HEADER_LEN == 16)
+assert(SLOT_LEN == 32)
+
+extract_bits = _helpers.extract_bits
+
+
+def _bits_for(count):
+    """Return the table size (in bits) for count objects, leaving room
+    for roughly as many again before the table has to be rebuilt."""
+    bits = int(math.ceil(math.log(max(count, 1) * 2, 2)))
+    return min(MAX_BITS, max(MIN_BITS, bits))
+
+
+class LocMap:
+    """An mmapped bup.locmap (cf. the module documentation)."""
+    def __init__(self, filename, f=None, readwrite=False):
+        self.name = filename
+        self.map = None
+        self.rwfile = None
+        assert(filename.endswith(b'.locmap'))
+        if readwrite:
+            self.rwfile = f = f or open(filename, 'r+b')
+            self.map = mmap_readwrite(f, close=False)
+        else:
+            self.map = mmap_read(f or open(filename, 'rb'))
+        if len(self.map) < HEADER_LEN:
+            log('Warning: ignoring truncated locmap %r\n' % path_msg(filename))
+            return self._init_failed()
+        magic, ver, self.bits, self.entries = \
+            _header.unpack_from(self.map, 0)
+        if magic != b'BLOC':
+            log('Warning: invalid BLOC header in %r\n' % path_msg(filename))
+            return self._init_failed()
+        if ver != LOCMAP_VERSION:
+            log('Warning: ignoring unsupported (v%d) locmap %r\n'
+                % (ver, path_msg(filename)))
+            return self._init_failed()
+        self.slots = 2**self.bits
+        self.names_ofs = HEADER_LEN + self.slots * SLOT_LEN
+        if len(self.map) < self.names_ofs:
+            log('Warning: ignoring truncated locmap %r\n' % path_msg(filename))
+            return self._init_failed()
+        names = self.map[self.names_ofs:]
+        self.idxnames = names.split(b'\0') if names else []
+
+    def __del__(self):
+        self.close()
+
+    def _init_failed(self):
+        self.bits = self.entries = self.slots = 0
+        self.idxnames = []
+
+    def _reread_idxnames(self):
+        # Another process may have added indexes since the file was
+        # mapped, and the names are appended beyond the end of our map.
+        with open(self.name, 'rb') as f:
+            f.seek(self.names_ofs)
+            names = f.read()
+        self.idxnames = names.split(b'\0') if names else []
+
+    def valid(self):
+        return self.map is not None and self.bits
+
+    def close(self):
+        if self.map is not None:
+            if self.rwfile:
+                self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.rwfile:
+            self.rwfile.close()
+            self.rwfile = None
+        self._init_failed()
+
+    def __len__(self):
+        return int(self.entries)
+
+    def _slot_ofs(self, sha):
+        """Return the position of sha's slot, which is either the slot
+        containing sha, or the empty slot that ends its probe sequence."""
+        m = self.map
+        mask = self.slots - 1
+        i = extract_bits(sha, self.bits)
+        while True:
+            ofs = HEADER_LEN + i * SLOT_LEN
+            if not _slot_tail.unpack_from(m, ofs + 20)[0]:
+                return ofs
+            if m[ofs : ofs + 20] == sha:
+                return ofs
+            i = (i + 1) & mask
+
+    def locate(self, sha):
+        """Return (idxname, offset) for the object, or None if it isn't
+        in the map."""
+        if not self.slots:
+            return None
+        idxnum, pack_ofs = _slot_tail.unpack_from(self.map,
+                                                  self._slot_ofs(sha) + 20)
+        if not idxnum:
+            return None
+        if idxnum > len(self.idxnames):
+            self._reread_idxnames()
+        return self.idxnames[idxnum - 1], pack_ofs
+
+    def _idx_from_hash(self, sha):
+        """Return the position of the object's slot in the table, or None
+        if it isn't in the map."""
+        if not self.slots:
+            return None
+        ofs = self._slot_ofs(sha)
+        if not _slot_tail.unpack_from(self.map, ofs + 20)[0]:
+            return None
+        return (ofs - HEADER_LEN) // SLOT_LEN
+
+    def exists(self, hash, want_source=False):
+        """Return nonempty if the object exists in the index files."""
+        loc = self.locate(hash)
+        if not loc:
+            return None
+        return want_source and loc[0] or True
+
+    def _find_many(self, batch, found):
+        """Set found[i] for each not yet found sha i in the sorted batch
+        (concatenated binary shas) that's in this map, and return the
+        number of shas that were newly found."""
+        hits = 0
+        for i in range(len(found)):
+            if not found[i] and self.locate(batch[i * 20 : i * 20 + 20]):
+                found[i] = 1
+                hits += 1
+        return hits
+
+    def __iter__(self):
+        """Generate the shas in the map in sorted order (as for an idx).
+        Every object is at or after its home slot, with no empty slot in
+        between, so the table is already in order, other than within
+        each run of full slots, and for any objects at the start of the
+        table that wrapped around from the end.  Sorting each run as it
+        goes by keeps the cost (and memory use) proportional to the
+        longest run."""
+        m = self.map
+        bits = self.bits
+        wrapped = []
+        run = []
+        first = True  # still in the run that starts at slot 0
+        for ofs in range(HEADER_LEN, self.names_ofs, SLOT_LEN):
+            if _slot_tail.unpack_from(m, ofs + 20)[0]:
+                sha = m[ofs : ofs + 20]
+                if first and extract_bits(sha, bits) > \
+                   (ofs - HEADER_LEN) // SLOT_LEN:
+                    wrapped.append(sha)
+                else:
+                    run.append(sha)
+            elif run or first:
+                first = False
+                run.sort()
+                for sha in run:
+                    yield sha
+                run = []
+        # The wrapped objects belong with the run at the end.
+        run.extend(wrapped)
+        run.sort()
+        for sha in run:
+            yield sha
+
+    def has_room(self, count):
+        """Return true if count more objects can be added without
+        exceeding MAX_LOAD."""
+        return self.slots and self.entries + count <= self.slots * MAX_LOAD
+
+    def add(self, idxname, entries):
+        """Add the (sha, offset) entries for idxname (the basename of an
+        idx file) to the map, and return the number of objects added.
+        Objects that are already in the map (via some other idx) are
+        left alone."""
+        assert(self.rwfile)
+        assert(idxname not in self.idxnames)
+        self.rwfile.seek(0, os.SEEK_END)
+        self.rwfile.write((self.idxnames and b'\0' or b'') + idxname)
+        self.rwfile.flush()
+        self.idxnames.append(idxname)
+        idxnum = len(self.idxnames)
+        m = self.map
+        added = 0
+        for sha, pack_ofs in entries:
+            ofs = self._slot_ofs(sha)
+            if _slot_tail.unpack_from(m, ofs + 20)[0]:
+                continue
+            m[ofs : ofs + 20] = sha
+            struct.pack_into('!Q', m, ofs + 24, pack_ofs)
+            struct.pack_into('!I', m, ofs + 20, idxnum)
+            added += 1
+        self.entries += added
+        struct.pack_into('!I', m, 12, self.entries)
+        return added
+
+    def add_idx(self, ix):
+        """Add all of the objects in the PackIdx ix to the map."""
+        return self.add(os.path.basename(ix.name),
+                        ((sha, ix._ofs_from_idx(i)) for i, sha in enumerate(ix)))
+
+
+def create(name, idxes, extra=0):
+    """Replace the location map name with one covering idxes (a list of
+    PackIdx instances), that has room for at least extra more objects
+    before it has to be rebuilt.  The caller must hold the lock()."""
+    total = sum(len(ix) for ix in idxes)
+    bits = _bits_for(total + extra)
+    debug1('locmap: %d objects in %d indexes, using 2^%d slots\n'
+           % (total, len(idxes), bits))
+    tmpname = os.path.join(os.path.dirname(name), b'bup.tmp.locmap')
+    f = open(tmpname, 'w+b')
+    f.write(_header.pack(b'BLOC', LOCMAP_VERSION, bits, 0))
+    # NOTE: On some systems this will not extend+zerofill, but it does on
+    # darwin, linux, bsd and solaris.
+    f.truncate(HEADER_LEN + 2**bits * SLOT_LEN)
+    f.flush()
+    lm = LocMap(tmpname, f=f, readwrite=True)
+    for ix in idxes:
+        lm.add_idx(ix)
+    lm.close()
+    os.rename(tmpname, name)
+
+
+@contextmanager
+def lock(dir):
+    """Hold an exclusive lock on the location map in dir (which may not
+    exist yet) for the duration of the block."""
+    fd = os.open(dir, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def clear_locmap(dir):
+    unlink(os.path.join(dir, b'bup.locmap'))
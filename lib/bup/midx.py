@@ -61,6 +61,7 @@ class PackMidx:
     def _init_failed(self):
         self.bits = 0
         self.entries = 1
+        self.nsha = 0
         self.idxnames = []
 
     def _fanget(self, i):
@@ -92,6 +93,13 @@ class PackMidx:
 
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in the index files."""
+        i = self._idx_from_hash(hash)
+        if i is None:
+            return None
+        return want_source and self._get_idxname(i) or True
+
+    def _idx_from_hash(self, hash):
+        """Return the position of the object in the midx, or None."""
         global _total_searches, _total_steps
         _total_searches += 1
         want = hash
@@ -121,9 +129,18 @@ class PackMidx:
                 end = mid
                 endv = _helpers.firstword(v)
             else: # got it!
-                return want_source and self._get_idxname(mid) or True
+                return mid
         return None
 
+    def _find_many(self, batch, found):
+        """Set found[i] for each not yet found sha i in the sorted batch
+        (concatenated binary shas) that's in this midx, and return the
+        number of shas that were newly found."""
+        if not self.nsha:
+            return 0
+        return _helpers.find_shas(self.map, self.sha_ofs, self.nsha, 20,
+                                  batch, found)
+
     def __iter__(self):
         start = self.sha_ofs
         for ofs in range(start, start + self.nsha * 20, 20):
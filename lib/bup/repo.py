@@ -1,11 +1,33 @@
 
 from __future__ import absolute_import
-from os.path import realpath
+from collections import deque
 from functools import partial
+from itertools import islice
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from os.path import realpath
+import threading
 
 from bup import client, git, vfs
 
 
+# How cat_many() reads ahead: the number of worker threads (local),
+# the number of refs handled per request, and the maximum number of
+# outstanding requests.
+try:
+    _cat_jobs = min(4, cpu_count())
+except NotImplementedError:
+    _cat_jobs = 1
+_cat_batch = 32
+_cat_window = 4
+
+
+def _cat_data(cp, ref):
+    it = cp.get(ref)
+    oidx, typ, size = next(it)
+    return oidx, typ, size, b''.join(it) if oidx else None
+
+
 _next_repo_id = 0
 _repo_ids = {}
 
@@ -19,15 +41,27 @@ def _repo_id(key):
     return next_id
 
 class LocalRepo:
-    def __init__(self, repo_dir=None):
+    def __init__(self, repo_dir=None, cat_jobs=None):
         self.repo_dir = realpath(repo_dir or git.repo())
         self._cp = git.cp(self.repo_dir)
         self.update_ref = partial(git.update_ref, repo_dir=self.repo_dir)
         self.rev_list = partial(git.rev_list, repo_dir=self.repo_dir)
         self._id = _repo_id(self.repo_dir)
+        self._cat_jobs = _cat_jobs if cat_jobs is None else cat_jobs
+        self._cat_pool = None
+        self._cat_local = threading.local()
+        self._cat_pipes = []  # every pipe created for the pool
 
     def close(self):
-        pass
+        if self._cat_pool:
+            self._cat_pool.terminate()
+            self._cat_pool.join()
+            self._cat_pool = None
+        # The pool's threads are gone, so their pipes are ours.
+        self._cat_local = threading.local()
+        pipes, self._cat_pipes = self._cat_pipes, []
+        for cp in pipes:
+            cp.close()
 
     def __del__(self):
         self.close()
@@ -48,11 +82,12 @@ class LocalRepo:
         return False
 
     def new_packwriter(self, compression_level=1,
-                       max_pack_size=None, max_pack_objects=None):
+                       max_pack_size=None, max_pack_objects=None, jobs=1):
         return git.PackWriter(repo_dir=self.repo_dir,
                               compression_level=compression_level,
                               max_pack_size=max_pack_size,
-                              max_pack_objects=max_pack_objects)
+                              max_pack_objects=max_pack_objects,
+                              jobs=jobs)
 
     def cat(self, ref):
         """If ref does not exist, yield (None, None, None).  Otherwise yield
@@ -68,6 +103,51 @@ class LocalRepo:
                 yield data
         assert not next(it, None)
 
+    def cat_raw(self, oidx, compression_level=None):
+        """Return (type, record) if the object named by oidx (hex) is
+        stored whole in one of the repository's packs, where record is
+        its complete pack record, otherwise None (cf. CatPipe.get_raw())."""
+        return self._cp.get_raw(oidx, compression_level=compression_level)
+
+    def _cat_fetch(self, refs):
+        # Runs in the cat_many() worker threads, each of which has its
+        # own CatPipe.
+        cp = getattr(self._cat_local, 'cp', None)
+        if not cp:
+            cp = self._cat_local.cp = git.CatPipe(self.repo_dir)
+            self._cat_pipes.append(cp)
+        return [_cat_data(cp, ref) for ref in refs]
+
+    def cat_many(self, refs):
+        """Yield (oidx, type, size, data) for each ref in refs, in order,
+        where data is all of the data associated with the ref, and
+        every field is None if the ref doesn't exist.  Given more than
+        one cat job (by default, one per cpu, up to 4), objects are read
+        ahead of the caller, and several are fetched (and inflated)
+        concurrently.
+
+        """
+        if self._cat_jobs < 2:
+            for ref in refs:
+                yield _cat_data(self._cp, ref)
+            return
+        if not self._cat_pool:
+            self._cat_pool = ThreadPool(self._cat_jobs)
+        refs = iter(refs)
+        pending = deque()
+        def request():
+            batch = tuple(islice(refs, _cat_batch))
+            if batch:
+                pending.append(self._cat_pool.apply_async(self._cat_fetch,
+                                                          (batch,)))
+        for i in range(_cat_window):
+            request()
+        while pending:
+            result = pending.popleft().get()
+            request()
+            for item in result:
+                yield item
+
     def join(self, ref):
         return self._cp.join(ref)
 
@@ -135,6 +215,16 @@ class RemoteRepo:
                 yield data
         assert not next(items, None)
 
+    def cat_many(self, refs):
+        """Yield (oidx, type, size, data) for each ref in refs, in order,
+        where data is all of the data associated with the ref, and
+        every field is None if the ref doesn't exist.  Objects are read
+        ahead of the caller, with a window of requests in flight.
+
+        """
+        for oidx, typ, size, it in self.client.cat_stream(refs):
+            yield oidx, typ, size, b''.join(it) if oidx else None
+
     def join(self, ref):
         return self.client.join(ref)
 
@@ -19,12 +19,14 @@ def test_bloom():
             ix = Idx()
             ix.name = b'dummy.idx'
             ix.shatable = b''.join(hashes)
-            for k in (4, 5):
-                b = bloom.create(tmpdir + b'/pybuptest.bloom', expected=100, k=k)
+            for version, k in ((2, 4), (2, 5), (3, 6), (3, 8)):
+                b = bloom.create(tmpdir + b'/pybuptest.bloom', expected=100, k=k,
+                                 version=version)
                 b.add_idx(ix)
                 WVPASSLT(b.pfalse_positive(), .1)
                 b.close()
                 b = bloom.ShaBloom(tmpdir + b'/pybuptest.bloom')
+                WVPASSEQ((b.version, b.k), (version, k))
                 all_present = True
                 for h in hashes:
                     all_present &= (b.exists(h) or False)
@@ -39,6 +41,9 @@ def test_bloom():
             tf = tempfile.TemporaryFile(dir=tmpdir)
             b = bloom.create(b'bup.bloom', f=tf, expected=100)
             WVPASSEQ(b.rwfile, tf)
+            WVPASSEQ((b.version, b.k), (3, 8))
+            tf = tempfile.TemporaryFile(dir=tmpdir)
+            b = bloom.create(b'bup.bloom', f=tf, expected=100, version=2)
             WVPASSEQ(b.k, 5)
 
             # Test large (~1GiB) filter.  This may fail on s390 (31-bit
@@ -48,7 +53,7 @@ def test_bloom():
             skip_test = False
             try:
                 b = bloom.create(b'bup.bloom', f=tf, expected=2**28,
-                                 delaywrite=False)
+                                 delaywrite=False, version=2)
             except EnvironmentError as ex:
                 (ptr_width, linkage) = platform.architecture()
                 if ptr_width == '32bit' and ex.errno == errno.ENOMEM:
@@ -59,3 +64,69 @@ def test_bloom():
                     raise
             if not skip_test:
                 WVPASSEQ(b.k, 4)
+
+
+@wvtest
+def test_ephemeral_bloom():
+    with no_lingering_errors():
+        hashes = [os.urandom(20) for i in range(100)]
+        for version, k in ((2, 4), (2, 5), (3, 8)):
+            b = bloom.create_ephemeral(expected=100, k=k, version=version)
+            WVPASSEQ((b.version, b.k), (version, k))
+            WVPASSEQ(b.rwfile, None)
+            for h in hashes:
+                b.add(h)
+            WVPASSEQ(len(b), 100)
+            WVPASS(all(b.exists(h) for h in hashes))
+            false_positives = sum(1 for h in (os.urandom(20)
+                                              for i in range(1000))
+                                  if b.exists(h))
+            WVPASSLT(false_positives, 5)
+            b.close()
+            WVPASSEQ(b.exists(hashes[0]), None)
+
+
+@wvtest
+def test_blocked_bloom():
+    with no_lingering_errors():
+        hashes = [os.urandom(20) for i in range(5000)]
+        b = bloom.create_ephemeral(expected=len(hashes))
+        WVPASSEQ(b.version, 3)
+        b.add(b''.join(hashes))
+        WVPASSEQ(len(b), len(hashes))
+        WVPASS(all([b.exists(h) for h in hashes]))
+        # All of an object's bits are in its 64 byte block.
+        h = os.urandom(20)
+        c = bloom.create_ephemeral(expected=len(hashes))
+        c.add(h)
+        block = bloom._helpers.extract_bits(h, c.bits - 6)
+        nonzero = [i for i in range(16, len(c.map)) if c.map[i:i+1] != b'\0']
+        WVPASS(nonzero)
+        WVPASSEQ(set((i - 16) // 64 for i in nonzero), set([block]))
+        # A one block filter works too.
+        d = bloom.create_ephemeral(expected=1)
+        WVPASSEQ(d.bits, 6)
+        d.add(h)
+        WVPASS(d.exists(h))
+
+
+@wvtest
+def test_blocked_pfalse_positive():
+    with no_lingering_errors():
+        # 2^16 bytes, at about 9.7 bits per entry.
+        b = bloom.create_ephemeral(expected=2**14)
+        WVPASSEQ((b.version, b.bits, b.k), (3, 16, 8))
+        b.add(os.urandom(20 * 54000))
+        expected = b.pfalse_positive()
+        # Higher than an unblocked filter's (0.99%)...
+        WVPASSLT(1.1, expected)
+        WVPASSLT(expected, 1.25)
+        tries = 200000
+        hits = sum(1 for i in range(tries) if b.exists(os.urandom(20)))
+        measured = 100. * hits / tries
+        WVPASSLT(abs(measured - expected), expected * .15)
+        v2 = bloom.create_ephemeral(expected=2**14, version=2)
+        WVPASSEQ((v2.bits, v2.k), (16, 5))
+        v2.add(os.urandom(20 * 54000))
+        # ...and than version 2's there (cf. bloom.py).
+        WVPASSLT(v2.pfalse_positive(), expected)
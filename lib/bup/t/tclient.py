@@ -1,5 +1,6 @@
 
 from __future__ import absolute_import
+from binascii import hexlify
 import sys, os, stat, time, random, subprocess, glob
 
 from wvtest import *
@@ -60,6 +61,8 @@ def test_multiple_suggestions():
 
             c = client.Client(bupdir, create=True)
             WVPASSEQ(len(glob.glob(c.cachedir+IDX_PAT)), 0)
+            # Exercise the suggestions, rather than have-objects
+            c._use_have_objects = False
             rw = c.new_packwriter()
             s1sha = rw.new_blob(s1)
             WVPASS(rw.exists(s1sha))
@@ -78,6 +81,71 @@ def test_multiple_suggestions():
             WVPASSEQ(len(glob.glob(c.cachedir+IDX_PAT)), 3)
 
 
+@wvtest
+def test_have_objects():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tclient-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            lw = git.PackWriter()
+            s1sha = lw.new_blob(s1)
+            s2sha = lw.new_blob(s2)
+            lw.close()
+            s3sha = git.calc_hash(b'blob', s3)
+
+            c = client.Client(bupdir, create=True)
+            WVPASSEQ(c.have_objects([]), [])
+            WVPASSEQ(c.have_objects([s3sha, s1sha, s2sha] * 3),
+                     [False, True, True] * 3)
+
+            old_batch = client.have_objects_batch
+            client.have_objects_batch = 2
+            try:
+                rw = c.new_packwriter()
+                blobs = [randbytes(100) for i in range(5)]
+                shas = [rw.new_blob(b) for b in blobs[:3]]
+                # Objects the server has are never sent, and the
+                # others are checked in batches (during the pack too).
+                rw.new_blob(s1)
+                rw.new_blob(s2)
+                WVPASS(rw.exists(s2sha))
+                shas.extend(rw.new_blob(b) for b in blobs[3:])
+                rw.new_blob(s3)
+                rw.new_blob(s3)
+                WVPASS(rw.exists(s3sha))
+                rw.close()
+            finally:
+                client.have_objects_batch = old_batch
+            # The idx of the new pack is kept, but not the others, and
+            # the objects the server already had are remembered.
+            idxs = glob.glob(c.cachedir + b'/pack-*.idx')
+            WVPASSEQ(len(idxs), 1)
+            ix = git.open_idx(idxs[0])
+            WVPASSEQ(sorted(ix), sorted(shas + [s3sha]))
+            WVPASSEQ(c.have_objects(shas), [True] * len(shas))
+            have = glob.glob(c.cachedir + b'/have-*.idx')
+            WVPASSEQ(len(have), 1)
+            WVPASSEQ(sorted(git.open_idx(have[0])), sorted([s1sha, s2sha]))
+            rw = c.new_packwriter()
+            WVPASS(rw.exists(s1sha))
+            WVPASS(rw.exists(s2sha))
+            rw.close()
+
+            # ...until the server drops any of the packs it had.
+            c.sync_indexes()
+            WVPASSEQ(len(glob.glob(c.cachedir + b'/have-*.idx')), 1)
+            lw = git.PackWriter()
+            lw.new_blob(s3)
+            lw.close()
+            c.sync_indexes()
+            WVPASSEQ(len(glob.glob(c.cachedir + b'/have-*.idx')), 1)
+            old_pack = git.repo(b'objects/pack/%s' % os.path.basename(idxs[0]))
+            os.unlink(old_pack)
+            os.unlink(old_pack[:-4] + b'.pack')
+            c.sync_indexes()
+            WVPASSEQ(glob.glob(c.cachedir + b'/have-*'), [])
+
+
 @wvtest
 def test_dumb_client_server():
     with no_lingering_errors():
@@ -100,6 +168,41 @@ def test_dumb_client_server():
             WVPASSEQ(len(glob.glob(c.cachedir+IDX_PAT)), 2)
 
 
+@wvtest
+def test_server_locmap():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tclient-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            subprocess.check_call([b'git', b'--git-dir', bupdir, b'config',
+                                   b'bup.locmap', b'true'])
+            packdir = git.repo(b'objects/pack')
+
+            lw = git.PackWriter()
+            lw.new_blob(s1)
+            lw.close()
+            WVPASS(git.open_locmap(packdir) is None)
+
+            c = client.Client(bupdir, create=True)
+            lm = git.open_locmap(packdir)
+            WVPASSEQ(len(lm), 1)
+            lm.close()
+            rw = c.new_packwriter()
+            rw.new_blob(s2)
+            rw.breakpoint()
+            # The next session sees the pack the last one finished.
+            rw.new_blob(s1)
+            rw.new_blob(s2)
+            rw.close()
+            idxnames = sorted(os.path.basename(n)
+                              for n in glob.glob(packdir + IDX_PAT))
+            WVPASSEQ(len(idxnames), 2)
+            lm = git.open_locmap(packdir)
+            WVPASSEQ(sorted(lm.idxnames), idxnames)
+            WVPASSEQ(len(lm), 2)
+            lm.close()
+
+
 @wvtest
 def test_midx_refreshing():
     with no_lingering_errors():
@@ -158,3 +261,38 @@ def test_remote_parsing():
             WVFAIL()
         except client.ClientError:
             WVPASS()
+
+
+@wvtest
+def test_cat_stream():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tclient-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            lw = git.PackWriter()
+            blobs = [randbytes(i * 10) for i in range(20)]
+            refs = [hexlify(lw.new_blob(blob)) for blob in blobs]
+            lw.close()
+            refs.insert(5, hexlify(git.calc_hash(b'blob', b'missing')))
+            blobs.insert(5, None)
+            expected = [(ref, b'blob', len(blob), blob) if blob is not None
+                        else (None, None, None, None)
+                        for ref, blob in zip(refs, blobs)]
+
+            c = client.Client(bupdir)
+            def cat_stream(refs, window):
+                for oidx, typ, size, it in c.cat_stream(refs, window=window):
+                    yield oidx, typ, size, b''.join(it) if oidx else None
+            for window in (1, 3, 100):
+                WVPASSEQ(list(cat_stream(refs, window)), expected)
+            # Abandoning the stream (even mid-object) shouldn't leave
+            # the connection out of sync.
+            it = c.cat_stream(refs, window=4)
+            for i in range(3):
+                for data in next(it)[3] or ():
+                    pass
+            data_it = next(it)[3]
+            next(data_it)
+            del data_it, it
+            WVPASSEQ(list(cat_stream(refs[:2], 2)), expected[:2])
+            c.close()
@@ -0,0 +1,115 @@
+
+from __future__ import absolute_import, print_function
+from binascii import hexlify
+from subprocess import check_call
+import glob, os, sys
+
+from wvtest import *
+
+from bup import fsck, git
+from bup.compat import environ, range
+from bup.helpers import readpipe
+from buptest import no_lingering_errors, test_tempdir
+
+
+def exc(*cmd):
+    print(repr(cmd), file=sys.stderr)
+    check_call(cmd)
+
+
+def exo(*cmd):
+    print(repr(cmd), file=sys.stderr)
+    return readpipe(cmd)
+
+
+def damage(path, ofs, data=b'\xff'):
+    os.chmod(path, 0o644)
+    with open(path, 'r+b') as f:
+        f.seek(ofs)
+        orig = f.read(len(data))
+        f.seek(ofs)
+        f.write(bytes(bytearray(b ^ 0xff for b in bytearray(orig))))
+    return orig
+
+
+def restore(path, ofs, orig):
+    with open(path, 'r+b') as f:
+        f.seek(ofs)
+        f.write(orig)
+
+
+@wvtest
+def test_verify_pack():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tfsck-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            shas = [w.new_blob(b'blob %d\n' % i * 100) for i in range(50)]
+            base = w.close(run_midx=False)
+            pack = base + b'.pack'
+            idx = base + b'.idx'
+
+            r = fsck.verify_pack(base)
+            WVPASSEQ(r['error_count'], 0)
+            WVPASSEQ(r['errors'], [])
+            WVPASSEQ(r['objects'], 50)
+            WVPASSEQ(r['bytes'], os.path.getsize(pack))
+
+            # Damage the middle of an object.
+            ix = git.open_idx(idx)
+            ofs = ix.find_offset(shas[10]) + 6
+            orig = damage(pack, ofs)
+            r = fsck.verify_pack(base, full=False)
+            WVPASS(r['error_count'] >= 2)
+            WVPASS('pack checksum mismatch' in r['errors'])
+            WVPASS(any(e.startswith('CRC mismatch for %s'
+                                    % hexlify(shas[10]).decode('ascii'))
+                       for e in r['errors']))
+            restore(pack, ofs, orig)
+            WVPASSEQ(fsck.verify_pack(base)['error_count'], 0)
+
+            # Damage the index.
+            orig = damage(idx, 8 + 256 * 4 + 20 * 5)
+            r = fsck.verify_pack(base)
+            WVPASS('index checksum mismatch' in r['errors'])
+            WVPASS(any('out of order' in e for e in r['errors']))
+            restore(idx, 8 + 256 * 4 + 20 * 5, orig)
+            orig = damage(idx, 8 + 256 * 4 - 4)
+            r = fsck.verify_pack(base)
+            WVPASS(r['error_count'])
+            restore(idx, 8 + 256 * 4 - 4, orig)
+            WVPASSEQ(fsck.verify_pack(base)['error_count'], 0)
+
+            os.unlink(pack)
+            r = fsck.verify_pack(base)
+            WVPASSEQ(r['error_count'], 1)
+
+
+@wvtest
+def test_verify_pack_deltas():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tfsck-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            base = b''.join(b'line %d\n' % i for i in range(2000))
+            w = git.PackWriter()
+            oidxs = [hexlify(w.new_blob(base + b'change %d\n' % i
+                                        + base[:i * 100]))
+                     for i in range(8)]
+            w.close(run_midx=False)
+            for i, oidx in enumerate(oidxs):
+                exc(b'git', b'--git-dir', bupdir,
+                    b'update-ref', b'refs/tags/blob-%d' % i, oidx)
+            # Check both ofs and ref deltas
+            for use_ofs in (b'true', b'false'):
+                exc(b'git', b'--git-dir', bupdir,
+                    b'-c', b'repack.useDeltaBaseOffset=' + use_ofs,
+                    b'repack', b'-a', b'-d', b'-f')
+                idx, = glob.glob(bupdir + b'/objects/pack/*.idx')
+                verify = exo(b'git', b'--git-dir', bupdir,
+                             b'verify-pack', b'-v', idx)
+                WVPASS(b'chain length = 1' in verify)
+                r = fsck.verify_pack(idx[:-4])
+                WVPASSEQ(r['errors'], [])
+                WVPASSEQ(r['objects'], 8)
@@ -2,11 +2,12 @@
 from __future__ import absolute_import, print_function
 from binascii import hexlify, unhexlify
 from subprocess import check_call
-import struct, os, time
+from itertools import islice
+import glob, struct, os, time
 
 from wvtest import *
 
-from bup import git, path
+from bup import bloom, git, helpers, locmap, path
 from bup.compat import bytes_from_byte, environ, range
 from bup.helpers import localtime, log, mkdirp, readpipe
 from buptest import no_lingering_errors, test_tempdir
@@ -106,6 +107,8 @@ def testpacks():
             print(repr(nameprefix))
             WVPASS(os.path.exists(nameprefix + b'.pack'))
             WVPASS(os.path.exists(nameprefix + b'.idx'))
+            # Checks the pack and idx trailers too
+            exc(b'git', b'verify-pack', nameprefix + b'.idx')
 
             r = git.open_idx(nameprefix + b'.idx')
             print(repr(r.fanout))
@@ -179,6 +182,15 @@ def test_long_index():
             WVPASSEQ(i.find_offset(obj_bin), 0xfffffffff)
             WVPASSEQ(i.find_offset(obj2_bin), 0xffffffffff)
             WVPASSEQ(i.find_offset(obj3_bin), 0xff)
+            offsets, idxs = i._pack_order()
+            WVPASSEQ(list(offsets), [0xff, 0xfffffffff, 0xffffffffff])
+            WVPASSEQ(list(idxs), [2, 0, 1])
+            WVPASSEQ((offsets.itemsize, idxs.itemsize), (8, 4))
+            WVPASSEQ(i.record_span(0xfffffffff, 0xffffffffff + 100),
+                     (0xffffffffff, 1))
+            WVPASSEQ(i.record_span(0xffffffffff, 0xffffffffff + 100)[0],
+                     0xffffffffff + 80)
+            WVEXCEPT(git.GitError, i.record_span, 0x100, 0xffffffffff + 100)
 
 
 @wvtest
@@ -440,3 +452,503 @@ def test_cat_pipe():
             for buf in next(it):
                 pass
             WVPASSEQ((oidx, typ, size), get_info)
+
+
+@wvtest
+def test_new_blobs_jobs():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            blobs = [os.urandom(100) for i in range(40)]
+            blobs.append(blobs[3])  # duplicate within the batch
+            expected_ids = [git.calc_hash(b'blob', b) for b in blobs]
+            results = []
+            for jobs in (1, 4):
+                w = git.PackWriter(jobs=jobs)
+                written = list(w.new_blobs((b, i) for i, b in enumerate(blobs)))
+                WVPASS([i for oid, i in written] == list(range(len(blobs))))
+                WVPASS([oid for oid, i in written] == expected_ids)
+                WVPASSEQ(w.count, 40)
+                nameprefix = w.close(run_midx=False)
+                with open(nameprefix + b'.pack', 'rb') as f:
+                    f.seek(-20, 2)  # The pack trailer is its sha1
+                    results.append((os.path.basename(nameprefix),
+                                    hexlify(f.read())))
+                os.unlink(nameprefix + b'.pack')
+                os.unlink(nameprefix + b'.idx')
+            WVPASSEQ(results[0], results[1])
+
+            # Only the missing blobs are compressed.
+            w = git.PackWriter(jobs=4)
+            list(w.new_blobs((b, None) for b in blobs))
+            w.close(run_midx=False)
+            encoded = []
+            orig_encode_blob = git._encode_blob
+            def encode_blob(content, compression_level):
+                encoded.append(content)
+                return orig_encode_blob(content, compression_level)
+            try:
+                git._encode_blob = encode_blob
+                w = git.PackWriter(jobs=4)
+                new = [os.urandom(100) for i in range(5)]
+                written = list(w.new_blobs((b, None) for b in blobs + new))
+                WVPASSEQ([oid for oid, info in written],
+                         expected_ids + [git.calc_hash(b'blob', b)
+                                         for b in new])
+                WVPASSEQ(w.count, 5)
+                w.close(run_midx=False)
+            finally:
+                git._encode_blob = orig_encode_blob
+            WVPASSEQ(sorted(encoded), sorted(new))
+
+
+@wvtest
+def test_exists_many():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            packdir = git.repo(b'objects/pack')
+            hashes = []
+            for start in (0, 10):
+                w = git.PackWriter()
+                for i in range(start, start + 10):
+                    hashes.append(w.new_blob(b'%d' % i))
+                w.close(run_midx=False)
+            missing = [git.calc_hash(b'blob', b'missing %d' % i)
+                       for i in range(5)]
+            batch = missing[:2] + hashes[::-1] + missing[2:] + hashes[:3]
+            expected = [h in hashes for h in batch]
+
+            r = git.PackIdxList(packdir)
+            WVPASSEQ(len(r.packs), 2)
+            WVPASSEQ(r.exists_many(batch), expected)
+            WVPASSEQ(r.exists_many([]), [])
+            r.add(missing[0])
+            WVPASSEQ(r.exists_many(missing[:2]), [True, False])
+            del r
+
+            exc(bup_exe, b'midx', b'-f')
+            r = git.PackIdxList(packdir)
+            WVPASSEQ(len(r.packs), 1)
+            WVPASSEQ(r.exists_many(batch), expected)
+
+
+@wvtest
+def test_locmap():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            packdir = git.repo(b'objects/pack')
+            lmname = packdir + b'/bup.locmap'
+            hashes = []
+            def write_pack(start):
+                w = git.PackWriter()
+                for i in range(start, start + 10):
+                    hashes.append(w.new_blob(b'%d' % i))
+                return w.close(run_midx=False)
+            write_pack(0)
+            WVPASS(git.open_locmap(packdir) is None)
+
+            git.update_locmap(packdir, create=True)
+            lm = git.open_locmap(packdir)
+            WVPASSEQ(len(lm), 10)
+            WVPASSEQ(len(lm.idxnames), 1)
+            lm.close()
+
+            # A finished pack is added to an existing map in place
+            st = os.stat(lmname)
+            nameprefix = write_pack(10)
+            WVPASSEQ(os.stat(lmname).st_ino, st.st_ino)
+            lm = git.open_locmap(packdir)
+            WVPASSEQ(len(lm), 20)
+            WVPASSEQ(sorted(lm), sorted(hashes))
+            ix = git.open_idx(nameprefix + b'.idx')
+            WVPASSEQ(lm.locate(hashes[15]),
+                     (os.path.basename(ix.name), ix.find_offset(hashes[15])))
+            WVPASS(lm.locate(git.calc_hash(b'blob', b'missing')) is None)
+            lm.close()
+
+            # Readers use the map instead of the idxes it covers, and
+            # more than one of them can be open at once.
+            r1 = git.PackIdxList(packdir)
+            r2 = git.PackIdxList(packdir)
+            WVPASSEQ(len(r1.packs), 1)
+            WVPASS(isinstance(r1.packs[0], locmap.LocMap))
+            WVPASSEQ(r2.exists(hashes[15], want_source=True),
+                     os.path.basename(ix.name))
+            WVPASSEQ(r1.exists_many([hashes[3], b'\0' * 20]), [True, False])
+            # A refresh picks up packs that were added to the map
+            # elsewhere, still without opening any idx.
+            nameprefix2 = write_pack(20)
+            WVPASS(r1.exists(hashes[25]))
+            r1.refresh()
+            WVPASSEQ(len(r1.packs), 1)
+            WVPASS(r1.exists(hashes[25]))
+            del r1, r2
+            os.unlink(nameprefix2 + b'.idx')
+            os.unlink(nameprefix2 + b'.pack')
+            del hashes[20:]
+
+            # Removing a covered idx makes the map stale, and the next
+            # update rebuilds it.
+            os.unlink(nameprefix + b'.idx')
+            os.unlink(nameprefix + b'.pack')
+            WVPASS(git.open_locmap(packdir) is None)
+            r = git.PackIdxList(packdir)
+            WVPASSEQ(len(r.packs), 1)
+            WVPASS(isinstance(r.packs[0], git.PackIdx))
+            del r
+            git.update_locmap(packdir)
+            lm = git.open_locmap(packdir)
+            WVPASSEQ(len(lm), 10)
+            WVPASSEQ(sorted(lm), sorted(hashes[:10]))
+            lm.close()
+
+            # Outgrowing the table also forces a rebuild
+            w = git.PackWriter()
+            for i in range(2000):
+                w.new_blob(b'more %d' % i)
+            w.close(run_midx=False)
+            WVPASSNE(os.stat(lmname).st_ino, st.st_ino)
+            lm = git.open_locmap(packdir)
+            WVPASSEQ(len(lm), 2010)
+            WVPASS(lm.bits > locmap.MIN_BITS)
+            lm.close()
+
+
+@wvtest
+def test_locmap_iter():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            lmname = tmpdir + b'/bup.locmap'
+            locmap.create(lmname, [], extra=300)
+            lm = locmap.LocMap(lmname, readwrite=True)
+            WVPASSEQ(lm.bits, locmap.MIN_BITS)
+            WVPASSEQ(list(lm), [])
+            # Plenty of collisions, and objects whose home is at the
+            # end of the table, so that some of them wrap around.
+            shas = [os.urandom(20) for i in range(200)]
+            shas.extend(prefix + os.urandom(19)
+                        for prefix in (b'\0', b'\x80', b'\xff')
+                        for i in range(20))
+            lm.add(b'x.idx', ((sha, i) for i, sha in enumerate(shas)))
+            WVPASSEQ(len(lm), len(shas))
+            WVPASSEQ(lm.locate(shas[-1]), (b'x.idx', len(shas) - 1))
+            WVPASSEQ(list(lm), sorted(shas))
+            lm.close()
+
+
+@wvtest
+def test_auto_midx():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            packdir = git.repo(b'objects/pack')
+            hashes = []
+            for i in range(7):
+                w = git.PackWriter()
+                for j in range(300):
+                    hashes.append(w.new_blob(b'%d %d' % (i, j)))
+                ixname = w.close() + b'.idx'
+                WVPASSEQ(git.idx_count(ixname), 300)
+                # The bloom is extended in place after each pack.
+                b = bloom.ShaBloom(packdir + b'/bup.bloom')
+                WVPASSEQ(len(b.idxnames), i + 1)
+                WVPASSEQ(len(b), 300 * (i + 1))
+                WVPASS(all([b.exists(h) for h in hashes]))
+                b.close()
+            # An old (v2) filter is still updated in place, until it's
+            # regenerated.
+            bname = packdir + b'/bup.bloom'
+            os.unlink(bname)
+            b = bloom.create(bname, expected=len(hashes) * 2, version=2)
+            for name in glob.glob(packdir + b'/*.idx')[:-1]:
+                b.add_idx(git.open_idx(name))
+            b.close()
+            git.update_bloom(packdir)
+            b = bloom.ShaBloom(bname)
+            WVPASSEQ((b.version, len(b)), (2, len(hashes)))
+            WVPASS(all([b.exists(h) for h in hashes]))
+            b.close()
+            git.update_bloom(packdir, force=True)
+            b = bloom.ShaBloom(bname)
+            WVPASSEQ((b.version, len(b)), (3, len(hashes)))
+            WVPASS(all([b.exists(h) for h in hashes]))
+            b.close()
+
+            # All of the packs are in tier 0, so they've been merged
+            # (every fourth file) into one midx.
+            pi = git.PackIdxList(packdir)
+            WVPASSEQ(len(pi.packs), 1)
+            WVPASS(pi.packs[0].name.endswith(b'.midx'))
+            WVPASS(all([pi.exists(h) for h in hashes]))
+            del pi
+            WVPASSEQ(git.update_midxes(packdir, force=True, auto=True), [])
+
+            # Any failure is just recorded, since the pack is finished,
+            # and doesn't stop the bloom from being updated.
+            orig_update_midxes = git.update_midxes
+            def update_midxes(*args, **kwargs):
+                assert False, 'broken midx'
+            try:
+                git.update_midxes = update_midxes
+                w = git.PackWriter()
+                hashes.append(w.new_blob(b'after'))
+                WVPASS(w.close())
+            finally:
+                git.update_midxes = orig_update_midxes
+            WVPASSEQ(len(helpers.saved_errors), 1)
+            WVPASS('broken midx' in str(helpers.saved_errors[0]))
+            helpers.clear_errors()
+            b = bloom.ShaBloom(bname)
+            WVPASS(b.exists(hashes[-1]))
+            b.close()
+
+
+@wvtest
+def test_midx_tiers():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            packdir = git.repo(b'objects/pack')
+            old_base = git.MIDX_TIER_BASE
+            git.MIDX_TIER_BASE = 4
+            try:
+                WVPASSEQ([git.midx_tier(n) for n in (0, 15, 16, 63, 64)],
+                         [0, 0, 1, 1, 2])
+                serial = [0]
+                def write_packs(count):
+                    for i in range(count):
+                        w = git.PackWriter()
+                        for j in range(5):
+                            w.new_blob(b'%d' % serial[0])
+                            serial[0] += 1
+                        w.close(run_midx=False)
+                write_packs(16)
+                stats = {}
+                new = git.update_midxes(packdir, auto=True, stats=stats)
+                WVPASSEQ(len(new), 1)
+                WVPASSEQ((stats['merges'], stats['objects']), (1, 80))
+                big = new[0]
+
+                # Fewer than MIDX_TIER_FACTOR files in a tier are left alone
+                write_packs(3)
+                stats = {}
+                WVPASSEQ(git.update_midxes(packdir, auto=True, stats=stats), [])
+                WVPASSEQ(stats, {})
+
+                # and merging them doesn't touch the bigger tier.
+                write_packs(1)
+                new = git.update_midxes(packdir, auto=True, stats=stats)
+                WVPASSEQ(len(new), 1)
+                WVPASSEQ((stats['merges'], stats['objects']), (1, 20))
+                pi = git.PackIdxList(packdir)
+                WVPASSEQ(sorted(p.name for p in pi.packs), sorted([big] + new))
+                WVPASSEQ(len(pi), 100)
+            finally:
+                git.MIDX_TIER_BASE = old_base
+
+
+@wvtest
+def test_cat_pipe_packed():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            # Write some similar objects via git itself, so that a
+            # repack will store most of them as (ofs) deltas.
+            base = b''.join(b'line %d\n' % i for i in range(2000))
+            oidxs = []
+            for i in range(8):
+                with open(tmpdir + b'/f', 'wb') as f:
+                    f.write(base + b'change %d\n' % i + base[:i * 100])
+                oidxs.append(exo(b'git', b'--git-dir', bupdir,
+                                 b'hash-object', b'-w', tmpdir + b'/f').strip())
+            w = git.PackWriter()
+            oidxs.append(hexlify(w.new_blob(b'x' * 200000)))
+            oidxs.append(hexlify(w.new_blob(b'')))
+            w.close(run_midx=False)
+            # Make them all reachable, so repack will include them
+            for i, oidx in enumerate(oidxs):
+                exc(b'git', b'--git-dir', bupdir,
+                    b'update-ref', b'refs/tags/blob-%d' % i, oidx)
+            # Check both ofs and ref deltas
+            for use_ofs in (b'true', b'false'):
+                exc(b'git', b'--git-dir', bupdir,
+                    b'-c', b'repack.useDeltaBaseOffset=' + use_ofs,
+                    b'repack', b'-a', b'-d', b'-f')
+                verify = exo(b'git', b'--git-dir', bupdir,
+                             b'verify-pack', b'-v',
+                             *glob.glob(bupdir + b'/objects/pack/*.idx'))
+                WVPASS(b'chain length = 1' in verify)
+
+                cp = git.CatPipe(bupdir)
+                for oidx in oidxs:
+                    size = int(exo(b'git', b'--git-dir', bupdir,
+                                   b'cat-file', b'-s', oidx))
+                    WVPASSEQ(next(cp.get(oidx)), (oidx, b'blob', size))
+                    data = b''.join(islice(cp.get(oidx), 1, None))
+                    WVPASSEQ(data, exo(b'git', b'--git-dir', bupdir,
+                                       b'cat-file', b'blob', oidx))
+                # None of that should have needed git cat-file
+                WVPASSEQ(cp.p, None)
+
+                missing = hexlify(git.calc_hash(b'blob', b'missing'))
+                WVPASSEQ(tuple(cp.get(missing)), ((None, None, None),))
+
+
+@wvtest
+def test_cat_pipe_refresh():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            packdir = git.repo(b'objects/pack')
+            w = git.PackWriter()
+            first = hexlify(w.new_blob(b'first'))
+            first_pack = w.close()
+            old = time.time() - 60
+            os.utime(packdir, (old, old))
+            cp = git.CatPipe(bupdir)
+            WVPASSEQ(next(cp.get(first))[0], first)
+            refreshes = []
+            orig_refresh = cp._idxlist.refresh
+            def refresh():
+                refreshes.append(1)
+                orig_refresh()
+            cp._idxlist.refresh = refresh
+            # Misses don't look at the packs again until they change.
+            missing = hexlify(git.calc_hash(b'blob', b'missing'))
+            for i in range(3):
+                WVPASSEQ(next(cp.get(missing)), (None, None, None))
+            WVPASSEQ(len(refreshes), 0)
+            w = git.PackWriter()
+            second = hexlify(w.new_blob(b'second'))
+            w.close()
+            WVPASSEQ(next(cp.get(second))[0], second)
+            WVPASSEQ(len(refreshes), 1)
+
+            # A pack that's been removed (say, by gc, after copying its
+            # objects elsewhere) since the indexes were read is noticed.
+            w = git.PackWriter(objcache_maker=None)
+            w.just_write(unhexlify(first), b'blob', b'first')
+            w.just_write(git.calc_hash(b'blob', b'third'), b'blob', b'third')
+            w.close(run_midx=False)
+            os.utime(packdir, (old, old))
+            cp._packdir_changed(packdir)
+            WVPASSEQ(next(cp.get(second))[0], second)
+            os.unlink(first_pack + b'.pack')
+            os.unlink(first_pack + b'.idx')
+            WVPASSEQ(cp.get_raw(first)[0], b'blob')
+            WVPASSEQ(b''.join(islice(cp.get(first), 1, None)), b'first')
+            removed = os.path.basename(first_pack) + b'.idx'
+            WVFAIL(removed in cp._packmaps)
+            WVFAIL(removed in cp._packidxes)
+            cp.close()
+            WVPASSEQ((cp._packmaps, cp._packidxes, cp._idxlist), ({}, {}, None))
+
+
+@wvtest
+def test_raw_copy():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            src = tmpdir + b'/src'
+            dest = tmpdir + b'/dest'
+            git.init_repo(src)
+            git.init_repo(dest)
+            blobs = [b'', b'x' * 200000, b'some data\n' * 10]
+            w = git.PackWriter(repo_dir=src, compression_level=1)
+            oids = [w.new_blob(b) for b in blobs]
+            oids.append(w.new_tree([(0o100644, b'a', oids[0]),
+                                    (0o100644, b'b', oids[1])]))
+            w.close(run_midx=False)
+
+            cp = git.CatPipe(src)
+            WVPASSEQ(cp.get_raw(hexlify(oids[1]), compression_level=9), None)
+            missing = hexlify(git.calc_hash(b'blob', b'missing'))
+            WVPASSEQ(cp.get_raw(missing), None)
+
+            w = git.PackWriter(repo_dir=dest)
+            for oid in oids:
+                typ, record = cp.get_raw(hexlify(oid), compression_level=1)
+                w.just_write_raw(oid, record)
+            w.close(run_midx=False)
+            # git verify-pack checks the idx CRCs too
+            exc(b'git', b'--git-dir', dest, b'verify-pack',
+                *glob.glob(dest + b'/objects/pack/*.idx'))
+            dest_cp = git.CatPipe(dest)
+            for oid in oids:
+                oidx = hexlify(oid)
+                WVPASSEQ(tuple(dest_cp.get(oidx)), tuple(cp.get(oidx)))
+            WVPASSEQ(dest_cp.get_raw(hexlify(oids[3]))[0], b'tree')
+
+            # A damaged record should be caught by the CRC check
+            pack = glob.glob(src + b'/objects/pack/*.pack')[0]
+            loc = cp._locate_idx(oids[2])
+            os.chmod(pack, 0o644)
+            with open(pack, 'r+b') as f:
+                f.seek(loc[1] + 5)
+                c = f.read(1)
+                f.seek(loc[1] + 5)
+                f.write(bytes(bytearray((ord(c) ^ 0xff,))))
+            cp = git.CatPipe(src)
+            WVEXCEPT(git.GitError, cp.get_raw, hexlify(oids[2]))
+
+
+@wvtest
+def test_walk_objects():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tgit-') as tmpdir:
+            environ[b'BUP_DIR'] = bupdir = tmpdir + b'/bup'
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            shared = w.new_blob(b'shared')
+            sub = w.new_tree([(0o100644, b'x', shared)])
+            commits = []
+            parent = None
+            for i in range(5):
+                blob = w.new_blob(b'data %d' % i)
+                tree = w.new_tree([(0o100644, b'a', blob),
+                                   (0o120000, b'l', shared),
+                                   (0o40000, b'sub', sub)])
+                parent = w.new_commit(tree, parent, b'a <a@b>', 0, 0,
+                                      b'a <a@b>', i, 0, b'msg %d' % i)
+                commits.append(parent)
+            w.close()
+
+            def get_many(oidxs):
+                for oidx in oidxs:
+                    it = git.cp().get(oidx)
+                    got, typ, size = next(it)
+                    yield got, typ, size, b''.join(it)
+
+            head = hexlify(commits[-1])
+            expected = set(item.oid for item in git.walk_object(git.cp().get,
+                                                                 head))
+            visited = set()
+            orig_batch = git._walk_batch
+            try:
+                git._walk_batch = 2
+                items = list(git.walk_objects(get_many, [head], visited))
+            finally:
+                git._walk_batch = orig_batch
+            WVPASSEQ(set(item.oid for item in items), expected)
+            read = [item.oid for item in items if item.type != b'blob']
+            WVPASSEQ(len(read), len(set(read)))
+            WVPASSEQ(len(read), 5 + 5 + 1)
+            # Breadth first: the commits come out before their trees.
+            WVPASSEQ([item.type for item in items[:2]], [b'commit'] * 2)
+            WVPASS([b'sub', b'x'] in [item.path for item in items])
+
+            # Nothing new is reachable from an older commit
+            WVPASSEQ(list(git.walk_objects(get_many, [hexlify(commits[1])],
+                                           visited)),
+                     [])
+            missing = hexlify(git.calc_hash(b'commit', b'missing'))
+            WVEXCEPT(git.MissingObject, list,
+                     git.walk_objects(get_many, [missing], set()))
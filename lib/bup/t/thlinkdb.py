@@ -0,0 +1,117 @@
+
+from __future__ import absolute_import
+import os
+
+from wvtest import *
+
+from bup import hlinkdb
+from bup.compat import py_maj
+from buptest import no_lingering_errors, test_tempdir
+
+if py_maj > 2:
+    import pickle
+else:
+    import cPickle as pickle
+
+
+def saved(db):
+    db.prepare_save()
+    db.commit_save()
+
+
+@wvtest
+def test_hlinkdb_updates():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-thlinkdb-') as tmpdir:
+            name = tmpdir + b'/hlink'
+            db = hlinkdb.HLinkDB(name)
+            db.add_path(b'/a/x', 1, 10)
+            db.add_path(b'/b/x', 1, 10)
+            db.add_path(b'/c/y', 2, 10)
+            WVPASSEQ(db.node_paths(1, 10), [b'/a/x', b'/b/x'])
+            saved(db)
+            WVPASSEQ(db.node_paths(1, 10), [b'/a/x', b'/b/x'])
+
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), [b'/a/x', b'/b/x'])
+            WVPASSEQ(db.node_paths(2, 10), [b'/c/y'])
+            WVEXCEPT(KeyError, db.node_paths, 3, 10)
+            db.del_path(b'/a/x')
+            db.del_path(b'/c/y')
+            db.del_path(b'/not/there')
+            WVPASSEQ(db.node_paths(1, 10), [b'/b/x'])
+            WVEXCEPT(KeyError, db.node_paths, 2, 10)
+            # Nothing changes until the save is committed.
+            db.prepare_save()
+            WVPASSEQ(hlinkdb.HLinkDB(name).node_paths(2, 10), [b'/c/y'])
+            db.commit_save()
+            size = os.stat(name).st_size
+
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), [b'/b/x'])
+            WVEXCEPT(KeyError, db.node_paths, 2, 10)
+            db.change_path(b'/b/x', 2, 10)
+            db.add_path(b'/c/y', 2, 10)
+            saved(db)
+            db = hlinkdb.HLinkDB(name)
+            WVEXCEPT(KeyError, db.node_paths, 1, 10)
+            WVPASSEQ(db.node_paths(2, 10), [b'/b/x', b'/c/y'])
+            # Small updates happen in place.
+            WVPASS(os.stat(name).st_size < size + 100)
+
+            # Enough new nodes to require a rewrite.
+            for i in range(1000):
+                db.add_path(b'/many/%d' % i, 3, i)
+                db.add_path(b'/many/%d-link' % i, 3, i)
+            saved(db)
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(2, 10), [b'/b/x', b'/c/y'])
+            WVPASSEQ(db.node_paths(3, 999), [b'/many/999', b'/many/999-link'])
+            for i in range(1000):
+                db.del_path(b'/many/%d-link' % i)
+            saved(db)
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(3, 7), [b'/many/7'])
+
+
+@wvtest
+def test_hlinkdb_journal():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-thlinkdb-') as tmpdir:
+            name = tmpdir + b'/hlink'
+            db = hlinkdb.HLinkDB(name)
+            db.add_path(b'/a/x', 1, 10)
+            db.add_path(b'/b/x', 1, 10)
+            saved(db)
+            db = hlinkdb.HLinkDB(name)
+            db.del_path(b'/a/x')
+            db.prepare_save()
+            # Simulate a commit that was interrupted before the journal
+            # was applied.
+            os.rename(db._tmpname, name + b'.journal')
+            db._tmpname = None
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), [b'/b/x'])
+            saved(db)
+            WVFAIL(os.path.exists(name + b'.journal'))
+            WVPASSEQ(hlinkdb.HLinkDB(name).node_paths(1, 10), [b'/b/x'])
+
+
+@wvtest
+def test_hlinkdb_pickled():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-thlinkdb-') as tmpdir:
+            name = tmpdir + b'/hlink'
+            with open(name, 'wb') as f:
+                pickle.dump({'1:10': [b'/a/x', b'/b/x'],
+                             '2:20': [b'/c/y', b'/d/y']},
+                            f, 2)
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), [b'/a/x', b'/b/x'])
+            db.del_path(b'/d/y')
+            saved(db)
+            with open(name, 'rb') as f:
+                WVPASSEQ(f.read(4), b'BHLK')
+            db = hlinkdb.HLinkDB(name)
+            WVPASSEQ(db.node_paths(1, 10), [b'/a/x', b'/b/x'])
+            WVPASSEQ(db.node_paths(2, 20), [b'/c/y'])
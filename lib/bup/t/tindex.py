@@ -1,6 +1,6 @@
 
 from __future__ import absolute_import, print_function
-import os, time
+import os, struct, time
 
 from wvtest import *
 
@@ -182,3 +182,305 @@ def index_dirty():
                 w3.close()
             finally:
                 os.chdir(orig_cwd)
+
+
+def fake_meta(mode, uid):
+    m = metadata.Metadata()
+    m.mode, m.uid, m.gid, m.user, m.group, m.rdev = mode, uid, 0, b'', b'', 0
+    m.atime = m.mtime = m.ctime = 0
+    return m
+
+@wvtest
+def index_metastore_offsets():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tindex-') as tmpdir:
+            meta_name = tmpdir + b'/index.meta'
+            metas = [fake_meta(0o100644, i) for i in range(3000)]
+            ms = index.MetaStoreWriter(meta_name)
+            ofs = [ms.store(m) for m in metas]
+            WVPASSEQ(len(set(ofs)), len(metas))
+            WVPASSEQ(ms.store(metas[7]), ofs[7])
+            ms.close()
+            WVPASS(os.path.exists(meta_name + b'.ofs'))
+            meta_size = os.stat(meta_name).st_size
+
+            # Reopening shouldn't have to read the store, or add anything.
+            ms = index.MetaStoreWriter(meta_name)
+            WVPASS([ms.store(m) for m in metas] == ofs)
+            ms.close()
+            WVPASSEQ(os.stat(meta_name).st_size, meta_size)
+
+            # Whatever the table doesn't cover should be found...
+            os.unlink(meta_name + b'.ofs')
+            ms = index.MetaStoreWriter(meta_name)
+            WVPASS([ms.store(m) for m in metas] == ofs)
+            # ...including records appended without the table.
+            with open(meta_name, 'ab') as f:
+                extra = fake_meta(0o100600, 7777)
+                f.write(extra.encode(include_path=False))
+            ms = index.MetaStoreWriter(meta_name)
+            WVPASSEQ(ms.store(extra), meta_size)
+            WVPASSEQ(ms.store(metas[0]), ofs[0])
+            ms.close()
+
+            # A table that wasn't closed cleanly is rebuilt.
+            ms = index.MetaStoreWriter(meta_name)
+            ms._file.close()
+            ms._file = None
+            ms2 = index.MetaStoreWriter(meta_name)
+            WVPASSEQ(ms2._offsets.meta_len, index._META_OFS_DIRTY)
+            WVPASSEQ(len(ms2._offsets), len(metas) + 1)
+            WVPASSEQ(ms2.store(metas[9]), ofs[9])
+            ms2.close()
+            del ms, ms2
+
+
+@wvtest
+def index_compact_metastore():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tindex-') as tmpdir:
+            orig_cwd = os.getcwd()
+            try:
+                os.chdir(tmpdir)
+                ds = xstat.stat(b'.')
+                fs = xstat.stat(lib_t_dir + b'/tindex.py')
+                tmax = (time.time() - 1) * 10**9
+                used = fake_meta(0o100644, 0)
+                ms = index.MetaStoreWriter(b'index.meta')
+                for i in range(100):
+                    ms.store(fake_meta(0o100600, i))
+                used_ofs = ms.store(used)
+                w = index.Writer(b'index', ms, tmax)
+                w.add(b'/etc/passwd', fs, used_ofs)
+                w.add(b'/etc/', ds, used_ofs)
+                w.add(b'/', ds, used_ofs)
+                w.close()
+                ms.close()
+                before = os.stat(b'index.meta').st_size
+                WVPASS(index.compact_metastore(b'index') > 0)
+                WVPASS(os.stat(b'index.meta').st_size < before)
+                r = index.Reader(b'index')
+                msr = index.MetaStoreReader(b'index.meta')
+                names = []
+                for e in r:
+                    names.append(e.name)
+                    if e.name == b'/etc/passwd':
+                        WVPASSEQ(msr.metadata_at(e.meta_ofs).mode, 0o100644)
+                WVPASSEQ(names, [b'/etc/passwd', b'/etc/', b'/'])
+                msr.close()
+                r.close()
+                # The offset table should match the compacted store.
+                ms = index.MetaStoreWriter(b'index.meta')
+                size = os.stat(b'index.meta').st_size
+                ms.store(used)
+                ms.close()
+                WVPASSEQ(os.stat(b'index.meta').st_size, size)
+            finally:
+                os.chdir(orig_cwd)
+
+
+@wvtest
+def index_compact_metastore_interrupted():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tindex-') as tmpdir:
+            orig_cwd = os.getcwd()
+            orig_rename = os.rename
+            try:
+                os.chdir(tmpdir)
+                ds = xstat.stat(b'.')
+                fs = xstat.stat(lib_t_dir + b'/tindex.py')
+                tmax = (time.time() - 1) * 10**9
+                used = fake_meta(0o100644, 0)
+                ms = index.MetaStoreWriter(b'index.meta')
+                for i in range(100):
+                    ms.store(fake_meta(0o100600, i))
+                used_ofs = ms.store(used)
+                w = index.Writer(b'index', ms, tmax)
+                w.add(b'/etc/passwd', fs, used_ofs)
+                w.add(b'/etc/', ds, used_ofs)
+                w.add(b'/', ds, used_ofs)
+                w.close()
+                ms.close()
+                # Crash after the new store is in place, but before
+                # the index that refers to it is.
+                renames = []
+                def crashing_rename(src, dst):
+                    if dst == b'index':
+                        raise KeyboardInterrupt()
+                    renames.append(dst)
+                    orig_rename(src, dst)
+                os.rename = crashing_rename
+                try:
+                    index.compact_metastore(b'index')
+                except KeyboardInterrupt:
+                    pass
+                os.rename = orig_rename
+                WVPASSEQ(renames[-2:], [b'index.meta.ofs', b'index.meta'])
+                WVPASS(os.path.exists(b'index.meta.compacted'))
+                # Opening the index finishes the swap.
+                r = index.Reader(b'index')
+                WVPASS(not os.path.exists(b'index.meta.compacted'))
+                WVPASS(not os.path.exists(b'index.compact.tmp'))
+                msr = index.MetaStoreReader(b'index.meta')
+                modes = [msr.metadata_at(e.meta_ofs).mode for e in r]
+                WVPASSEQ(modes, [0o100644] * 3)
+                msr.close()
+                r.close()
+                # As does opening the store for writing.
+                os.rename = crashing_rename
+                try:
+                    index.compact_metastore(b'index')
+                except KeyboardInterrupt:
+                    pass
+                os.rename = orig_rename
+                ms = index.MetaStoreWriter(b'index.meta')
+                ms.close()
+                WVPASS(not os.path.exists(b'index.meta.compacted'))
+                r = index.Reader(b'index')
+                msr = index.MetaStoreReader(b'index.meta')
+                modes = [msr.metadata_at(e.meta_ofs).mode for e in r]
+                WVPASSEQ(modes, [0o100644] * 3)
+                msr.close()
+                r.close()
+            finally:
+                os.rename = orig_rename
+                os.chdir(orig_cwd)
+
+
+@wvtest
+def index_lazy_entries():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tindex-') as tmpdir:
+            orig_cwd = os.getcwd()
+            try:
+                os.chdir(tmpdir)
+                ds = xstat.stat(b'.')
+                fs = xstat.stat(lib_t_dir + b'/tindex.py')
+                tmax = (time.time() - 1) * 10**9
+                ms = index.MetaStoreWriter(b'index.meta')
+                w = index.Writer(b'index', ms, tmax)
+                w.add(b'/a/c', fs, 0)
+                w.add(b'/a/b/x', fs, 0)
+                w.add(b'/a/b/', ds, 0)
+                w.add(b'/a/', ds, 0)
+                w.add(b'/', ds, 0)
+                w.close()
+                ms.close()
+                r = index.Reader(b'index')
+                entries = list(r)
+                WVPASSEQ([e.name for e in entries],
+                         [b'/a/c', b'/a/b/x', b'/a/b/', b'/a/', b'/'])
+                # forward_iter() produces the entries in file order,
+                # named by their basenames.
+                WVPASSEQ([e.name for e in r.forward_iter()],
+                         [b'x', b'c', b'b/', b'a/', b'/'])
+                WVPASSEQ([e.name for e in r.iter(b'/a/b/')],
+                         [b'/a/b/x', b'/a/b/'])
+                for e in entries:
+                    fields = struct.unpack(index.INDEX_SIG,
+                                           r.m[e._ofs : e._ofs + index.ENTLEN])
+                    WVPASSEQ(e.packed(), struct.pack(index.INDEX_SIG, *fields))
+                x = entries[1]
+                WVPASSEQ(x.size, fs.st_size)
+                WVPASSEQ(x.mtime, xstat.timespec_to_nsecs(
+                    xstat.nsecs_to_timespec(min(fs.st_mtime, tmax))))
+                # Assigning fields before they've been decoded shouldn't
+                # be undone by decoding the rest.
+                c = index.Reader(b'index').find(b'/a/c')
+                c.sha = b'\x07' * 20
+                WVPASSEQ(c.size, fs.st_size)
+                WVPASSEQ(c.sha, b'\x07' * 20)
+                WVEXCEPT(AttributeError, getattr, c, 'no_such_field')
+                r.close()
+            finally:
+                os.chdir(orig_cwd)
+
+
+@wvtest
+def index_delta():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tindex-') as tmpdir:
+            orig_cwd = os.getcwd()
+            try:
+                os.chdir(tmpdir)
+                ds = xstat.stat(b'.')
+                fs = xstat.stat(lib_t_dir + b'/tindex.py')
+                tmax = (time.time() - 1) * 10**9
+                ms = index.MetaStoreWriter(b'index.meta')
+                w = index.Writer(b'index', ms, tmax)
+                for d in range(39, -1, -1):
+                    for f in range(39, -1, -1):
+                        w.add(b'/d%02d/f%02d' % (d, f), fs, 0)
+                    w.add(b'/d%02d/' % d, ds, 0)
+                w.add(b'/', ds, 0)
+                w.close()
+                size = os.stat(b'index').st_size
+
+                def update(*names):
+                    r = index.Reader(b'index')
+                    w = index.Writer(b'index', ms, tmax)
+                    for name in names:
+                        w.add(name, ds if name.endswith(b'/') else fs, 0)
+                    wr = w.new_reader()
+                    result = index.update_delta(r, wr)
+                    r.close()
+                    wr.close()
+                    w.abort()
+                    return result
+
+                def names():
+                    return [e.name for e in index.Reader(b'index')]
+
+                before = names()
+                WVPASS(update(b'/d05/new', b'/d05/', b'/'))
+                WVPASSEQ(os.stat(b'index').st_size, size)
+                WVPASS(os.stat(b'index.delta').st_size < size / 10)
+                after = names()
+                WVPASSEQ(after, sorted(before + [b'/d05/new'], reverse=True))
+                r = index.Reader(b'index')
+                WVPASSEQ(len(r), len(after))
+                WVPASSEQ([e.name for e in r.forward_iter()], after)
+                # Changes to entries in either file are kept.
+                for name in (b'/d05/new', b'/d10/f03'):
+                    e = r.find(name)
+                    e.set_deleted()
+                    e.repack()
+                r.close()
+                WVPASS(index.Reader(b'index').find(b'/d05/new').is_deleted())
+                WVPASS(index.Reader(b'index').find(b'/d10/f03').is_deleted())
+
+                # A second delta replaces the first.
+                WVPASS(update(b'/d15/sub/x', b'/d15/sub/', b'/d15/', b'/'))
+                after = names()
+                WVPASSEQ(after,
+                         sorted(before + [b'/d05/new', b'/d15/sub/x',
+                                          b'/d15/sub/'],
+                                reverse=True))
+                WVPASSEQ(len(index.Reader(b'index')), len(after))
+
+                # Too much for a delta.
+                WVFAIL(update(*([b'/d07/g%03d' % i
+                                 for i in range(199, -1, -1)]
+                                + [b'/d07/', b'/'])))
+                WVPASSEQ(names(), after)
+
+                WVPASS(index.fold_delta(b'index'))
+                WVFAIL(os.path.exists(b'index.delta'))
+                WVFAIL(index.fold_delta(b'index'))
+                WVPASSEQ(names(), after)
+                r = index.Reader(b'index')
+                WVPASSEQ(len(r), len(after))
+                WVPASS(r.find(b'/d05/new').is_deleted())
+                WVPASS(r.find(b'/d10/f03').is_deleted())
+                WVFAIL(r.find(b'/d10/f04').is_deleted())
+                r.close()
+
+                # A delta for an index that's been rewritten is ignored.
+                WVPASS(update(b'/d01/new', b'/d01/', b'/'))
+                w = index.Writer(b'index', ms, tmax)
+                w.add(b'/', ds, 0)
+                w.close()
+                WVPASSEQ(names(), [b'/'])
+                ms.close()
+            finally:
+                os.chdir(orig_cwd)
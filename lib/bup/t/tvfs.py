@@ -1,6 +1,6 @@
 
 from __future__ import absolute_import, print_function
-from binascii import unhexlify
+from binascii import hexlify, unhexlify
 from collections import namedtuple
 from errno import ELOOP, ENOTDIR
 from io import BytesIO
@@ -13,7 +13,7 @@ from time import localtime, strftime, tzset
 from wvtest import *
 
 from bup._helpers import write_random
-from bup import git, metadata, vfs
+from bup import git, metadata, repo as repo_mod, vfs
 from bup.compat import environ, fsencode, items, range
 from bup.git import BUP_CHUNKED
 from bup.helpers import exc, shstr
@@ -311,6 +311,51 @@ def test_read_and_seek():
                                           b'%s/%d' % (data_path, size),
                                           read_sizes)
 
+@wvtest
+def test_cat_many():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-tvfs-cat-many-') as tmpdir:
+            bup_dir = tmpdir + b'/bup'
+            environ[b'GIT_DIR'] = bup_dir
+            environ[b'BUP_DIR'] = bup_dir
+            git.repodir = bup_dir
+            git.init_repo(bup_dir)
+            w = git.PackWriter()
+            blobs = [b'blob %d' % i * i for i in range(100)]
+            refs = [hexlify(w.new_blob(blob)) for blob in blobs]
+            w.close(run_midx=False)
+            missing = hexlify(git.calc_hash(b'blob', b'missing'))
+            refs.insert(50, missing)
+            blobs.insert(50, None)
+            orig = repo_mod._cat_jobs, repo_mod._cat_batch
+            try:
+                repo_mod._cat_batch = 7
+                for jobs in (1, 3):
+                    repo_mod._cat_jobs = jobs
+                    repo = LocalRepo()
+                    # Pass a generator to make sure the refs are consumed
+                    # lazily, and only read part of the result.
+                    got = []
+                    for item in repo.cat_many(ref for ref in refs):
+                        got.append(item)
+                        if len(got) == 60:
+                            break
+                    wvpasseq([(ref, b'blob', len(blob), blob)
+                              if blob is not None else (None,) * 4
+                              for ref, blob in zip(refs, blobs)][:60],
+                             got)
+                    wvpasseq([x[3] for x in repo.cat_many(refs)], blobs)
+                    pipes = list(repo._cat_pipes)
+                    wvpass(len(pipes) <= (0 if jobs == 1 else jobs))
+                    repo.close()
+                    # Every worker's pipe (and its subprocess) is closed.
+                    wvpasseq(repo._cat_pipes, [])
+                    for cp in pipes:
+                        wvpass(cp.p is None)
+                        wvpasseq(cp._packmaps, {})
+            finally:
+                repo_mod._cat_jobs, repo_mod._cat_batch = orig
+
 @wvtest
 def test_contents_with_mismatched_bupm_git_ordering():
     with no_lingering_errors():
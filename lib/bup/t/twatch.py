@@ -0,0 +1,105 @@
+
+from __future__ import absolute_import
+import os
+
+from wvtest import *
+
+from bup import _helpers, watch
+from bup.watch import Changes, LISTED, MODIFIED, TREE
+from buptest import no_lingering_errors, test_tempdir
+
+
+@wvtest
+def test_changes():
+    with no_lingering_errors():
+        c = Changes([(MODIFIED, b'/a/b/f'), (LISTED, b'/a/b/'),
+                     (TREE, b'/x/'), (MODIFIED, b'/y/g')])
+        WVPASSEQ(len(c), 4)
+        WVPASSEQ(list(Changes.decode(c.encode()).records()),
+                 list(c.records()))
+        WVPASSEQ(list(c.under(b'/a/').records()),
+                 [(LISTED, b'/a/b/'), (MODIFIED, b'/a/b/f')])
+        # A change to a whole tree applies to everything in it.
+        WVPASSEQ(list(c.under(b'/x/y/').records()), [(TREE, b'/x/y/')])
+        WVPASSEQ(list(c.outside([b'/a/', b'/x/']).records()),
+                 [(MODIFIED, b'/y/g')])
+        WVEXCEPT(ValueError, c.add, b'?', b'/z')
+
+
+@wvtest
+def test_journal():
+    with no_lingering_errors():
+        with test_tempdir(b'bup-twatch-') as tmpdir:
+            ix = tmpdir + b'/bupindex'
+            watch.append_changes(ix, Changes([(MODIFIED, b'/a/f')]))
+            # Without a watcher, nothing can be assumed.
+            WVPASSEQ(watch.take_changes(ix), None)
+            if not watch.inotify_init:
+                return
+            root = tmpdir + b'/src/'
+            os.mkdir(root)
+            w = watch.Watcher(ix, [root])
+            try:
+                WVPASSEQ(watch.watched_roots(ix), None)
+                w.start()
+                WVPASS(watch.watcher_running(ix))
+                WVPASSEQ(watch.watched_roots(ix), [root])
+                WVPASS(watch.under_roots(root + b'x/y', [root]))
+                WVFAIL(watch.under_roots(tmpdir + b'/', [root]))
+                WVEXCEPT(Exception, watch.Watcher(ix, [root]).start)
+                c = watch.take_changes(ix)
+                WVPASSEQ(list(c.records()),
+                         [(TREE, root), (MODIFIED, b'/a/f')])
+                # Not finished, so the changes are taken again.
+                watch.append_changes(ix, Changes([(LISTED, root)]))
+                c = watch.take_changes(ix)
+                WVPASSEQ(len(c), 3)
+                watch.finish_changes(ix, Changes([(MODIFIED, b'/a/f')]))
+                WVPASSEQ(list(watch.take_changes(ix).records()),
+                         [(MODIFIED, b'/a/f')])
+                watch.finish_changes(ix)
+                WVPASSEQ(len(watch.take_changes(ix)), 0)
+            finally:
+                w.close()
+            WVFAIL(watch.watcher_running(ix))
+            WVPASSEQ(watch.watched_roots(ix), None)
+
+
+@wvtest
+def test_watcher_events():
+    with no_lingering_errors():
+        if not watch.inotify_init:
+            return
+        with test_tempdir(b'bup-twatch-') as tmpdir:
+            ix = tmpdir + b'/bupindex'
+            root = tmpdir + b'/src/'
+            os.mkdir(root)
+            os.mkdir(root + b'd')
+            with open(root + b'd/f', 'wb') as f:
+                f.write(b'x')
+            w = watch.Watcher(ix, [root])
+            try:
+                w.start()
+                WVPASSEQ(len(w), 2)
+                def changes():
+                    return list(w.changes_from(_helpers.inotify_read(w.fd))
+                                .records())
+                with open(root + b'd/f', 'ab') as f:
+                    f.write(b'y')
+                WVPASSEQ(changes(), [(MODIFIED, root + b'd/f')])
+                os.makedirs(root + b'd/new/sub')
+                WVPASSEQ(changes(), [(TREE, root + b'd/new/'),
+                                     (LISTED, root + b'd/')])
+                # The new directory (and everything in it) is watched.
+                WVPASSEQ(len(w), 4)
+                os.rename(root + b'd/new', root + b'moved')
+                WVPASSEQ(changes(), [(TREE, root + b'moved/'),
+                                     (LISTED, root),
+                                     (LISTED, root + b'd/')])
+                WVPASSEQ(sorted(w.path_wds),
+                         [root, root + b'd/', root + b'moved/',
+                          root + b'moved/sub/'])
+                os.unlink(root + b'd/f')
+                WVPASSEQ(changes(), [(LISTED, root + b'd/')])
+            finally:
+                w.close()
@@ -143,22 +143,38 @@ def _skip_chunks_before_offset(tree, offset):
 def _tree_chunks(repo, tree, startofs):
     "Tree should be a sequence of (name, mode, hash) as per tree_decode()."
     assert(startofs >= 0)
+    # Each run of blobs is read ahead (and concurrently) via
+    # cat_many().  The runs are finite, and each is finished before the
+    # next subtree is read, so that cat_many() never has to handle
+    # other requests (e.g. via a remote connection) while it's busy.
+    def read_blobs(blobs):
+        refs = [hexlify(oid) for oid, skip in blobs]
+        for i, (_, obj_t, size, data) in enumerate(repo.cat_many(refs)):
+            assert obj_t == b'blob'
+            yield data[blobs[i][1]:]
+    blobs = []
     # name is the chunk's hex offset in the original file
     for mode, name, oid in _skip_chunks_before_offset(tree, startofs):
         ofs = int(name, 16)
         skipmore = startofs - ofs
         if skipmore < 0:
             skipmore = 0
+        if not S_ISDIR(mode):
+            blobs.append((oid, skipmore))
+            continue
+        if blobs:
+            for data in read_blobs(blobs):
+                yield data
+            blobs = []
         it = repo.cat(hexlify(oid))
         _, obj_t, size = next(it)
         data = b''.join(it)
-        if S_ISDIR(mode):
-            assert obj_t == b'tree'
-            for b in _tree_chunks(repo, tree_decode(data), skipmore):
-                yield b
-        else:
-            assert obj_t == b'blob'
-            yield data[skipmore:]
+        assert obj_t == b'tree'
+        for b in _tree_chunks(repo, tree_decode(data), skipmore):
+            yield b
+    if blobs:
+        for data in read_blobs(blobs):
+            yield data
 
 class _ChunkReader:
     def __init__(self, repo, oid, startofs):
@@ -0,0 +1,410 @@
+"""Filesystem change journal (bup index --watch and --from-journal).
+
+While `bup index --watch` is running, it uses inotify to record the
+paths that may have changed in a journal (INDEX.changes) next to the
+index, so that `bup index --from-journal` can update just the
+corresponding entries instead of walking everything.
+
+The journal is a sequence of records, each of which is a one byte
+kind, followed by an absolute path (with a trailing slash for
+directories), followed by a NUL:
+
+  M: the path itself (e.g. a file's content, or anyone's attributes)
+     may have changed
+  L: the directory's list of entries may have changed
+  T: anything at or below the directory may have changed
+
+Appends are serialized via flock() on the journal.  A reader takes
+all of the records at once (via take_changes()) by moving them to
+INDEX.changes.taken, which is only removed (by finish_changes()) once
+the index has been updated, so nothing is lost if the update fails.
+
+The journal is only trustworthy if a watcher has been running the
+whole time since the last update, and so the watcher holds a lock on
+INDEX.watch, and writes its pid there, followed by its roots (each
+terminated by a NUL), once it has established all of its watches (and
+recorded a T for each of its roots, since anything could have changed
+before then).  If there's no such watcher, take_changes() returns
+None, and the caller has to assume that anything could have changed.
+The same T records are written if the kernel's event queue overflows.
+Nothing outside the roots (cf. watched_roots()) is recorded, so
+anything there could have changed too.
+"""
+
+from __future__ import absolute_import
+import errno, fcntl, os, select, stat, time
+
+from bup import _helpers
+from bup.drecurse import recursive_dirlist
+from bup.helpers import debug1, log, unlink
+from bup.io import path_msg
+
+
+MODIFIED = b'M'
+LISTED = b'L'
+TREE = b'T'
+
+# How long the watcher lets events accumulate before recording them,
+# so that (for example) a file that's being written is only recorded
+# once.
+BATCH_SECS = 1.0
+
+inotify_init = getattr(_helpers, 'inotify_init', None)
+if inotify_init:
+    _watch_mask = (_helpers.IN_MODIFY | _helpers.IN_ATTRIB
+                   | _helpers.IN_CLOSE_WRITE
+                   | _helpers.IN_MOVED_FROM | _helpers.IN_MOVED_TO
+                   | _helpers.IN_CREATE | _helpers.IN_DELETE
+                   | _helpers.IN_DELETE_SELF | _helpers.IN_MOVE_SELF
+                   | _helpers.IN_ONLYDIR | _helpers.IN_DONT_FOLLOW)
+
+
+def journal_name(indexfile):
+    return indexfile + b'.changes'
+
+def _taken_name(indexfile):
+    return indexfile + b'.changes.taken'
+
+def _lock_name(indexfile):
+    return indexfile + b'.watch'
+
+
+def _parent_name(path):
+    return path[:path.rindex(b'/', 0, len(path) - 1) + 1]
+
+
+class Changes:
+    """The set of paths recorded in a journal."""
+    def __init__(self, records=()):
+        self.modified = set()
+        self.listed = set()
+        self.trees = set()
+        for kind, path in records:
+            self.add(kind, path)
+
+    def _set(self, kind):
+        if kind == MODIFIED:
+            return self.modified
+        if kind == LISTED:
+            return self.listed
+        if kind == TREE:
+            return self.trees
+        raise ValueError('unknown change kind %r' % kind)
+
+    def add(self, kind, path):
+        self._set(kind).add(path)
+
+    def records(self):
+        for kind in (TREE, LISTED, MODIFIED):
+            for path in sorted(self._set(kind)):
+                yield kind, path
+
+    def __len__(self):
+        return len(self.modified) + len(self.listed) + len(self.trees)
+
+    def under(self, top):
+        """Return the changes that affect top (a path as produced by
+        index.reduce_paths()), i.e. those at or below it, with any
+        change to the whole tree above it applied to top itself."""
+        result = Changes()
+        for kind, path in self.records():
+            if path.startswith(top):
+                result.add(kind, path)
+            elif kind == TREE and top.startswith(path):
+                result.add(TREE, top)
+        return result
+
+    def outside(self, tops):
+        """Return the changes that aren't at or below any of tops."""
+        return Changes((kind, path) for kind, path in self.records()
+                       if not any(path.startswith(top) for top in tops))
+
+    def encode(self):
+        return b''.join(kind + path + b'\0' for kind, path in self.records())
+
+    @staticmethod
+    def decode(data):
+        # Ignore a trailing partial record (there shouldn't be one).
+        return Changes((rec[:1], rec[1:]) for rec in data.split(b'\0')[:-1]
+                       if rec)
+
+
+def _read_all(fd):
+    chunks = []
+    while True:
+        b = os.read(fd, 1024 * 1024)
+        if not b:
+            return b''.join(chunks)
+        chunks.append(b)
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def append_changes(indexfile, changes):
+    """Add the changes to the journal for indexfile."""
+    data = changes.encode()
+    if not data:
+        return
+    name = journal_name(indexfile)
+    while True:
+        fd = os.open(name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # Make sure the journal wasn't taken while we were waiting.
+            try:
+                current = os.stat(name).st_ino
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                current = None
+            if current == os.fstat(fd).st_ino:
+                _write_all(fd, data)
+                return
+        finally:
+            os.close(fd)
+
+
+def watcher_running(indexfile):
+    """Return true if a watcher for indexfile is ready and running."""
+    try:
+        fd = os.open(_lock_name(indexfile), os.O_RDONLY)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            # Locked; the pid is written once the watcher is ready.
+            return os.fstat(fd).st_size > 0
+        return False
+    finally:
+        os.close(fd)
+
+
+def watched_roots(indexfile):
+    """Return the list of directories (with trailing slashes) that
+    the running watcher for indexfile is watching, or None if there's
+    no watcher running."""
+    try:
+        with open(_lock_name(indexfile), 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    if not watcher_running(indexfile):
+        return None
+    pid, sep, roots = data.partition(b'\n')
+    return roots.split(b'\0')[:-1]
+
+
+def under_roots(path, roots):
+    """Return true if path is at or below any of roots."""
+    return any(path.startswith(root) for root in roots)
+
+
+def take_changes(indexfile):
+    """Return the Changes recorded for indexfile since the last call
+    whose update was finished (cf. finish_changes()), or None if
+    there's no watcher running, in which case anything may have
+    changed."""
+    if not watcher_running(indexfile):
+        return None
+    taken = _taken_name(indexfile)
+    try:
+        with open(taken, 'rb') as f:
+            changes = Changes.decode(f.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        changes = Changes()
+    name = journal_name(indexfile)
+    try:
+        fd = os.open(name, os.O_RDONLY)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return changes
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        for kind, path in Changes.decode(_read_all(fd)).records():
+            changes.add(kind, path)
+        tmpname = taken + b'.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(changes.encode())
+        os.rename(tmpname, taken)
+        unlink(name)
+    finally:
+        os.close(fd)
+    return changes
+
+
+def finish_changes(indexfile, unused=None):
+    """Discard the changes returned by take_changes(), other than the
+    unused ones, which are returned to the journal."""
+    if unused:
+        append_changes(indexfile, unused)
+    unlink(_taken_name(indexfile))
+
+
+def clear_changes(indexfile):
+    unlink(journal_name(indexfile))
+    unlink(_taken_name(indexfile))
+
+
+class Watcher:
+    """Record changes to everything in roots (a list of directory
+    paths, with trailing slashes) in the journal for indexfile."""
+    def __init__(self, indexfile, roots, xdev=False, bup_dir=None,
+                 excluded_paths=None, exclude_rxs=None):
+        self.indexfile = indexfile
+        self.roots = roots
+        self.xdev = xdev
+        self.bup_dir = bup_dir
+        self.excluded_paths = excluded_paths
+        self.exclude_rxs = exclude_rxs
+        self.lockfile = None
+        self.fd = None
+        self.fd = inotify_init()
+        self.wd_paths = {}
+        self.path_wds = {}
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.lockfile:
+            self.lockfile.truncate(0)
+            self.lockfile.close()
+            self.lockfile = None
+
+    def __len__(self):
+        return len(self.wd_paths)
+
+    def _watch(self, path):
+        try:
+            wd = _helpers.inotify_add_watch(self.fd, path, _watch_mask)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise Exception('%s: too many inotify watches'
+                                ' (cf. fs.inotify.max_user_watches)'
+                                % path_msg(path))
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return  # Gone already; the parent will notice.
+            raise
+        old = self.wd_paths.get(wd)
+        if old is not None:
+            del self.path_wds[old]
+        self.wd_paths[wd] = path
+        self.path_wds[path] = wd
+
+    def _watch_tree(self, top):
+        for path, st in recursive_dirlist([top], xdev=self.xdev,
+                                          bup_dir=self.bup_dir,
+                                          excluded_paths=self.excluded_paths,
+                                          exclude_rxs=self.exclude_rxs):
+            if stat.S_ISDIR(st.st_mode):
+                self._watch(path)
+
+    def _forget_tree(self, top):
+        for path in [p for p in self.path_wds if p.startswith(top)]:
+            wd = self.path_wds.pop(path)
+            del self.wd_paths[wd]
+            try:
+                _helpers.inotify_rm_watch(self.fd, wd)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+
+    def start(self):
+        """Establish the watches, and record that anything could have
+        changed before they were."""
+        self.lockfile = open(_lock_name(self.indexfile), 'a+b')
+        try:
+            fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            self.lockfile.close()
+            self.lockfile = None
+            raise Exception('%s is already being watched'
+                            % path_msg(self.indexfile))
+        self.lockfile.truncate(0)
+        for root in self.roots:
+            self._watch_tree(root)
+        append_changes(self.indexfile,
+                       Changes((TREE, root) for root in self.roots))
+        # Write everything at once, since a non-empty file means ready.
+        _write_all(self.lockfile.fileno(),
+                   b'%d\n' % os.getpid()
+                   + b''.join(root + b'\0' for root in self.roots))
+
+    def changes_from(self, events):
+        """Return the Changes implied by events, a list of
+        (wd, mask, cookie, name) as returned by inotify_read(), and
+        update the watches to match."""
+        changes = Changes()
+        for wd, mask, cookie, name in events:
+            if mask & _helpers.IN_Q_OVERFLOW:
+                log('watch: event queue overflowed; rescanning everything\n')
+                for root in self.roots:
+                    changes.add(TREE, root)
+                continue
+            dir = self.wd_paths.get(wd)
+            if dir is None:
+                continue
+            if not name:
+                if mask & (_helpers.IN_IGNORED | _helpers.IN_DELETE_SELF
+                           | _helpers.IN_MOVE_SELF):
+                    # The parent (if it's watched) reports the rest.
+                    if dir in self.roots:
+                        changes.add(TREE, dir)
+                    self._forget_tree(dir)
+                elif mask & (_helpers.IN_ATTRIB | _helpers.IN_MODIFY):
+                    changes.add(MODIFIED, dir)
+                continue
+            isdir = mask & _helpers.IN_ISDIR
+            path = dir + name + (b'/' if isdir else b'')
+            if mask & (_helpers.IN_CREATE | _helpers.IN_DELETE
+                       | _helpers.IN_MOVED_FROM | _helpers.IN_MOVED_TO):
+                changes.add(LISTED, dir)
+                if isdir:
+                    if mask & (_helpers.IN_DELETE | _helpers.IN_MOVED_FROM):
+                        self._forget_tree(path)
+                    else:
+                        self._watch_tree(path)
+                        changes.add(TREE, path)
+            else:
+                changes.add(MODIFIED, path)
+        return changes
+
+    def run(self):
+        """Record changes until interrupted, or until the index's
+        directory disappears."""
+        while True:
+            select.select([self.fd], [], [])
+            # Let related events accumulate.
+            time.sleep(BATCH_SECS)
+            events = []
+            while select.select([self.fd], [], [], 0)[0]:
+                events.extend(_helpers.inotify_read(self.fd))
+            changes = self.changes_from(events)
+            debug1('watch: %d events, %d changes, %d watches\n'
+                   % (len(events), len(changes), len(self)))
+            try:
+                append_changes(self.indexfile, changes)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                log('watch: %s no longer exists; stopping\n'
+                    % path_msg(os.path.dirname(self.indexfile)))
+                return
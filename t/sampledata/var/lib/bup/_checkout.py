@@ -0,0 +1,3 @@
+COMMIT='ce69ccfecf0712b53a50655b962f126f2d24f238'
+NAMES='(tag: ce69ccf)'
+DATE='2026-10-18 19:15:22 +0000'
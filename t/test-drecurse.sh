@@ -97,4 +97,47 @@ $(pwd)/src/a/
 $(pwd)/src/a-link
 $(pwd)/src/"
 
+WVSTART "drecurse --jobs"
+WVPASS mkdir -p src/d/e/f src/d/g src/h
+WVPASS touch src/d/e/f/1 src/d/e/2 src/d/g/3 src/h/4 src/d/5
+WVPASS bup drecurse src > serial.out
+for jobs in 2 3 8; do
+    WVPASS bup drecurse -j "$jobs" src > jobs.out
+    WVPASS cmp serial.out jobs.out
+done
+WVPASSEQ "$(bup drecurse -j 4 --exclude src/d/e/ --exclude-rx '/3$' src)" \
+"src/h/4
+src/h/
+src/d/g/
+src/d/5
+src/d/
+src/c
+src/b/2
+src/b/1
+src/b/
+src/a/2
+src/a/1
+src/a/
+src/a-link
+src/"
+
+WVSTART "drecurse --jobs (open file limit)"
+# The read ahead mustn't grow with the depth of the tree, and z/ is
+# visited first (before the rest of its siblings) at every level.
+WVPASS mkdir deep
+dir=deep
+for level in $(seq 12); do
+    for sub in z $(seq 40); do
+        WVPASS mkdir "$dir/$sub"
+    done
+    dir="$dir/z"
+done
+WVPASS bup drecurse deep > serial.out
+WVPASSEQ "$(wc -l < serial.out)" 493
+for jobs in 2 8; do
+    WVPASS bash -c "ulimit -n 64 && \"$top/bup\" drecurse -j $jobs deep" \
+           > jobs.out
+    WVPASS cmp serial.out jobs.out
+done
+
 WVPASS rm -rf "$tmpdir"
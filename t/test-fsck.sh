@@ -26,6 +26,9 @@ WVPASS bup save -n fsck-test src/var/lib
 WVPASS bup save -n fsck-test src/y
 WVPASS bup fsck
 WVPASS bup fsck --quick
+WVPASS bup fsck -j2 --report fsck.json
+WVPASSEQ "$(grep -c '"result": "ok"' fsck.json)" \
+         "$(ls "$BUP_DIR"/objects/pack/*.pack | wc -l)"
 if bup fsck --par2-ok; then
     WVSTART "fsck (par2)"
 else
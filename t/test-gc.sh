@@ -93,6 +93,8 @@ size_after=$(WVPASS data-size "$BUP_DIR") || exit $?
 
 WVPASS [ "$size_before" -gt 5000000 ]
 WVPASS [ "$size_after" -lt 100000 ]
+# The rewritten packs' records (and their CRCs) should still be valid
+WVPASS git verify-pack "$BUP_DIR"/objects/pack/*.idx
 
 WVPASS rm -r "$tmpdir/restore"
 WVPASS bup restore -C "$tmpdir/restore" /a/latest
@@ -238,4 +240,41 @@ packs_after="$(ls "$BUP_DIR/objects/pack/"*.pack)" || exit $?
 WVPASSEQ 1 "$(grep -cE '^rewriting ' gc.log)"
 WVPASSEQ "$packs_before" "$packs_after"
 
+WVSTART "gc (--jobs)"
+
+WVPASS rm -rf "$BUP_DIR"
+WVPASS bup init
+WVPASS rm -rf src && mkdir src
+for i in $(seq 8); do
+    WVPASS bup random 100k | WVPASS bup split -n split-$i
+    WVPASS echo $i > src/$i
+    WVPASS bup index src
+    WVPASS bup save -n src-$i src
+done
+WVPASS bup rm --unsafe split-2 split-5 src-3
+WVPASS rm -rf "$tmpdir/bup-j1" "$tmpdir/bup-bloom"
+WVPASS cp -pPR "$BUP_DIR" "$tmpdir/bup-j1"
+WVPASS cp -pPR "$BUP_DIR" "$tmpdir/bup-bloom"
+
+WVPASS bup gc -v $GC_OPTS --threshold 0 -j 3 2>&1 | tee gc.log
+WVPASS [ "$(grep -cE '^rewriting ' gc.log)" -gt 1 ]
+WVPASS grep -E '^tracking live objects exactly' gc.log
+WVPASS git verify-pack "$BUP_DIR"/objects/pack/*.idx
+# With the exact (bitmap) record, nothing unreachable should remain.
+WVPASSEQ "$(git --git-dir "$BUP_DIR" fsck --unreachable --no-reflogs \
+                | grep unreachable)" ""
+packs_j3="$(cd "$BUP_DIR/objects/pack" && ls *.pack)" || exit $?
+WVPASS bup join src-8 > /dev/null
+
+# The serial sweep should produce exactly the same packs.
+WVPASS bup -d "$tmpdir/bup-j1" gc -v $GC_OPTS --threshold 0 2>&1 | tee gc.log
+packs_j1="$(cd "$tmpdir/bup-j1/objects/pack" && ls *.pack)" || exit $?
+WVPASSEQ "$packs_j3" "$packs_j1"
+
+WVPASS bup -d "$tmpdir/bup-bloom" gc -v $GC_OPTS --threshold 0 \
+    --bitmap-max 0 2>&1 | tee gc.log
+WVPASS grep -E '^expecting to retain about' gc.log
+WVPASS git verify-pack "$tmpdir/bup-bloom"/objects/pack/*.idx
+WVPASS bup -d "$tmpdir/bup-bloom" join src-8 > /dev/null
+
 WVPASS rm -rf "$tmpdir"
@@ -124,4 +124,157 @@ WVPASS bup save -r ":$BUP_DIR" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR/fake/path" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR" -n r-test $D/fake/path
 
+WVSTART "index --compact"
+for i in 1 2 3 4 5; do
+    WVPASS chmod 0$((600 + i)) $D/a
+    WVPASS bup index -u $D
+done
+before="$(WVPASS bup index -ls $D)" || exit $?
+meta_size="$(WVPASS wc -c < "$BUP_DIR/bupindex.meta")" || exit $?
+WVPASS bup index --compact
+WVPASS bup index --check -p $D
+WVPASSEQ "$(bup index -ls $D)" "$before"
+WVPASS test "$(wc -c < "$BUP_DIR/bupindex.meta")" -lt "$meta_size"
+WVPASS bup save -n compacted $D
+WVPASSEQ "$(bup ls -l "compacted/latest$(pwd)/$D/a" | cut -d' ' -f1)" -rw----r-x
+WVPASS bup index -u $D
+WVPASS bup index --clear
+WVFAIL test -e "$BUP_DIR/bupindex.meta.ofs"
+
+WVSTART "index delta"
+WVPASS rm -rf $D
+for d in $(seq 10 49); do
+    WVPASS mkdir -p $D/d$d
+    WVPASS touch $(seq -f "$D/d$d/f%g" 10 49)
+done
+WVPASS bup tick
+WVPASS bup index -u $D
+WVPASS bup save -n delta $D
+WVPASS touch $D/d20/new
+WVPASS bup tick
+WVPASS bup index -u $D
+WVPASS test -e "$BUP_DIR/bupindex.delta"
+WVPASS bup index --check -u $D
+WVPASSEQ "$(bup index -m $D)" "$D/d20/new
+$D/d20/
+$D/"
+WVPASS bup save -n delta $D
+WVPASSEQ "$(bup index -m $D)" ""
+WVPASS bup index --compact
+WVFAIL test -e "$BUP_DIR/bupindex.delta"
+WVPASSEQ "$(cd $D && bup index -p d20 | head -2)" "d20/new
+d20/f49"
+WVPASSEQ "$(bup index -m $D)" ""
+WVPASS bup ls "delta/latest/$(pwd)/$D/d20/new"
+
+WVSTART "index --assume-stable"
+WVPASS rm -rf $D
+WVPASS mkdir -p $D/x/y $D/z
+WVPASS touch $D/x/f $D/x/y/g $D/z/h
+WVPASS touch -d @$(($(date +%s) - 10)) $D/x/f $D/x/y/g $D/z/h $D/x/y $D/x $D/z
+WVPASS bup tick
+WVPASS bup index -u $D
+WVPASS bup save -n stable $D
+WVFAIL bup index -s --assume-stable=dirs $D
+WVFAIL bup index -u --assume-stable=everything $D
+# An in-place change doesn't change the directory, so it's only
+# noticed without --assume-stable, but additions are noticed with dirs.
+echo changed > $D/x/f
+WVPASS touch $D/x/y/new $D/z/h2
+WVPASS bup tick
+# Fold any delta into the index, so that it can be restored by itself.
+WVPASS bup index --compact
+WVPASS cp "$BUP_DIR/bupindex" "$BUP_DIR/bupindex.saved"
+WVPASS bup index -u --assume-stable=dirs -j 2 $D
+WVPASSEQ "$(cd $D && bup index -m)" \
+"z/h2
+z/
+x/y/new
+x/y/
+x/
+./"
+WVPASS bup index --check -p $D
+# With trees, unchanged x's subtree is kept without looking inside.
+WVPASS cp "$BUP_DIR/bupindex.saved" "$BUP_DIR/bupindex"
+WVPASS rm -f "$BUP_DIR/bupindex.delta"
+WVPASS bup index -u --assume-stable=trees $D
+WVPASSEQ "$(cd $D && bup index -m)" \
+"z/h2
+z/
+./"
+WVPASS bup index --check -p $D
+WVPASS cp "$BUP_DIR/bupindex.saved" "$BUP_DIR/bupindex"
+WVPASS rm -f "$BUP_DIR/bupindex.delta"
+WVPASS bup index -u $D
+WVPASSEQ "$(cd $D && bup index -m)" \
+"z/h2
+z/
+x/y/new
+x/y/
+x/f
+x/
+./"
+WVPASS rm "$BUP_DIR/bupindex.saved"
+
+if bup-python -c 'from bup import watch; assert watch.inotify_init' 2>/dev/null
+then
+    WVSTART "index --watch and --from-journal"
+    WVPASS rm -rf $D
+    WVPASS mkdir -p $D/x/y $D/z
+    WVPASS touch $D/x/f $D/x/y/g $D/z/h
+    WVPASS bup tick
+    WVPASS bup index -u $D
+    # Without a watcher, everything is updated.
+    WVPASS touch $D/z/h2
+    WVPASS bup index --from-journal $D
+    WVPASSEQ "$(cd $D && bup index -p z)" \
+"z/h2
+z/h
+z/"
+    # Not via the bup function, so that $! is the watcher itself.
+    "$top/bup" index --watch $D &
+    watcher=$!
+    while ! test -s "$BUP_DIR/bupindex.watch"; do sleep 0.1; done
+    # The first update after the watcher starts looks at everything.
+    WVPASS bup index --from-journal $D
+    WVPASS bup save -n watched $D
+    echo changed > $D/x/f
+    WVPASS mkdir -p $D/x/new/sub
+    WVPASS touch $D/x/new/sub/n
+    WVPASS rm $D/z/h
+    WVPASS sleep 2
+    WVPASS bup index --from-journal $D
+    WVPASS kill $watcher
+    wait $watcher
+    from_journal="$(bup index -s $D)" || exit $?
+    WVPASS bup index -u $D
+    WVPASSEQ "$from_journal" "$(bup index -s $D)"
+    WVPASS bup index --check -p $D
+
+    WVSTART "index --from-journal outside the watched paths"
+    "$top/bup" index --watch $D/x &
+    watcher=$!
+    while ! test -s "$BUP_DIR/bupindex.watch"; do sleep 0.1; done
+    WVPASS bup index --from-journal $D
+    WVPASS bup save -n watched $D
+    WVPASS touch $D/z/outside $D/x/inside
+    WVPASS sleep 2
+    # Only x/ is watched, so the rest of $D has to be examined.
+    WVPASS bup index --from-journal $D
+    WVPASSEQ "$(cd $D && bup index -m)" \
+"z/outside
+z/
+x/inside
+x/
+./"
+    WVPASS touch $D/z/outside2
+    WVPASS bup index --from-journal $D/z
+    WVPASSEQ "$(cd $D && bup index -m z)" \
+"z/outside2
+z/outside
+z/"
+    WVPASS kill $watcher
+    wait $watcher
+fi
+
 WVPASS rm -rf "$tmpdir"
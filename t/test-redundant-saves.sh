@@ -58,4 +58,32 @@ tree3=$(WVPASS bup save -t /) || exit $?
 indexed_tree3="$(WVPASS t/subtree-hash "$tree3" "${indexed_top[@]}" src)" || exit $?
 WVPASSEQ "$indexed_tree1" "$indexed_tree3"
 
+WVSTART 'save --jobs'
+WVPASS bup random 4M > "$tmpdir/src/d/random"
+WVPASS bup index -u "$tmpdir/src"
+tree4=$(WVPASS bup save -t "$tmpdir/src") || exit $?
+indexed_tree4="$(WVPASS t/subtree-hash "$tree4" "${indexed_top[@]}" src)" \
+    || exit $?
+export BUP_DIR="$tmpdir/bup-jobs"
+export GIT_DIR="$BUP_DIR"
+WVPASS bup init
+WVPASS bup index -u "$tmpdir/src"
+tree5=$(WVPASS bup save -j 4 -t "$tmpdir/src") || exit $?
+indexed_tree5="$(WVPASS t/subtree-hash "$tree5" "${indexed_top[@]}" src)" \
+    || exit $?
+WVPASSEQ "$indexed_tree4" "$indexed_tree5"
+
+WVSTART 'remote save of data the server already has'
+# A new client that has never written anything to the repository
+# should only have to read the file once.
+export BUP_DIR="$tmpdir/client"
+export GIT_DIR="$BUP_DIR"
+WVPASS bup init
+WVPASS bup index -u "$tmpdir/src"
+WVPASS bup save -r ":$tmpdir/bup-jobs" -vv -n other "$tmpdir/src" 2> "$tmpdir/log"
+WVPASS grep -E '^A .*/d/random' "$tmpdir/log"
+WVPASS bup save -r ":$tmpdir/bup-jobs" -vv -n other "$tmpdir/src" 2> "$tmpdir/log"
+WVPASS grep -E '^  .*/src/ *$' "$tmpdir/log"
+WVFAIL grep -E '^[AM] ' "$tmpdir/log"
+
 WVPASS rm -rf "$tmpdir"